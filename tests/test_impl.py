@@ -50,6 +50,261 @@ def test_getBlock(cxx_impl: VectorCollectionT, numpy_impl: VectorCollectionT):
 def test_search(cxx_impl: VectorCollectionT, numpy_impl: VectorCollectionT):
     assert cxx_impl.search([1, 2, 3]) == numpy_impl.search([1, 2, 3])
 
+def test_buffer(cxx_impl: VectorCollectionT, numpy_impl: VectorCollectionT):
+    vectors = np.array([[1, 0, 0], [0, 2, 1]], dtype=np.float32)
+    cxx_impl.addBlock(["b1", "b2"], vectors)
+    numpy_impl.addBlock(["b1", "b2"], vectors)
+    assert cxx_impl.getBlock(["b1", "b2"]) == vectors.tolist()
+    assert (cxx_impl.getBlock(["b1", "b2"], as_numpy=True) == vectors).all()
+
+    cxx_impl.setBlock(["b2"], memoryview(vectors[:1]))
+    assert cxx_impl.get("b2") == [1, 0, 0]
+
+    query = np.array([1, 2, 3], dtype=np.float32)
+    assert cxx_impl.search(query) == cxx_impl.search([1, 2, 3])
+    assert cxx_impl.searchBatch(np.stack([query, query])) == cxx_impl.searchBatch([[1, 2, 3], [1, 2, 3]])
+    with pytest.raises(RuntimeError):
+        cxx_impl.addBlock(["b3"], np.zeros((1, 3), dtype=np.float64))
+    with pytest.raises(RuntimeError):
+        cxx_impl.addBlock(["b3", "b4"], np.zeros((3, 2), dtype=np.float32).T)
+    cxx_impl.deleteBlock(["b1", "b2"])
+    numpy_impl.deleteBlock(["b1", "b2"])
+
+def test_searchBatch(cxx_impl: VectorCollectionT, numpy_impl: VectorCollectionT):
+    queries = [[1, 2, 3], [3, 2, 1], [0, 1, 0]]
+    ids_cxx, scores_cxx = cxx_impl.searchBatch(queries)
+    ids_np, scores_np = numpy_impl.searchBatch(queries)
+    assert ids_cxx == ids_np
+    assert almostEqual(scores_cxx, scores_np)
+    for i, query in enumerate(queries):
+        ids, scores = cxx_impl.search(query)
+        assert ids == ids_cxx[i]
+        assert almostEqual(scores, scores_cxx[i])
+
+def test_addStream(cxx_impl: VectorCollectionT, numpy_impl: VectorCollectionT):
+    np.random.seed(0)
+    vectors = np.random.rand(20, 3).tolist()
+    for i, vector in enumerate(vectors):
+        cxx_impl.addBlock([f"s{i}"], [vector])
+        numpy_impl.addBlock([f"s{i}"], [vector])
+    assert len(cxx_impl) == len(numpy_impl)
+    assert cxx_impl.getBlock(["s0", "s19"]) == numpy_impl.getBlock(["s0", "s19"])
+    ids_cxx, scores_cxx = cxx_impl.search([1, 2, 3], k=5)
+    ids_np, scores_np = numpy_impl.search([1, 2, 3], k=5)
+    assert ids_cxx == ids_np
+    assert almostEqual(scores_cxx, scores_np)
+
+def test_delete(cxx_impl: VectorCollectionT, numpy_impl: VectorCollectionT):
+    to_delete = ["s3", "1", "s19", "s0"]
+    cxx_impl.deleteBlock(to_delete)
+    numpy_impl.deleteBlock(to_delete)
+    assert sorted(cxx_impl.keys()) == sorted(numpy_impl.keys())
+    assert not any(cxx_impl.has(id) for id in to_delete)
+    assert cxx_impl.getBlock(["s1", "s18"]) == numpy_impl.getBlock(["s1", "s18"])
+    ids_cxx, scores_cxx = cxx_impl.search([1, 2, 3])
+    ids_np, scores_np = numpy_impl.search([1, 2, 3])
+    assert ids_cxx == ids_np
+    assert almostEqual(scores_cxx, scores_np)
+
+def test_setBlock(cxx_impl: VectorCollectionT, numpy_impl: VectorCollectionT):
+    # mixed updates and adds, the result should be in the order of the ids
+    ids = ["s5", "n1", "s2", "n2"]
+    vectors = [[1, 0, 0], [0, 1, 0], [0, 0, 1], [1, 1, 1]]
+    cxx_impl.setBlock(ids, vectors)
+    numpy_impl.setBlock(ids, vectors)
+    assert cxx_impl.getBlock(ids[::-1]) == numpy_impl.getBlock(ids[::-1]) == vectors[::-1]
+    assert sorted(cxx_impl.keys()) == sorted(numpy_impl.keys())
+    changes = numpy_impl.flush()
+    assert changes["ADD"][1][changes["ADD"][0].index("n1")] == np.array([0, 1, 0], dtype=np.float32).tobytes()
+    # deleted then set again after a flush is an update
+    numpy_impl.deleteBlock(["s5"])
+    numpy_impl.setBlock(["s5"], [[1, 0, 0]])
+    assert numpy_impl.flush()["UPDATE"][0] == ["s5"]
+
+def test_searchParallel():
+    from tiny_vectordb import getVectorCollectionBackend
+    n = 50000
+    collection = getVectorCollectionBackend('cxx')(None, quite_loading=True, name="Parallel", dimension=3, num_threads=4)
+    collection_ref = getVectorCollectionBackend('numpy')(None, quite_loading=True, name="Parallel", dimension=3)
+    np.random.seed(1)
+    vectors = (np.random.rand(n, 3) - 0.5).tolist()
+    ids = [str(x) for x in range(n)]
+    collection.addBlock(ids, vectors)
+    collection_ref.addBlock(ids, vectors)
+
+    for k in [1, 10, 100]:
+        ids_cxx, scores_cxx = collection.search([1, 2, 3], k=k)
+        ids_np, scores_np = collection_ref.search([1, 2, 3], k=k)
+        assert ids_cxx == ids_np
+        assert almostEqual(scores_cxx, scores_np)
+    queries = [[1, 2, 3], [-1, 0.5, 0], [0, 0, 1]]
+    for k in [1, 10, 100]:
+        ids_cxx, scores_cxx = collection.searchBatch(queries, k=k)
+        ids_np, scores_np = collection_ref.searchBatch(queries, k=k)
+        assert ids_cxx == ids_np
+        assert almostEqual(scores_cxx, scores_np)
+    ids_cxx, scores_cxx = collection.search([1, 2, 3])
+    assert len(ids_cxx) == n
+    assert almostEqual(scores_cxx, sorted(scores_cxx, reverse=True))
+
+def test_quantized():
+    from tiny_vectordb import getVectorCollectionBackend
+    n = 20000
+    np.random.seed(3)
+    vectors = (np.random.rand(n, 3) - 0.5).astype(np.float32)
+    ids = [str(x) for x in range(n)]
+    queries = (np.random.rand(20, 3) - 0.5).astype(np.float32)
+    for dtype in ["float16", "int8"]:
+        collection = getVectorCollectionBackend('cxx')(None, quite_loading=True, name="Quantized", dimension=3, dtype=dtype)
+        collection.addBlock(ids, vectors)
+        # the quantized rows are maintained on modifications
+        collection.deleteBlock(ids[:1000])
+        collection.setBlock(ids[1000:2000], -vectors[1000:2000])
+        assert collection.dtype == dtype
+        assert collection._impl.quantizedBytes() < len(collection) * 3 * 4
+
+        collection.dtype = "float32"
+        exact_ids, exact_scores = collection.searchBatch(queries, 10)
+        collection.dtype = dtype
+        approx_ids, approx_scores = collection.searchBatch(queries, 10)
+        assert np.mean([len(set(a) & set(e)) / 10 for a, e in zip(approx_ids, exact_ids)]) > 0.95
+        # re-ranked scores are exact
+        for q, a, s in zip(queries, approx_ids, approx_scores):
+            found = collection.getBlock(a, as_numpy=True)
+            assert almostEqual(s, found @ q / np.linalg.norm(found, axis=1) / np.linalg.norm(q))
+        collection.rerank = 0
+        ids_q, scores_q = collection.search(queries[0], 10)
+        assert almostEqual(np.sort(scores_q)[::-1], scores_q)
+        assert np.allclose(scores_q, exact_scores[0], atol=0.05)
+        # the on-disk encoding of a quantized row
+        blob = collection.encoding.encodeQuantized(vectors[0].tolist(), dtype)
+        assert len(blob) < 3 * 4 + 8 and np.allclose(collection.encoding.decodeQuantized(blob), vectors[0], atol=0.01)
+
+def test_metric():
+    from tiny_vectordb import getVectorCollectionBackend
+    n = 20000
+    np.random.seed(4)
+    vectors = ((np.random.rand(n, 3) - 0.5) * 10).astype(np.float32)
+    ids = [str(x) for x in range(n)]
+    queries = ((np.random.rand(5, 3) - 0.5) * 10).astype(np.float32)
+    for metric in ["cosine", "ip", "l2"]:
+        cxx = getVectorCollectionBackend('cxx')(None, quite_loading=True, name="Metric", dimension=3, metric=metric)
+        npy = getVectorCollectionBackend('numpy')(None, quite_loading=True, name="Metric", dimension=3, metric=metric)
+        assert cxx.metric == metric
+        cxx.addBlock(ids, vectors)
+        npy.addBlock(ids, vectors)
+        # both the blocked top-k and the full selection
+        for k in [10, n]:
+            cxx_ids, cxx_scores = cxx.searchBatch(queries, k)
+            npy_ids, npy_scores = npy.searchBatch(queries, k)
+            assert np.allclose(cxx_scores, npy_scores, rtol=1e-4, atol=1e-3)
+            assert np.allclose(cxx.search(queries[0], k)[1], cxx_scores[0], rtol=1e-4, atol=1e-5)
+        assert np.allclose(cxx._impl.score(queries[0].tolist()), npy._scores(queries[:1])[0], rtol=1e-4, atol=1e-3)
+        # quantized scores are re-ranked with the metric
+        cxx.dtype = "int8"
+        assert np.allclose(cxx.searchBatch(queries, 10)[1], npy.searchBatch(queries, 10)[1], rtol=1e-4, atol=1e-3)
+
+def test_searchChunked():
+    from tiny_vectordb import getVectorCollectionBackend
+    n = 10000
+    np.random.seed(5)
+    vectors = (np.random.rand(n, 3) - 0.5).astype(np.float32)
+    ids = [str(x) for x in range(n)]
+    queries = (np.random.rand(4, 3) - 0.5).astype(np.float32)
+    cxx = getVectorCollectionBackend('cxx')(None, quite_loading=True, name="Chunked", dimension=3)
+    npy = getVectorCollectionBackend('numpy')(None, quite_loading=True, name="Chunked", dimension=3)
+    npy.SCORE_CHUNK_ROWS = 999
+    cxx.addBlock(ids, vectors)
+    npy.addBlock(ids, vectors)
+    # norms are kept up to date on modifications
+    cxx.setBlock(ids[:100], vectors[:100] * 3)
+    npy.setBlock(ids[:100], vectors[:100] * 3)
+    cxx.deleteBlock(ids[100:200])
+    npy.deleteBlock(ids[100:200])
+    for k in [1, 10, 2500, -1]:
+        cxx_ids, cxx_scores = cxx.searchBatch(queries, k)
+        npy_ids, npy_scores = npy.searchBatch(queries, k)
+        assert cxx_ids == npy_ids
+        assert np.allclose(cxx_scores, npy_scores, atol=1e-6)
+
+def test_filter():
+    from tiny_vectordb import getVectorCollectionBackend
+    n = 20000
+    np.random.seed(5)
+    vectors = (np.random.rand(n, 3) - 0.5).astype(np.float32)
+    ids = [f"t{x % 50}/{x}" for x in range(n)]
+    queries = (np.random.rand(5, 3) - 0.5).astype(np.float32)
+    cxx = getVectorCollectionBackend('cxx')(None, quite_loading=True, name="Filter", dimension=3)
+    npy = getVectorCollectionBackend('numpy')(None, quite_loading=True, name="Filter", dimension=3)
+    for c in [cxx, npy]:
+        c.addBlock(ids, vectors)
+        c.setAttributes("group", ids, [x % 3 for x in range(n)])
+        c.setAttributes("kind", ids[:100], ["a", "b"] * 50)
+        c.deleteBlock(ids[:10])
+    filters = [
+        {"prefix": "t7/"},                              # sparse, scored directly
+        {"where": {"group": [0, 2]}},                   # dense, masked scan
+        {"where": {"kind": "a"}, "prefix": "t1"},
+        {"ids": ids[5:500:3]},
+        {"mask": "even"},
+        {"where": {"kind": None}, "prefix": "t2/"},
+        {"prefix": "none"},
+    ]
+    for f in filters:
+        # the mask is in the order of keys(), which differs between the backends
+        f_cxx, f_np = [{**f, "mask": [int(id.split("/")[1]) % 2 == 0 for id in c.keys()]} if "mask" in f else f for c in [cxx, npy]]
+        for k in [10, -1]:
+            ids_cxx, scores_cxx = cxx.searchBatch(queries, k, filter=f_cxx)
+            ids_np, scores_np = npy.searchBatch(queries, k, filter=f_np)
+            assert [len(x) for x in ids_cxx] == [len(x) for x in ids_np]
+            assert np.allclose(scores_cxx, scores_np, atol=1e-6)
+            assert np.allclose(cxx.search(queries[0], k, filter=f_cxx)[1], scores_cxx[0], atol=1e-6)
+    # the indexes only return the allowed rows
+    cxx.buildHNSW()
+    found = cxx.search(queries[0], 10, filter={"where": {"group": 1}})[0]
+    assert len(found) == 10 and cxx.getAttributes("group", found) == [1] * 10
+
+def test_hnswUpdated():
+    from tiny_vectordb import getVectorCollectionBackend
+    n = 500
+    np.random.seed(7)
+    ids = [str(x) for x in range(n)]
+    queries = np.random.randn(50, 16).astype(np.float32)
+    collection = getVectorCollectionBackend('cxx')(None, quite_loading=True, name="Updated", dimension=16, index="hnsw", ef_search=20)
+    collection.addBlock(ids, np.random.randn(n, 16).astype(np.float32))
+    # the updated rows keep their nodes, and the deleted ones are reused
+    for _ in range(3):
+        collection.setBlock(ids, np.random.randn(n, 16).astype(np.float32))
+        assert all(len(found) == 10 for found in collection.searchBatch(queries, 10, index="hnsw")[0])
+    collection.deleteBlock(ids[:100])
+    collection.addBlock(ids[:100], np.random.randn(100, 16).astype(np.float32))
+    assert collection._impl.hnswInfo()["n_nodes"] == n and collection._impl.hnswInfo()["n_deleted"] == 0
+    assert collection.search(collection.get(ids[0]), 1)[0] == [ids[0]]
+    # rebuilt without a flush when the freed nodes outnumber the live ones
+    collection.deleteBlock(ids[:300])
+    assert collection._impl.hnswInfo()["n_nodes"] == n - 300
+    assert all(len(found) == 10 for found in collection.searchBatch(queries, 10, index="hnsw")[0])
+
+def test_concurrent():
+    from concurrent.futures import ThreadPoolExecutor
+    from tiny_vectordb import getVectorCollectionBackend
+    collection = getVectorCollectionBackend('cxx')(None, quite_loading=True, name="Concurrent", dimension=3)
+    np.random.seed(2)
+    collection.addBlock([f"init{i}" for i in range(1000)], np.random.rand(1000, 3).tolist())
+
+    def write(i: int):
+        collection.addBlock([f"w{i}_{j}" for j in range(10)], np.random.rand(10, 3).tolist())
+        collection.deleteBlock([f"w{i}_0"])
+    def read(i: int):
+        ids, scores = collection.search([1, 2, 3], k=10)
+        assert len(ids) == 10 and almostEqual(scores, sorted(scores, reverse=True))
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        futures = [executor.submit(write if i % 4 == 0 else read, i) for i in range(200)]
+        for f in futures:
+            f.result()
+    assert len(collection) == 1000 + 50 * 9
+
 def test_savenload():
     from tiny_vectordb import VectorDatabase
     import os
@@ -81,4 +336,50 @@ def test_savenload():
     collection = database.getCollection("Test")
     assert almostEqual(collection.getBlock(ids), vectors)
 
-    os.remove(test_db_path)
\ No newline at end of file
+    os.remove(test_db_path)
+
+def test_cacheKey(monkeypatch):
+    from tiny_vectordb import jit
+    key = jit._cacheKey(3, "g++", ["-O2"], [])
+    assert key == jit._cacheKey(3, "g++", ["-O2"], [])
+    assert key != jit._cacheKey(3, "g++", ["-O3"], [])
+    assert key != jit._cacheKey(4, "g++", ["-O2"], [])
+    # native builds are not shared between CPUs
+    native_key = jit._cacheKey(3, "g++", ["-march=native"], [])
+    monkeypatch.setattr(jit, "_nativeTarget", lambda: "another cpu")
+    assert native_key != jit._cacheKey(3, "g++", ["-march=native"], [])
+    assert key == jit._cacheKey(3, "g++", ["-O2"], [])
+
+def test_prebuilt(tmp_path, monkeypatch):
+    from tiny_vectordb import jit
+    m_file, = jit.build([3], out_dir=str(tmp_path), quite=True)
+    assert m_file.startswith(str(tmp_path))
+    monkeypatch.setattr(jit, "PREBUILT_DIRS", [str(tmp_path)])
+    assert jit.findModule(3) == m_file
+    assert jit.load(3).__name__ == "vecdbImpl3"
+
+def test_kernel():
+    from tiny_vectordb import getVectorCollectionBackend
+    n, dim = 3000, 12
+    np.random.seed(6)
+    vectors = np.random.randn(n, dim).astype(np.float32)
+    ids = [str(x) for x in range(n)]
+    queries = np.random.randn(5, dim).astype(np.float32)
+    results = {}
+    for kernel in ["fixed", "runtime"]:
+        collection = getVectorCollectionBackend('cxx')(None, quite_loading=True, name="Kernel", dimension=dim, kernel=kernel, index="hnsw")
+        assert collection._impl.dim == dim
+        collection.addBlock(ids, vectors)
+        collection.deleteBlock(ids[:100])
+        collection.trainIndex(16)
+        collection.trainPQ(4)
+        results[kernel] = [collection.searchBatch(queries, 10, index=index) for index in ["flat", "ivf", "hnsw", "pq"]]
+        collection.dtype = "int8"
+        results[kernel].append(collection.searchBatch(queries, 10, index="flat"))
+        assert collection.getBlock(ids[100:110]) == vectors[100:110].tolist()
+    assert collection.clib.FEAT_DIM == -1
+    for (ids_fixed, scores_fixed), (ids_runtime, scores_runtime) in zip(results["fixed"], results["runtime"]):
+        assert ids_fixed == ids_runtime
+        assert np.allclose(scores_fixed, scores_runtime, atol=1e-5)
+    with pytest.raises(ValueError):
+        getVectorCollectionBackend('cxx')(None, quite_loading=True, name="Kernel", dimension=dim, kernel="jit")
@@ -33,4 +33,503 @@ def test_diskio(database: VectorDatabase):
     collection.deleteBlock(["1", "2"])
     # collection._impl.update("3", np.zeros(LEN).tolist())
     # collection._impl.print()
-    database.commit()
\ No newline at end of file
+    database.commit()
+
+def test_migrate():
+    import sqlite3, base64
+    migrate_db_path = os.path.join(os.path.dirname(__file__), "test_migrate.db")
+    if os.path.exists(migrate_db_path):
+        os.remove(migrate_db_path)
+
+    # database of the old format, base64 encoded vectors in TEXT column
+    np.random.seed(0)
+    vectors = np.random.rand(n, LEN_6).astype(np.float32)
+    ids = [str(x) for x in range(n)]
+    conn = sqlite3.connect(migrate_db_path)
+    conn.execute("CREATE TABLE Test (id TEXT PRIMARY KEY, vector TEXT)")
+    conn.executemany("INSERT INTO Test VALUES (?, ?)", [(i, base64.b64encode(v.tobytes()).decode()) for i, v in zip(ids, vectors)])
+    conn.commit()
+    conn.close()
+
+    for backend in ["cxx", "numpy"]:
+        os.environ["TVDB_BACKEND"] = backend
+        database = VectorDatabase(migrate_db_path, [{ "name": "Test", "dimension": LEN_6 }])
+        assert database.disk_io.format_version == database.disk_io.FORMAT_VERSION
+        assert np.allclose(database.getCollection("Test").getBlock(ids), vectors)
+    os.environ.pop("TVDB_BACKEND")
+    os.remove(migrate_db_path)
+
+    # database of format 1, without the quantized column
+    conn = sqlite3.connect(migrate_db_path)
+    conn.execute("CREATE TABLE Test (id TEXT PRIMARY KEY, vector BLOB)")
+    conn.executemany("INSERT INTO Test VALUES (?, ?)", [(i, v.tobytes()) for i, v in zip(ids, vectors)])
+    conn.execute("PRAGMA user_version = 1")
+    conn.commit()
+    conn.close()
+    database = VectorDatabase(migrate_db_path, [{ "name": "Test", "dimension": LEN_6, "dtype": "int8" }])
+    assert database.disk_io.format_version == database.disk_io.FORMAT_VERSION
+    assert np.allclose(database.getCollection("Test").getBlock(ids), vectors)
+    # the quantized rows are saved when first loaded
+    assert database.disk_io.cur.execute("SELECT COUNT(*) FROM Test WHERE quantized IS NOT NULL").fetchone()[0] == n
+    os.remove(migrate_db_path)
+
+
+def test_commitBulk():
+    bulk_db_path = os.path.join(os.path.dirname(__file__), "test_bulk.db")
+    if os.path.exists(bulk_db_path):
+        os.remove(bulk_db_path)
+    configs = [{ "name": "Test", "dimension": LEN_6 }]
+    np.random.seed(0)
+    vectors = np.random.rand(1000, LEN_6).astype(np.float32)
+    ids = [str(x) for x in range(1000)]
+
+    database = VectorDatabase(bulk_db_path, configs)
+    collection = database.getCollection("Test")
+    collection.addBlock(ids, vectors.tolist())
+    database.commit()
+    vectors[:100] = 0.5
+    collection.setBlock(ids[:100], vectors[:100].tolist())
+    collection.deleteBlock(ids[900:])
+    database.commit()
+
+    database = VectorDatabase(bulk_db_path, configs)
+    collection = database.getCollection("Test")
+    assert sorted(collection.keys()) == sorted(ids[:900])
+    assert np.allclose(collection.getBlock(ids[:900]), vectors[:900])
+    chunks = list(database.disk_io.iterTableData("Test", chunk_size=128))
+    assert [len(c[0]) for c in chunks] == [128] * 7 + [4]
+    os.remove(bulk_db_path)
+
+def test_commitFailure(monkeypatch):
+    fail_db_path = os.path.join(os.path.dirname(__file__), "test_fail.db")
+    configs = [{ "name": "Test", "dimension": LEN_6 }, { "name": "Hello", "dimension": LEN_6 }]
+    np.random.seed(0)
+    vectors = np.random.rand(100, LEN_6).astype(np.float32)
+    ids = [str(x) for x in range(100)]
+
+    for backend in ["cxx", "numpy"]:
+        os.environ["TVDB_BACKEND"] = backend
+        if os.path.exists(fail_db_path):
+            os.remove(fail_db_path)
+        database = VectorDatabase(fail_db_path, configs)
+        collection, hello = database["Test"], database["Hello"]
+        collection.addBlock(ids[:50], vectors[:50])
+        database.commit()
+        collection.addBlock(ids[50:], vectors[50:])
+        collection.setBlock(ids[:10], vectors[:10] * 2)
+        collection.deleteBlock(ids[10:20])
+        collection.setAttributes("tag", ids[20:30], ["a"] * 10)
+        hello.addBlock(ids[:10], vectors[:10])
+
+        # the write of the last collection fails, the transaction is rolled back
+        insertBulk = database.disk_io.insertBulk
+        def failInsert(name, *args):
+            if name == "Hello":
+                raise RuntimeError("disk failure")
+            insertBulk(name, *args)
+        with monkeypatch.context() as m:
+            m.setattr(database.disk_io, "insertBulk", failInsert)
+            with pytest.raises(RuntimeError):
+                database.commit()
+        assert database.disk_io.countTable("Test") == 50
+        # changes after the failure are merged with the restored ones
+        collection.deleteBlock(ids[50:55])
+        collection.addBlock(ids[10:12], vectors[10:12])
+        database.commit()
+
+        database = VectorDatabase(fail_db_path, configs)
+        collection = database["Test"]
+        remaining = ids[:12] + ids[20:50] + ids[55:]
+        assert sorted(collection.keys()) == sorted(remaining)
+        assert np.allclose(collection.getBlock(ids[:10]), vectors[:10] * 2)
+        assert np.allclose(collection.getBlock(ids[55:]), vectors[55:])
+        assert collection.getAttributes("tag", ids[20:30]) == ["a"] * 10
+        assert sorted(database["Hello"].keys()) == sorted(ids[:10])
+    os.environ.pop("TVDB_BACKEND")
+    os.remove(fail_db_path)
+
+
+def test_mmapStorage():
+    import shutil
+    mmap_db_path = os.path.join(os.path.dirname(__file__), "test_mmap.db")
+    for p in [mmap_db_path, mmap_db_path + ".segments"]:
+        if os.path.isdir(p): shutil.rmtree(p)
+        elif os.path.exists(p): os.remove(p)
+    configs = [{ "name": "Test", "dimension": LEN_6 }]
+    np.random.seed(0)
+    vectors = np.random.rand(100, LEN_6).astype(np.float32)
+    ids = [str(x) for x in range(100)]
+
+    database = VectorDatabase(mmap_db_path, configs, storage="mmap")
+    database.getCollection("Test").addBlock(ids, vectors)
+    database.commit()
+
+    database = VectorDatabase(mmap_db_path, configs, storage="mmap")
+    collection = database.getCollection("Test")
+    assert collection._impl.isMapped()
+    assert np.allclose(collection.getBlock(ids), vectors)
+    assert collection.search(vectors[3].tolist(), 1)[0] == ["3"]
+
+    # modifications are made in place, committed to the log without rewriting the segment, 
+    # and applied on top of the segment when loaded
+    header = database.segment_io.readHeader("Test")
+    collection.update("3", [0.5] * LEN_6)
+    collection.deleteBlock(["4"])
+    assert collection._impl.isMapped()
+    database.commit()
+    vectors[3] = 0.5
+    assert database.segment_io.readHeader("Test") == header and database.disk_io.countLog("Test") == 2
+    database = VectorDatabase(mmap_db_path, configs, storage="mmap")
+    collection = database.getCollection("Test")
+    assert collection._impl.isMapped() and len(collection) == 99
+    assert np.allclose(collection.get("3"), vectors[3]) and not collection.has("4")
+
+    # changes made without the segment files are detected by the generation
+    database = VectorDatabase(mmap_db_path, configs)
+    database.getCollection("Test").deleteBlock(["5"])
+    database.commit()
+
+    for backend in ["cxx", "numpy"]:
+        os.environ["TVDB_BACKEND"] = backend
+        database = VectorDatabase(mmap_db_path, configs, storage="mmap")
+        collection = database.getCollection("Test")
+        remaining = [i for i in ids if i not in ("4", "5")]
+        assert sorted(collection.keys()) == sorted(remaining)
+        assert np.allclose([collection.get(i) for i in remaining], vectors[[int(i) for i in remaining]])
+    # the norms stored in the segment are mapped, not computed from the vectors
+    assert not collection._norms.flags.owndata
+    assert np.allclose(collection._norms[:len(collection)], np.linalg.norm(collection.getBlock(collection.keys(), as_numpy=True), axis=1))
+    os.environ.pop("TVDB_BACKEND")
+
+    os.remove(mmap_db_path)
+    shutil.rmtree(mmap_db_path + ".segments")
+
+
+def test_quantizedStorage():
+    import shutil
+    from tiny_vectordb import getVectorCollectionBackend
+    quantized_db_path = os.path.join(os.path.dirname(__file__), "test_quantized.db")
+    for p in [quantized_db_path, quantized_db_path + ".segments"]:
+        if os.path.isdir(p): shutil.rmtree(p)
+        elif os.path.exists(p): os.remove(p)
+    n, dim = 2000, 32
+    configs = [{ "name": "Test", "dimension": dim, "dtype": "int8" }]
+    np.random.seed(5)
+    vectors = np.random.randn(n, dim).astype(np.float32)
+    ids = [str(x) for x in range(n)]
+    queries = np.random.randn(5, dim).astype(np.float32)
+    exact = getVectorCollectionBackend('cxx')(None, quite_loading=True, name="Exact", dimension=dim)
+    exact.addBlock(ids, vectors)
+
+    # only the quantized rows are in memory, the float32 vectors are read from the database
+    database = VectorDatabase(quantized_db_path, configs)
+    collection = database.getCollection("Test")
+    assert not collection._impl.getKeepRows()
+    collection.addBlock(ids, vectors)
+    assert np.array_equal(collection.getBlock(ids[:10], as_numpy=True), vectors[:10])
+    database.commit()
+    assert collection.memoryBytes() < exact.memoryBytes() / 2
+    assert np.array_equal(collection.getBlock(ids[:10], as_numpy=True), vectors[:10])
+    assert collection.get("missing") == [] and collection.getBlock(["0", "missing"])[1] == []
+    exact_ids, exact_scores = exact.searchBatch(queries, 10)
+    found_ids, found_scores = collection.searchBatch(queries, 10)
+    assert found_ids == exact_ids and np.allclose(found_scores, exact_scores, atol=1e-5)
+    assert collection.search(queries[0], 10)[0] == exact_ids[0]
+
+    collection.setBlock(ids[:5], vectors[5:10])
+    collection.deleteBlock(ids[-5:])
+    exact.setBlock(ids[:5], vectors[5:10])
+    exact.deleteBlock(ids[-5:])
+    assert np.array_equal(collection.getBlock(ids[:5], as_numpy=True), vectors[5:10])
+    database.commit()
+    assert database.disk_io.cur.execute("SELECT COUNT(*) FROM Test WHERE quantized IS NULL").fetchone()[0] == 0
+
+    # reloaded from the saved quantized rows
+    for storage in ["sqlite", "mmap"]:
+        database = VectorDatabase(quantized_db_path, configs, storage=storage)
+        collection = database.getCollection("Test")
+        assert len(collection) == n - 5 and collection._impl.getKeepRows() == (storage == "mmap")
+        assert collection.searchBatch(queries, 10)[0] == exact.searchBatch(queries, 10)[0]
+        assert np.array_equal(collection.get(ids[0]), vectors[5])
+    os.remove(quantized_db_path)
+    shutil.rmtree(quantized_db_path + ".segments")
+
+
+def test_lazy():
+    lazy_db_path = os.path.join(os.path.dirname(__file__), "test_lazy.db")
+    if os.path.exists(lazy_db_path):
+        os.remove(lazy_db_path)
+    configs = [{ "name": f"C{i}", "dimension": LEN_6 } for i in range(3)]
+    np.random.seed(0)
+    vectors = np.random.rand(100, LEN_6).astype(np.float32)
+    ids = [str(x) for x in range(100)]
+
+    database = VectorDatabase(lazy_db_path, configs)
+    for name in database.getCollectionNames():
+        database[name].addBlock(ids, vectors)
+    database.commit()
+    size = database["C0"].memoryBytes()
+    assert size >= 100 * LEN_6 * 4
+
+    # budget of two collections
+    database = VectorDatabase(lazy_db_path, configs, lazy=True, memory_budget=2 * size)
+    assert not any(database.isLoaded(name) for name in database)
+    assert database.getCollectionNames() == ["C0", "C1", "C2"]
+    assert "C1" in database and list(database.keys()) == ["C0", "C1", "C2"]
+    database["C0"].update("0", [0.5] * LEN_6)
+    database.getCollection("C1")
+    assert database.isLoaded("C0") and database.isLoaded("C1")
+    database["C2"]
+    assert not database.isLoaded("C0")      # evicted, with changes saved
+    assert np.allclose(database["C0"].get("0"), [0.5] * LEN_6)
+    assert not database.isLoaded("C1")
+    database.unloadCollection("C0")
+    assert [name for name in database if database.isLoaded(name)] == ["C2"]
+    assert database.get("C1") is not None and database.get("C3") is None
+    assert database.isLoaded("C1")
+    os.remove(lazy_db_path)
+
+
+def test_ivf():
+    ivf_db_path = os.path.join(os.path.dirname(__file__), "test_ivf.db")
+    if os.path.exists(ivf_db_path):
+        os.remove(ivf_db_path)
+    configs = [{ "name": "Test", "dimension": LEN_6, "index": "ivf", "n_lists": 16, "nprobe": 1 }]
+    np.random.seed(0)
+    vectors = np.random.randn(5000, LEN_6).astype(np.float32)
+    ids = [str(x) for x in range(5000)]
+
+    def checkSelfSearch(collection, sample_ids):
+        # a vector is always in the list of its nearest centroid, so it is found with a single probe
+        for i in sample_ids:
+            assert collection.search(collection.get(i), 1)[0] == [i]
+
+    database = VectorDatabase(ivf_db_path, configs)
+    collection = database.getCollection("Test")
+    collection.addBlock(ids[:4000], vectors[:4000])
+    collection.trainIndex()
+    assert collection._impl.isIndexTrained()
+
+    # the index is maintained on modifications
+    collection.addBlock(ids[4000:], vectors[4000:])
+    collection.deleteBlock(ids[:1000:2])
+    collection.setBlock(ids[1:1000:2], -vectors[1:1000:2])
+    remaining = ids[1:1000:2] + ids[1000:]
+    checkSelfSearch(collection, remaining[::50])
+
+    # recall against exhaustive search
+    queries = np.random.randn(20, LEN_6).astype(np.float32)
+    collection.nprobe = 16
+    exact = collection.searchBatch(queries, 10)[0]
+    collection.nprobe = 4
+    approx = collection.searchBatch(queries, 10)[0]
+    assert np.mean([len(set(a) & set(e)) / 10 for a, e in zip(approx, exact)]) > 0.8
+    database.commit()
+
+    # the index is saved and restored
+    database = VectorDatabase(ivf_db_path, configs)
+    collection = database.getCollection("Test")
+    assert collection._impl.isIndexTrained()
+    assert collection.nprobe == 1
+    checkSelfSearch(collection, remaining[::50])
+
+    # only the lists of the changed rows are written, the centroids are kept
+    centroids = database.disk_io.getMeta("ivf.Test")
+    collection.setBlock(remaining[:10], vectors[:10])
+    collection.deleteBlock(remaining[10:20])
+    database.commit()
+    assert database.disk_io.getMeta("ivf.Test") == centroids
+    saved_ids, saved_lists = database.disk_io.getIndexRows(database.disk_io.IVF_TABLE_PREFIX, "Test")
+    assert sorted(saved_ids) == sorted(collection.keys())
+    database = VectorDatabase(ivf_db_path, configs)
+    collection = database.getCollection("Test")
+    checkSelfSearch(collection, remaining[:10] + remaining[20::50])
+    os.remove(ivf_db_path)
+
+def test_hnsw():
+    hnsw_db_path = os.path.join(os.path.dirname(__file__), "test_hnsw.db")
+    if os.path.exists(hnsw_db_path):
+        os.remove(hnsw_db_path)
+    configs = [{ "name": "Test", "dimension": LEN_6, "index": "hnsw", "M": 8, "ef_construction": 64 }]
+    np.random.seed(0)
+    vectors = np.random.randn(3000, LEN_6).astype(np.float32)
+    ids = [str(x) for x in range(3000)]
+
+    def selfRecall(collection, sample_ids):
+        return np.mean([collection.search(collection.get(i), 1)[0] == [i] for i in sample_ids])
+
+    database = VectorDatabase(hnsw_db_path, configs)
+    collection = database.getCollection("Test")
+    collection.addBlock(ids[:2000], vectors[:2000])
+    database.commit()
+
+    # the graph is maintained on modifications, deleted vectors are never returned
+    collection.addBlock(ids[2000:], vectors[2000:])
+    collection.deleteBlock(ids[:1000:2])
+    collection.setBlock(ids[1:1000:2], -vectors[1:1000:2])
+    remaining = ids[1:1000:2] + ids[1000:]
+    assert selfRecall(collection, remaining[::20]) > 0.95
+    assert collection._impl.hnswInfo()["n_nodes"] == 3000 and collection._impl.hnswInfo()["n_deleted"] == 500
+
+    # recall against exhaustive search
+    queries = np.random.randn(20, LEN_6).astype(np.float32)
+    exact = collection.searchBatch(queries, 10, index="flat")[0]
+    approx = collection.searchBatch(queries, 10)[0]
+    assert all(set(a).issubset(remaining) for a in approx)
+    assert np.mean([len(set(a) & set(e)) / 10 for a, e in zip(approx, exact)]) > 0.9
+    database.commit()
+    info = collection._impl.hnswInfo()
+
+    # the graph is saved and restored, not rebuilt
+    database = VectorDatabase(hnsw_db_path, configs)
+    collection = database.getCollection("Test")
+    assert collection._impl.hnswInfo() == info
+    assert collection.searchBatch(queries, 10)[0] == approx
+
+    # rebuilt when the freed nodes outnumber the live ones, and saved smaller
+    collection.deleteBlock(remaining[:2000])
+    database.commit()
+    assert collection._impl.hnswInfo()["n_deleted"] == 0
+    info = collection._impl.hnswInfo()
+    database = VectorDatabase(hnsw_db_path, configs)
+    collection = database.getCollection("Test")
+    assert collection._impl.hnswInfo() == info and info["n_nodes"] == 500
+    assert len(collection.search(queries[0], 10, index="hnsw")[0]) == 10
+    os.remove(hnsw_db_path)
+
+def test_pq():
+    pq_db_path = os.path.join(os.path.dirname(__file__), "test_pq.db")
+    if os.path.exists(pq_db_path):
+        os.remove(pq_db_path)
+    configs = [{ "name": "Test", "dimension": LEN_6, "index": "pq", "n_subspaces": 3 }]
+    np.random.seed(0)
+    vectors = np.random.randn(5000, LEN_6).astype(np.float32)
+    ids = [str(x) for x in range(5000)]
+    queries = np.random.randn(20, LEN_6).astype(np.float32)
+
+    def recall(collection):
+        exact = collection.searchBatch(queries, 10, index="flat")[0]
+        approx = collection.searchBatch(queries, 10)[0]
+        return np.mean([len(set(a) & set(e)) / 10 for a, e in zip(approx, exact)])
+
+    database = VectorDatabase(pq_db_path, configs)
+    collection = database.getCollection("Test")
+    collection.addBlock(ids[:4000], vectors[:4000])
+    collection.trainPQ()
+    assert collection._impl.isPQTrained()
+
+    # the codes are maintained on modifications
+    collection.addBlock(ids[4000:], vectors[4000:])
+    collection.deleteBlock(ids[:1000:2])
+    collection.setBlock(ids[1:1000:2], -vectors[1:1000:2])
+    assert recall(collection) > 0.9
+    # re-ranked scores are exact
+    ids_pq, scores_pq = collection.search(queries[0], 10, index="pq")
+    found = collection.getBlock(ids_pq, as_numpy=True)
+    assert np.allclose(scores_pq, found @ queries[0] / np.linalg.norm(found, axis=1) / np.linalg.norm(queries[0]))
+    database.commit()
+
+    # the index is saved and restored
+    database = VectorDatabase(pq_db_path, configs)
+    collection = database.getCollection("Test")
+    assert collection._impl.isPQTrained()
+    assert collection.search(queries[0], 10)[0] == ids_pq
+
+    # only the codes of the changed rows are written, the codebooks are kept
+    codebooks = database.disk_io.getMeta("pq.Test")
+    collection.setBlock(ids[1000:1010], -vectors[1000:1010])
+    collection.deleteBlock(ids[1010:1020])
+    database.commit()
+    assert database.disk_io.getMeta("pq.Test") == codebooks
+    saved_ids, _ = database.disk_io.getIndexRows(database.disk_io.PQ_TABLE_PREFIX, "Test")
+    assert sorted(saved_ids) == sorted(collection.keys())
+    ids_pq = collection.search(queries[0], 10)[0]
+    database = VectorDatabase(pq_db_path, configs)
+    assert database.getCollection("Test").search(queries[0], 10)[0] == ids_pq
+    os.remove(pq_db_path)
+
+def test_pqStorage(monkeypatch):
+    from tiny_vectordb import getVectorCollectionBackend
+    from tiny_vectordb.diskio import SqliteIO
+    pq_db_path = os.path.join(os.path.dirname(__file__), "test_pq_storage.db")
+    if os.path.exists(pq_db_path):
+        os.remove(pq_db_path)
+    n, dim = 3000, 16
+    configs = [{ "name": "Test", "dimension": dim, "dtype": "pq", "n_subspaces": 8 }]
+    np.random.seed(7)
+    vectors = np.random.randn(n, dim).astype(np.float32)
+    ids = [str(x) for x in range(n)]
+    queries = np.random.randn(10, dim).astype(np.float32)
+    exact = getVectorCollectionBackend('cxx')(None, quite_loading=True, name="Exact", dimension=dim)
+    exact.addBlock(ids, vectors)
+
+    def recall(collection):
+        found_ids, found_scores = collection.searchBatch(queries, 10)
+        for q, found, scores in zip(queries, found_ids, found_scores):
+            # re-ranked with the float32 vectors read from the database
+            found = collection.getBlock(found, as_numpy=True)
+            assert np.allclose(scores, found @ q / np.linalg.norm(found, axis=1) / np.linalg.norm(q), atol=1e-5)
+        return np.mean([len(set(a) & set(e)) / 10 for a, e in zip(found_ids, exact.searchBatch(queries, 10)[0])])
+
+    # the float32 rows are kept until the pq index is trained, then only the codes
+    database = VectorDatabase(pq_db_path, configs)
+    collection = database.getCollection("Test")
+    collection.addBlock(ids, vectors)
+    assert collection._impl.getKeepRows()
+    size = collection.memoryBytes()
+    collection.trainPQ()
+    assert not collection._impl.getKeepRows()
+    assert np.array_equal(collection.getBlock(ids[:10], as_numpy=True), vectors[:10])
+    database.commit()
+    assert collection.memoryBytes() < size / 3
+    assert np.array_equal(collection.getBlock(ids[:10], as_numpy=True), vectors[:10])
+    assert recall(collection) > 0.9
+    with pytest.raises(RuntimeError):
+        collection.trainPQ()
+
+    collection.setBlock(ids[:5], vectors[5:10])
+    collection.deleteBlock(ids[-5:])
+    exact.setBlock(ids[:5], vectors[5:10])
+    exact.deleteBlock(ids[-5:])
+    database.commit()
+
+    # restored from the saved codes, without reading the vectors
+    monkeypatch.setattr(SqliteIO, "iterTableData", None)
+    database = VectorDatabase(pq_db_path, configs)
+    collection = database.getCollection("Test")
+    assert not collection._impl.getKeepRows() and len(collection) == n - 5
+    assert np.array_equal(collection.get(ids[0]), vectors[5])
+    assert recall(collection) > 0.9
+    os.remove(pq_db_path)
+
+def test_attributes():
+    attr_db_path = os.path.join(os.path.dirname(__file__), "test_attr.db")
+    configs = [{ "name": "Test", "dimension": LEN_6 }]
+    np.random.seed(0)
+    vectors = np.random.randn(100, LEN_6).astype(np.float32)
+    ids = [f"t{x % 4}/{x}" for x in range(100)]
+
+    for backend in ["cxx", "numpy"]:
+        os.environ["TVDB_BACKEND"] = backend
+        if os.path.exists(attr_db_path):
+            os.remove(attr_db_path)
+        database = VectorDatabase(attr_db_path, configs)
+        collection = database.getCollection("Test")
+        collection.addBlock(ids, vectors)
+        collection.setAttributes("tenant", ids, [x % 4 for x in range(100)])
+        collection.setAttributes("tag", ids[:10], ["a"] * 10)
+        collection.deleteBlock(ids[:2])
+        collection.setAttributes("tag", ids[2:4], [None, "b"])
+        database.commit()
+
+        database = VectorDatabase(attr_db_path, configs)
+        collection = database.getCollection("Test")
+        assert collection.getAttributes("tenant", ids[2:6]) == [2, 3, 0, 1]
+        assert collection.getAttributes("tag", ids[2:12]) == [None, "b"] + ["a"] * 6 + [None] * 2
+        found = collection.search(vectors[5], 10, filter={"where": {"tenant": 1}, "prefix": "t1/"})[0]
+        assert found[0] == ids[5] and all(id.startswith("t1/") for id in found)
+        # attributes of deleted vectors are not restored
+        collection.addBlock(ids[:1], vectors[:1])
+        assert collection.getAttributes("tenant", ids[:1]) == [None]
+    os.environ.pop("TVDB_BACKEND")
+    os.remove(attr_db_path)
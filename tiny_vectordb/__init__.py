@@ -3,7 +3,7 @@ vecotr related modules.
 vector database and related functions.
 """
 from .wrap import VectorDatabase, CompileConfig, CollectionConfig, getVectorCollectionBackend
-from .vector_collection import VectorCollectionAbstract as VectorCollectionT
+from .vector_collection import VectorCollectionAbstract as VectorCollectionT, SearchFilter
 from .config import cleanup
 from .jit_utils import autoCompileConfig
 from . import jit
@@ -16,6 +16,7 @@ __all__ = [
     "VectorCollectionT",
     "CompileConfig",
     "CollectionConfig",
+    "SearchFilter",
     "autoCompileConfig",
     "cleanup", 
     "jit", 
@@ -0,0 +1,37 @@
+"""
+Command line tools, 
+    python -m tiny_vectordb build [DIM ...] [--out DIR] [--portable] [--no-runtime]
+builds the modules of the dimensions and the runtime-dimension module ahead of time, e.g. when building a container image, 
+set TVDB_PREBUILT_DIR to the output directory to use them without a compiler.
+"""
+import argparse
+from . import jit
+from .jit_utils import autoCompileConfig
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m tiny_vectordb")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="build the modules of the dimensions ahead of time")
+    build_parser.add_argument("dims", nargs="*", type=int, default=jit.AOT_DIMS, 
+                              help=f"dimensions to build, default to {' '.join(map(str, jit.AOT_DIMS))}")
+    build_parser.add_argument("-o", "--out", default=None, 
+                              help="copy the modules into this directory, to be used with TVDB_PREBUILT_DIR")
+    build_parser.add_argument("--portable", action="store_true", 
+                              help="build without -march=native, for machines with other CPUs")
+    build_parser.add_argument("--no-runtime", action="store_true", 
+                              help="do not build the runtime-dimension module, which serves the other dimensions")
+    build_parser.add_argument("-q", "--quite", action="store_true")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        compile_config = autoCompileConfig()
+        if args.portable:
+            compile_config["additional_compile_flags"] = [
+                f for f in compile_config["additional_compile_flags"] if not f.startswith(("-march=", "-mtune="))
+                ]
+        dims = args.dims if args.no_runtime else args.dims + [jit.RUNTIME_DIM]
+        for m_file in jit.build(dims, out_dir=args.out, quite=args.quite, compile_config=compile_config):
+            print(m_file)
+
+if __name__ == "__main__":
+    main()
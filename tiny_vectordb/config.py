@@ -19,6 +19,9 @@ def cleanup():
 
 BUILD_DIR = os.path.join(CACHE_DIR, f"build{VERSION}")
 BIN_DIR = os.path.join(BUILD_DIR, "bin")
+# directories of ahead-of-time built modules (see `python -m tiny_vectordb build`), separated by os.pathsep, 
+# searched before BIN_DIR, so that no compiler is needed for the dimensions built into them
+PREBUILT_DIRS = [_d for _d in os.getenv("TVDB_PREBUILT_DIR", "").split(os.pathsep) if _d]
 for _d in [BUILD_DIR, BIN_DIR]:
     if not os.path.exists(_d):
         os.makedirs(_d, exist_ok=True)
@@ -1,5 +1,8 @@
 import sqlite3
+import base64
 from threading import Lock
+from contextlib import contextmanager
+from typing import Iterator, Any, Optional
 
 def lockRequire(lock):
     def _func(func):
@@ -15,28 +18,196 @@ def lockRequire(lock):
 class SqliteIO:
     _lock = Lock()
 
-    def __init__(self, fpath: str) -> None:
+    # on-disk format version, stored as sqlite user_version
+    # 0: vectors stored as base64 encoded TEXT
+    # 1: vectors stored as BLOB of raw little-endian float32
+    # 2: a quantized BLOB column next to the vector, NULL if not saved (see VectorQuantizedEncode)
+    FORMAT_VERSION = 2
+    # internal key-value table, not a collection
+    META_TABLE = "__tvdb_meta"
+    # internal table of the hnsw graph of a collection, one row per node
+    HNSW_TABLE_PREFIX = "__tvdb_hnsw_"
+    # internal table of the row attributes of a collection, one row per (id, key)
+    ATTRIBUTE_TABLE_PREFIX = "__tvdb_attr_"
+    # internal table of the list of each row of the ivf index of a collection, one row per id
+    IVF_TABLE_PREFIX = "__tvdb_ivf_"
+    # internal table of the codes of each row of the pq index of a collection, one row per id
+    PQ_TABLE_PREFIX = "__tvdb_pq_"
+    # internal table of the ids changed after the segment file of a collection is written, one row per id
+    LOG_TABLE_PREFIX = "__tvdb_log_"
+
+    def __init__(self, fpath: str, log_changes: bool = False) -> None:
+        # log_changes: log the ids changed by every write, so that a segment file can be brought up to date (see getLoggedChanges)
         self.conn = sqlite3.connect(fpath)
         self.cur = self.conn.cursor()
+        self.log_changes = log_changes
+        self.__migrate()
+        self.cur.execute(f"CREATE TABLE IF NOT EXISTS {self.META_TABLE} (key TEXT PRIMARY KEY, value)")
+        self.conn.commit()
+    
+    @property
+    def format_version(self) -> int:
+        return self.cur.execute("PRAGMA user_version").fetchone()[0]
+
+    @lockRequire(_lock)
+    def __migrate(self) -> None:
+        # one-time migration of the tables from older formats, step by step in a single transaction
+        version = self.format_version
+        if version >= self.FORMAT_VERSION:
+            return
+        self.conn.commit()
+        self.cur.execute("BEGIN")
+        try:
+            for name in self.getTableNames():
+                if version < 1:
+                    self.cur.execute(f"ALTER TABLE {name} RENAME TO {name}__base64")
+                    self.cur.execute(f"CREATE TABLE {name} (id TEXT PRIMARY KEY, vector BLOB)")
+                    rows = self.conn.execute(f"SELECT id, vector FROM {name}__base64")
+                    self.cur.executemany(
+                        f"INSERT INTO {name} VALUES (?, ?)", 
+                        ((id, base64.b64decode(enc_vector)) for id, enc_vector in rows)
+                        )
+                    self.cur.execute(f"DROP TABLE {name}__base64")
+                if version < 2:
+                    self.cur.execute(f"ALTER TABLE {name} ADD COLUMN quantized BLOB")
+            self.cur.execute(f"PRAGMA user_version = {self.FORMAT_VERSION}")
+            self.conn.commit()
+        except:
+            self.conn.rollback()
+            raise
     
     @lockRequire(_lock)
     def touchTable(self, name: str) -> None:
-        # create if not exists, save string
-        self.cur.execute(f"CREATE TABLE IF NOT EXISTS {name} (id TEXT PRIMARY KEY, vector TEXT)")
+        # create if not exists, save raw bytes
+        self.cur.execute(f"CREATE TABLE IF NOT EXISTS {name} (id TEXT PRIMARY KEY, vector BLOB, quantized BLOB)")
     
     @lockRequire(_lock)
     def deleteTable(self, name: str) -> None:
         # delete table
         self.cur.execute(f"DROP TABLE {name}")
+        self.cur.execute(f"DROP TABLE IF EXISTS {self.HNSW_TABLE_PREFIX}{name}")
+        self.cur.execute(f"DROP TABLE IF EXISTS {self.ATTRIBUTE_TABLE_PREFIX}{name}")
+        self.cur.execute(f"DROP TABLE IF EXISTS {self.IVF_TABLE_PREFIX}{name}")
+        self.cur.execute(f"DROP TABLE IF EXISTS {self.PQ_TABLE_PREFIX}{name}")
+        self.cur.execute(f"DROP TABLE IF EXISTS {self.LOG_TABLE_PREFIX}{name}")
+        # meta keys of a table are in the form of "<kind>.<table name>"
+        self.cur.execute(f"DELETE FROM {self.META_TABLE} WHERE substr(key, instr(key, '.') + 1) = ?", (name,))
 
     def getTableNames(self) -> list[str]:
-        # get all table names
+        # get all table names, except the internal ones
         ret = self.cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
-        return [i[0] for i in ret]
+        return [i[0] for i in ret if not i[0].startswith("__tvdb")]
+    
+    def getMeta(self, key: str, default: Any = None) -> Any:
+        ret = self.cur.execute(f"SELECT value FROM {self.META_TABLE} WHERE key = ?", (key,)).fetchone()
+        return default if ret is None else ret[0]
+    
+    @lockRequire(_lock)
+    def setMeta(self, key: str, value: Any) -> None:
+        self.cur.execute(f"INSERT OR REPLACE INTO {self.META_TABLE} VALUES (?, ?)", (key, value))
+    
+    def getGeneration(self, name: str) -> int:
+        # the generation of a table is increased on every write, 
+        # to tell whether a snapshot of the table (e.g. a segment file) is up to date
+        return self.getMeta(f"generation.{name}", 0)
+    
+    def __bumpGeneration(self, name: str, ids: list[str]) -> None:
+        # should be called with the lock held, in the same transaction as the write, 
+        # the changed ids are logged if logging and the log is complete up to the previous generation
+        self.cur.execute(
+            f"INSERT INTO {self.META_TABLE} VALUES (?, 1) ON CONFLICT(key) DO UPDATE SET value = value + 1", 
+            (f"generation.{name}",)
+            )
+        if not self.log_changes:
+            return
+        generation = self.getGeneration(name)
+        if self.getMeta(f"logged.{name}") != generation - 1:
+            return
+        self.cur.executemany(
+            f"INSERT OR REPLACE INTO {self.LOG_TABLE_PREFIX}{name} VALUES (?, ?)", ((id, generation) for id in ids)
+            )
+        self.cur.execute(f"INSERT OR REPLACE INTO {self.META_TABLE} VALUES (?, ?)", (f"logged.{name}", generation))
+    
+    @lockRequire(_lock)
+    def resetLog(self, name: str, generation: int) -> None:
+        # start the log after a snapshot of the table at the generation, the ids logged up to it are dropped, 
+        # meta "log.<name>" and "logged.<name>" are the generations after which and up to which the log is complete
+        self.cur.execute(f"CREATE TABLE IF NOT EXISTS {self.LOG_TABLE_PREFIX}{name} (id TEXT PRIMARY KEY, generation INTEGER)")
+        start, logged = self.getMeta(f"log.{name}"), self.getMeta(f"logged.{name}")
+        if start is None or logged is None or logged < generation:
+            # nothing is logged after the generation
+            start = logged = generation
+        else:
+            # the log may be reset by another process with a newer snapshot
+            start = max(start, generation)
+        self.cur.execute(f"DELETE FROM {self.LOG_TABLE_PREFIX}{name} WHERE generation <= ?", (start,))
+        self.cur.executemany(
+            f"INSERT OR REPLACE INTO {self.META_TABLE} VALUES (?, ?)", ((f"log.{name}", start), (f"logged.{name}", logged))
+            )
+    
+    def isLogged(self, name: str, since: int) -> bool:
+        # whether all changes after a snapshot of the table at the generation are in the log
+        start, logged = self.getMeta(f"log.{name}"), self.getMeta(f"logged.{name}")
+        return start is not None and logged == self.getGeneration(name) and start <= since <= logged
+    
+    def getLoggedChanges(self, name: str, since: int) -> Optional[tuple[list[str], list[bytes], list[str]]]:
+        # the changes after a snapshot of the table at the generation, as (ids, vectors, deleted ids) of the current table, 
+        # or None if the log does not cover them
+        if not self.isLogged(name, since):
+            return None
+        ids, enc_vectors, deleted = [], [], []
+        for id, enc_vector in self.cur.execute(
+            f"SELECT l.id, t.vector FROM {self.LOG_TABLE_PREFIX}{name} AS l LEFT JOIN {name} AS t ON l.id = t.id "
+            "WHERE l.generation > ?", (since,)
+            ):
+            if enc_vector is None:
+                deleted.append(id)
+            else:
+                ids.append(id)
+                enc_vectors.append(enc_vector)
+        return ids, enc_vectors, deleted
     
-    def getTableData(self, name: str) -> tuple[list[str], list[str]]:
+    def countLog(self, name: str) -> int:
+        # number of ids in the log
+        if not self.hasTable(f"{self.LOG_TABLE_PREFIX}{name}"):
+            return 0
+        return self.cur.execute(f"SELECT COUNT(*) FROM {self.LOG_TABLE_PREFIX}{name}").fetchone()[0]
+    
+    def countTable(self, name: str) -> int:
+        # number of rows in table
+        return self.cur.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0]
+    
+    def iterTableData(self, name: str, chunk_size: int = 65536, quantized: bool = False) -> Iterator[tuple[list[str], list[bytes]]]:
+        # iterate data in table by chunks of at most chunk_size rows, 
+        # with a separate cursor so that only one chunk is held in memory at a time, 
+        # quantized: the quantized BLOBs instead of the vectors, empty if not saved
+        column = "COALESCE(quantized, x'')" if quantized else "vector"
+        cur = self.conn.cursor()
+        try:
+            cur.execute(f"SELECT id, {column} FROM {name}")
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                ids, enc_vectors = zip(*rows)
+                del rows
+                yield list(ids), list(enc_vectors)
+        finally:
+            cur.close()
+
+    def getVectors(self, name: str, ids: list[str], chunk_size: int = 512) -> list[Optional[bytes]]:
+        # the vectors of the ids, None if not exists
+        found: dict[str, bytes] = {}
+        for i in range(0, len(ids), chunk_size):
+            chunk = ids[i: i + chunk_size]
+            found.update(self.cur.execute(
+                f"SELECT id, vector FROM {name} WHERE id IN ({', '.join('?' * len(chunk))})", chunk
+                ).fetchall())
+        return [found.get(id) for id in ids]
+
+    def getTableData(self, name: str) -> tuple[list[str], list[bytes]]:
         # get all data in table
-        res = self.cur.execute(f"SELECT * FROM {name}")
+        res = self.cur.execute(f"SELECT id, vector FROM {name}")
         ret = ([], [])
         for i in res:
             ret[0].append(i[0])
@@ -44,20 +215,140 @@ class SqliteIO:
         return ret
 
     @lockRequire(_lock)
-    def insetToTable(self, name: str, id: str, enc_vector: str) -> None:
-        # insert one row to table, make sure id not exists
-        self.cur.execute(f"INSERT INTO {name} VALUES (?, ?)", (id, enc_vector))
+    def insertBulk(self, name: str, ids: list[str], enc_vectors: list[bytes]) -> None:
+        # insert rows to table, make sure ids not exist
+        if not ids: return
+        self.cur.executemany(f"INSERT INTO {name} (id, vector) VALUES (?, ?)", zip(ids, enc_vectors))
+        self.__bumpGeneration(name, ids)
+    
+    @lockRequire(_lock)
+    def upsertBulk(self, name: str, ids: list[str], enc_vectors: list[bytes]) -> None:
+        # insert rows to table, or update the vector if id exists, the quantized BLOB of the old vector is dropped
+        if not ids: return
+        self.cur.executemany(
+            f"INSERT INTO {name} (id, vector) VALUES (?, ?) ON CONFLICT(id) DO UPDATE SET vector = excluded.vector, quantized = NULL", 
+            zip(ids, enc_vectors)
+            )
+        self.__bumpGeneration(name, ids)
+    
+    @lockRequire(_lock)
+    def setQuantized(self, name: str, ids: list[str], blobs: list[bytes]) -> None:
+        # save the quantized BLOBs of existing rows, derived from the vectors, so the generation is not increased
+        if not ids: return
+        self.cur.executemany(f"UPDATE {name} SET quantized = ? WHERE id = ?", zip(blobs, ids))
+    
+    @lockRequire(_lock)
+    def deleteBulk(self, name: str, ids: list[str]) -> None:
+        # delete rows from table
+        if not ids: return
+        self.cur.executemany(f"DELETE FROM {name} WHERE id = ?", ((id,) for id in ids))
+        self.__bumpGeneration(name, ids)
+    
+    @lockRequire(_lock)
+    def touchHNSWTable(self, name: str) -> None:
+        # links are raw int32 bytes, id is NULL for freed nodes
+        self.cur.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.HNSW_TABLE_PREFIX}{name} "
+            "(node INTEGER PRIMARY KEY, id TEXT, level INTEGER, links BLOB)"
+            )
     
     @lockRequire(_lock)
-    def updateTable(self, name: str, id: str, enc_vector: str) -> None:
-        # update one row to table, make sure id exists
-        self.cur.execute(f"UPDATE {name} SET vector = ? WHERE id = ?", (enc_vector, id))
+    def clearHNSWTable(self, name: str) -> None:
+        self.cur.execute(f"DELETE FROM {self.HNSW_TABLE_PREFIX}{name}")
     
     @lockRequire(_lock)
-    def deleteFromTable(self, name: str, id: str) -> None:
-        # delete one row from table, make sure id exists
-        self.cur.execute(f"DELETE FROM {name} WHERE id = ?", (id,))
+    def upsertHNSWNodes(self, name: str, nodes: list[tuple[int, Optional[str], int, bytes]]) -> None:
+        # insert or replace nodes of the hnsw graph, as (node, id, level, links)
+        if not nodes: return
+        self.cur.executemany(f"INSERT OR REPLACE INTO {self.HNSW_TABLE_PREFIX}{name} (node, id, level, links) VALUES (?, ?, ?, ?)", nodes)
     
+    @lockRequire(_lock)
+    def truncateHNSWTable(self, name: str, n_nodes: int) -> None:
+        # drop the nodes beyond the graph, after it is rebuilt smaller
+        self.cur.execute(f"DELETE FROM {self.HNSW_TABLE_PREFIX}{name} WHERE node >= ?", (n_nodes,))
+    
+    def getHNSWNodes(self, name: str) -> list[tuple[int, Optional[str], int, bytes]]:
+        # all nodes of the hnsw graph, sorted by node
+        return self.cur.execute(
+            f"SELECT node, id, level, links FROM {self.HNSW_TABLE_PREFIX}{name} ORDER BY node"
+            ).fetchall()
+    
+    @lockRequire(_lock)
+    def touchIndexRowTable(self, prefix: str, name: str) -> None:
+        # per-row data of an index (the ivf list or the pq codes), keyed by id, so that only the changed rows are written
+        self.cur.execute(f"CREATE TABLE IF NOT EXISTS {prefix}{name} (id TEXT PRIMARY KEY, value)")
+    
+    @lockRequire(_lock)
+    def clearIndexRows(self, prefix: str, name: str) -> None:
+        self.cur.execute(f"DROP TABLE IF EXISTS {prefix}{name}")
+    
+    @lockRequire(_lock)
+    def upsertIndexRows(self, prefix: str, name: str, ids: list[str], values: list[Any]) -> None:
+        if not ids: return
+        self.cur.executemany(f"INSERT OR REPLACE INTO {prefix}{name} VALUES (?, ?)", zip(ids, values))
+    
+    @lockRequire(_lock)
+    def deleteIndexRows(self, prefix: str, name: str, ids: list[str]) -> None:
+        if not ids: return
+        self.cur.executemany(f"DELETE FROM {prefix}{name} WHERE id = ?", ((id,) for id in ids))
+    
+    def getIndexRows(self, prefix: str, name: str) -> tuple[list[str], list[Any]]:
+        # all rows of the index, as (ids, values)
+        if not self.hasTable(f"{prefix}{name}"):
+            return [], []
+        rows = self.cur.execute(f"SELECT id, value FROM {prefix}{name}").fetchall()
+        return [r[0] for r in rows], [r[1] for r in rows]
+    
+    def hasTable(self, name: str) -> bool:
+        return self.cur.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name = ?", (name,)).fetchone() is not None
+    
+    @lockRequire(_lock)
+    def upsertAttributes(self, name: str, rows: list[tuple[str, str, Any]]) -> None:
+        # set attributes as (id, key, value), a None value removes the attribute
+        if not rows: return
+        table = f"{self.ATTRIBUTE_TABLE_PREFIX}{name}"
+        self.cur.execute(f"CREATE TABLE IF NOT EXISTS {table} (id TEXT, key TEXT, value, PRIMARY KEY (id, key))")
+        self.cur.executemany(f"DELETE FROM {table} WHERE id = ? AND key = ?", ((id, key) for id, key, value in rows if value is None))
+        self.cur.executemany(f"INSERT OR REPLACE INTO {table} VALUES (?, ?, ?)", (row for row in rows if row[2] is not None))
+    
+    @lockRequire(_lock)
+    def deleteAttributes(self, name: str, ids: list[str]) -> None:
+        # remove all attributes of the ids
+        if not ids or not self.hasTable(f"{self.ATTRIBUTE_TABLE_PREFIX}{name}"): return
+        self.cur.executemany(f"DELETE FROM {self.ATTRIBUTE_TABLE_PREFIX}{name} WHERE id = ?", ((id,) for id in ids))
+    
+    def getAttributes(self, name: str) -> dict[str, tuple[list[str], list[Any]]]:
+        # all attributes of the table, as {key: (ids, values)}
+        ret: dict[str, tuple[list[str], list[Any]]] = {}
+        if not self.hasTable(f"{self.ATTRIBUTE_TABLE_PREFIX}{name}"):
+            return ret
+        for id, key, value in self.cur.execute(f"SELECT id, key, value FROM {self.ATTRIBUTE_TABLE_PREFIX}{name}"):
+            ids, values = ret.setdefault(key, ([], []))
+            ids.append(id)
+            values.append(value)
+        return ret
+    
+    @lockRequire(_lock)
+    def begin(self) -> None:
+        # start an explicit transaction, unless one is already open
+        if not self.conn.in_transaction:
+            self.cur.execute("BEGIN")
+    
+    @lockRequire(_lock)
+    def rollback(self) -> None:
+        self.conn.rollback()
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        # all writes in the block are committed at once, or rolled back on error
+        self.begin()
+        try:
+            yield
+            self.commit()
+        except:
+            self.rollback()
+            raise
+
     @lockRequire(_lock)
     def commit(self):
         self.conn.commit()
\ No newline at end of file
@@ -1,5 +1,7 @@
 #pragma once
 
+// the dimension of the vectors, fixed at compile time so that Eigen can unroll and vectorize over it, 
+// or Eigen::Dynamic (-1) for the runtime-dimension module, where each collection is given its dimension
 #ifndef FEAT_DIM
 #define FEAT_DIM 768
 #endif
@@ -30,8 +32,18 @@ static_assert(sizeof(num_t) == 4, "num_t must be 32bit");
 
 typedef Eigen::Matrix<num_t, Eigen::Dynamic, FEAT_DIM, Eigen::RowMajor> 
 MatrixF;
+// read-only views, to pass the occupied rows of a pre-allocated chunk without copying
+typedef Eigen::Ref<const MatrixF> MatrixFCRef;
+typedef Eigen::Ref<const Eigen::Matrix<num_t, 1, FEAT_DIM>> RowFCRef;
+typedef Eigen::Ref<const Eigen::Vector<float, Eigen::Dynamic>> VectorFCRef;
 typedef std::vector<std::string> StringVector;
 
+// the dimension of a collection, a compile-time constant in the fixed-dimension modules, 
+// so that the loops over it can still be unrolled there
+inline int featDim(int dim){
+    return FEAT_DIM == Eigen::Dynamic ? dim : FEAT_DIM;
+}
+
 
 // Modification update logic, markov chain
 /*
@@ -0,0 +1,438 @@
+#pragma once
+#include "common.h"
+#include <algorithm>
+#include <cmath>
+#include <cstdint>
+#include <functional>
+#include <queue>
+#include <random>
+#include <unordered_set>
+
+/*
+Hierarchical navigable small world (HNSW) graph index for approximate cosine similarity search.
+Each row of the collection is a node of the graph, the vectors are read from the collection (see HNSWSpace), 
+so the index only keeps the links.
+An updated row keeps its node, which is re-linked in place; 
+a deleted row frees its node, whose neighbours are re-linked to each other, and the slot is reused by the next added row.
+Nodes are mapped to the rows of the collection, which must report every row it adds, moves or removes.
+*/
+
+// the rows of the collection and their norms, passed to every call that reads the vectors
+struct HNSWSpace{
+    Eigen::Map<const MatrixF> rows;
+    Eigen::Map<const Eigen::Vector<float, Eigen::Dynamic>> norms;
+    // the approximate vector of a row, read instead of rows if the collection does not keep the float32 rows
+    std::function<Eigen::Matrix<num_t, 1, FEAT_DIM>(int)> decode;
+
+    Eigen::Matrix<num_t, 1, FEAT_DIM> vector(int row) const {
+        return decode ? decode(row) : rows.row(row);
+    }
+    float dot(int row, const Eigen::Matrix<num_t, 1, FEAT_DIM>& q) const {
+        return decode ? decode(row).dot(q) : rows.row(row).dot(q);
+    }
+    float dot(int a, int b) const {
+        return decode ? decode(a).dot(decode(b)) : rows.row(a).dot(rows.row(b));
+    }
+};
+
+class HNSWIndex{
+public:
+    HNSWIndex(int M = 16, int ef_construction = 200):
+        M(M), M0(2 * M), ef_construction(ef_construction), level_mult(1.0 / std::log(std::max(M, 2))), rng(0) {
+        if (M < 2){
+            throw std::runtime_error("M should be at least 2");
+        }
+    }
+
+    int getM() const { return M; }
+    int getEfConstruction() const { return ef_construction; }
+    int getEntry() const { return entry; }
+    int getMaxLevel() const { return max_level; }
+    int nNodes() const { return node_level.size(); }
+    // freed nodes that are not reused yet
+    int nDeleted() const { return free_nodes.size(); }
+    int nodeRow(int node) const { return node_row[node]; }
+    int nodeLevel(int node) const { return node_level[node]; }
+    const std::vector<int>& nodeLinks(int node, int level) const { return links[node][level]; }
+    // bytes of the links and the node maps
+    size_t nbytes() const {
+        size_t ret = (size_t)nNodes() * 2 * sizeof(int) + row_node.size() * sizeof(int);
+        for (const auto& node_links : links){
+            for (const auto& l : node_links){
+                ret += l.size() * sizeof(int);
+            }
+        }
+        return ret;
+    }
+
+    // nodes that are changed since the last call, for incremental saving
+    std::vector<int> takeDirtyNodes(){
+        std::vector<int> ret(dirty.begin(), dirty.end());
+        dirty.clear();
+        return ret;
+    }
+
+    // a row is appended to the collection, its vector should already be in the space
+    void addRow(int row, const HNSWSpace& space){
+        if (row != (int)row_node.size()){
+            throw std::runtime_error("rows should be added in order");
+        }
+        const int level = randomLevel();
+        int node;
+        if (free_nodes.empty()){
+            node = nNodes();
+            node_level.push_back(level);
+            node_row.push_back(row);
+            links.emplace_back(level + 1);
+        }
+        else{
+            node = free_nodes.back();
+            free_nodes.pop_back();
+            node_level[node] = level;
+            node_row[node] = row;
+            links[node].assign(level + 1, std::vector<int>());
+        }
+        row_node.push_back(node);
+        dirty.insert(node);
+        linkNode(node, space);
+        if (level > max_level){
+            max_level = level;
+            entry = node;
+        }
+    }
+
+    // the vector of a row is changed in the space, the node is re-linked at its new position
+    void updateRow(int row, const HNSWSpace& space){
+        const int node = row_node[row];
+        linkNode(node, space);
+        dirty.insert(node);
+    }
+
+    // the row is removed from the collection, and the last row is moved to its position, 
+    // called before the rows are moved in the space
+    void swapRemoveRow(int row, const HNSWSpace& space){
+        const int last = row_node.size() - 1;
+        const int node = row_node[row];
+        unlinkNode(node, space);
+        node_row[node] = -1;
+        free_nodes.push_back(node);
+        dirty.insert(node);
+        if (row != last){
+            row_node[row] = row_node[last];
+            node_row[row_node[row]] = row;
+        }
+        row_node.pop_back();
+        if (node == entry){
+            resetEntry();
+        }
+    }
+
+    /*
+    restore a node of a saved graph, nodes should be restored in order,
+    row is -1 for freed nodes, links are in the form of [n_0, links_0..., n_1, links_1..., ...] for each level
+    */
+    void restoreNode(int node, int row, int level, const std::vector<int>& flat_links){
+        if (node != nNodes()){
+            throw std::runtime_error("nodes should be restored in order");
+        }
+        node_level.push_back(level);
+        node_row.push_back(row);
+        links.emplace_back(level + 1);
+        size_t pos = 0;
+        for (int l = 0; l <= level; l++){
+            if (pos >= flat_links.size() || pos + 1 + flat_links[pos] > flat_links.size()){
+                throw std::runtime_error("invalid links of node " + std::to_string(node));
+            }
+            links[node][l].assign(flat_links.begin() + pos + 1, flat_links.begin() + pos + 1 + flat_links[pos]);
+            pos += 1 + flat_links[pos];
+        }
+        if (row < 0){
+            free_nodes.push_back(node);
+        }
+    }
+
+    // finish restoring: set the entry point and map rows to nodes, every row should have a node
+    void finishRestore(int entry_, int max_level_, int n_rows){
+        entry = entry_;
+        max_level = max_level_;
+        if (entry >= nNodes() || (entry >= 0 && node_row[entry] < 0)){
+            throw std::runtime_error("invalid entry node " + std::to_string(entry));
+        }
+        row_node.assign(n_rows, -1);
+        for (int node = 0; node < nNodes(); node++){
+            for (int l = 0; l <= node_level[node]; l++){
+                for (int n : links[node][l]){
+                    if (n < 0 || n >= nNodes()){
+                        throw std::runtime_error("invalid link to node " + std::to_string(n));
+                    }
+                }
+            }
+            if (node_row[node] >= n_rows){
+                throw std::runtime_error("invalid row of node " + std::to_string(node));
+            }
+            if (node_row[node] >= 0){
+                row_node[node_row[node]] = node;
+            }
+        }
+        for (int row = 0; row < n_rows; row++){
+            if (row_node[row] < 0){
+                throw std::runtime_error("row " + std::to_string(row) + " is not in the graph");
+            }
+        }
+    }
+
+    // flatten the links of a node, see restoreNode
+    std::vector<int> flatLinks(int node) const {
+        std::vector<int> ret;
+        for (int l = 0; l <= node_level[node]; l++){
+            ret.push_back(links[node][l].size());
+            ret.insert(ret.end(), links[node][l].begin(), links[node][l].end());
+        }
+        return ret;
+    }
+
+    /*
+    query: (feat_dim, )
+    return the top-k (score, row) pairs found with a beam of width ef,
+    sorted with the larger score the first, 
+    only the rows with a non-zero mask are returned if mask is given, 
+    the filtered out nodes are traversed but do not take the places in the beam
+    */
+    template <typename NumT>
+    std::vector<std::pair<float, int>> search(
+        const Eigen::Vector<NumT, FEAT_DIM>& query, int k, int ef, const HNSWSpace& space, const uint8_t* mask = nullptr
+        ) const {
+        std::vector<std::pair<float, int>> ret;
+        if (entry < 0 || k <= 0){
+            return ret;
+        }
+        Eigen::Matrix<num_t, 1, FEAT_DIM> q = query.transpose().normalized();
+        int ep = greedyDescend(q, entry, max_level, 0, space);
+        std::vector<std::pair<float, int>> found = searchLayer(q, ep, std::max(ef, k), 0, space, -1, mask);
+        for (auto& p : found){
+            ret.push_back(std::make_pair(p.first, node_row[p.second]));
+            if (ret.size() == k) break;
+        }
+        return ret;
+    }
+
+private:
+    int M;
+    int M0;                 // maximum number of links at level 0
+    int ef_construction;
+    double level_mult;
+    std::mt19937 rng;
+
+    int entry = -1;
+    int max_level = -1;
+
+    std::vector<int> node_level;
+    std::vector<int> node_row;      // -1 if freed
+    std::vector<int> row_node;
+    std::vector<int> free_nodes;
+    // links[node][level], links to freed (or reused) nodes are skipped, and dropped when the list is pruned
+    std::vector<std::vector<std::vector<int>>> links;
+    std::unordered_set<int> dirty;
+
+    int randomLevel(){
+        std::uniform_real_distribution<double> uniform(0.0, 1.0);
+        return (int)(-std::log(std::max(uniform(rng), 1e-12)) * level_mult);
+    }
+
+    int maxLinks(int level) const { return level == 0 ? M0 : M; }
+    bool live(int node) const { return node_row[node] >= 0; }
+    // a link at a level is followed only to a live node of that level, as the slot of a freed node may be reused
+    bool linked(int node, int level) const { return live(node) && node_level[node] >= level; }
+
+    // the normalized vector of a node
+    Eigen::Matrix<num_t, 1, FEAT_DIM> nodeVector(int node, const HNSWSpace& space) const {
+        const int row = node_row[node];
+        const float norm = space.norms[row];
+        return norm > 0 ? (space.vector(row) / norm).eval() : space.vector(row);
+    }
+
+    float similarity(const Eigen::Matrix<num_t, 1, FEAT_DIM>& q, int node, const HNSWSpace& space) const {
+        const int row = node_row[node];
+        const float norm = space.norms[row];
+        return norm > 0 ? space.dot(row, q) / norm : 0.0f;
+    }
+
+    float similarity(int a, int b, const HNSWSpace& space) const {
+        const int ra = node_row[a], rb = node_row[b];
+        const float norm = space.norms[ra] * space.norms[rb];
+        return norm > 0 ? space.dot(ra, rb) / norm : 0.0f;
+    }
+
+    // the live node with the highest level becomes the entry, after the entry is freed
+    void resetEntry(){
+        entry = -1;
+        max_level = -1;
+        for (int node = 0; node < nNodes(); node++){
+            if (live(node) && node_level[node] > max_level){
+                entry = node;
+                max_level = node_level[node];
+            }
+        }
+    }
+
+    // skip: a node that is not moved to, i.e. the one being linked
+    int greedyDescend(
+        const Eigen::Matrix<num_t, 1, FEAT_DIM>& q, int ep, int from_level, int to_level, const HNSWSpace& space, int skip = -1
+        ) const {
+        float best = similarity(q, ep, space);
+        for (int l = from_level; l > to_level; l--){
+            bool changed = true;
+            while (changed){
+                changed = false;
+                for (int n : links[ep][l]){
+                    if (n == skip || !linked(n, l)) continue;
+                    float s = similarity(q, n, space);
+                    if (s > best){
+                        best = s;
+                        ep = n;
+                        changed = true;
+                    }
+                }
+            }
+        }
+        return ep;
+    }
+
+    /*
+    beam search in a level, return (similarity, node) pairs sorted with the larger similarity the first,
+    the skipped node is traversed but not returned, 
+    if mask is given, the beam keeps only the nodes of the rows with a non-zero mask, 
+    and the search goes on through the other nodes until it is filled or the level is exhausted
+    */
+    std::vector<std::pair<float, int>> searchLayer(
+        const Eigen::Matrix<num_t, 1, FEAT_DIM>& q, int ep, int ef, int level, const HNSWSpace& space, 
+        int skip = -1, const uint8_t* mask = nullptr
+        ) const {
+        typedef std::pair<float, int> Item;
+        auto accepted = [&](int node){ return node != skip && (!mask || mask[node_row[node]]); };
+        std::vector<bool> visited(nNodes(), false);
+        // candidates: the most similar on top; results: the least similar on top
+        std::priority_queue<Item> candidates;
+        std::priority_queue<Item, std::vector<Item>, std::greater<Item>> results;
+        float s = similarity(q, ep, space);
+        visited[ep] = true;
+        candidates.emplace(s, ep);
+        if (accepted(ep)){
+            results.emplace(s, ep);
+        }
+        while (!candidates.empty()){
+            Item c = candidates.top();
+            if (results.size() >= ef && c.first < results.top().first){
+                break;
+            }
+            candidates.pop();
+            for (int n : links[c.second][level]){
+                if (visited[n]) continue;
+                visited[n] = true;
+                if (!linked(n, level)) continue;
+                s = similarity(q, n, space);
+                if (results.size() < ef || s > results.top().first){
+                    candidates.emplace(s, n);
+                    if (accepted(n)){
+                        results.emplace(s, n);
+                        if (results.size() > ef) results.pop();
+                    }
+                }
+            }
+        }
+        std::vector<Item> ret(results.size());
+        for (int i = ret.size() - 1; i >= 0; i--){
+            ret[i] = results.top();
+            results.pop();
+        }
+        return ret;
+    }
+
+    // the heuristic of the HNSW paper: keep a candidate only if it is closer to the base than to the kept ones,
+    // candidates should be sorted with the larger similarity the first
+    std::vector<int> selectNeighbors(const std::vector<std::pair<float, int>>& candidates, int max_links, const HNSWSpace& space) const {
+        std::vector<int> ret;
+        for (auto& c : candidates){
+            bool keep = true;
+            for (int r : ret){
+                if (similarity(c.second, r, space) > c.first){
+                    keep = false;
+                    break;
+                }
+            }
+            if (keep){
+                ret.push_back(c.second);
+                if (ret.size() >= max_links) break;
+            }
+        }
+        return ret;
+    }
+
+    // re-select the links of node n at a level from the given nodes, the freed ones and n itself are dropped
+    void pruneLinks(int n, int level, const std::vector<int>& nodes, const HNSWSpace& space){
+        std::vector<std::pair<float, int>> n_candidates;
+        std::unordered_set<int> seen;
+        for (int m : nodes){
+            if (m != n && linked(m, level) && seen.insert(m).second){
+                n_candidates.emplace_back(similarity(n, m, space), m);
+            }
+        }
+        std::sort(n_candidates.begin(), n_candidates.end(), std::greater<std::pair<float, int>>());
+        links[n][level] = selectNeighbors(n_candidates, maxLinks(level), space);
+        dirty.insert(n);
+    }
+
+    // (re-)select the links of a node from a search of the graph, and link the neighbours back to it
+    void linkNode(int node, const HNSWSpace& space){
+        const int level = node_level[node];
+        int ep = entry;
+        if (ep == node){
+            // the entry is re-linked, start from any other live node
+            ep = -1;
+            for (int n = 0; n < nNodes() && ep < 0; n++){
+                if (n != node && live(n)) ep = n;
+            }
+        }
+        if (ep < 0){
+            return;
+        }
+        const Eigen::Matrix<num_t, 1, FEAT_DIM> q = nodeVector(node, space);
+        const int ep_level = std::min(max_level, node_level[ep]);
+        ep = greedyDescend(q, ep, ep_level, level, space, node);
+        for (int l = std::min(level, ep_level); l >= 0; l--){
+            std::vector<std::pair<float, int>> found = searchLayer(q, ep, ef_construction, l, space, node);
+            links[node][l] = selectNeighbors(found, M, space);
+            for (int n : links[node][l]){
+                std::vector<int>& n_links = links[n][l];
+                if (std::find(n_links.begin(), n_links.end(), node) != n_links.end()){
+                    continue;
+                }
+                n_links.push_back(node);
+                if (n_links.size() > maxLinks(l)){
+                    pruneLinks(n, l, std::vector<int>(n_links), space);
+                }
+                dirty.insert(n);
+            }
+            if (!found.empty()){
+                ep = found[0].second;
+            }
+        }
+    }
+
+    // drop the links to a node that is about to be freed, its neighbours are re-linked among its other neighbours
+    void unlinkNode(int node, const HNSWSpace& space){
+        for (int l = 0; l <= node_level[node]; l++){
+            const std::vector<int> neighbours = links[node][l];
+            for (int n : neighbours){
+                if (n == node || !linked(n, l)){
+                    continue;
+                }
+                std::vector<int> n_links = links[n][l];
+                n_links.insert(n_links.end(), neighbours.begin(), neighbours.end());
+                n_links.erase(std::remove(n_links.begin(), n_links.end(), node), n_links.end());
+                pruneLinks(n, l, n_links, space);
+            }
+            links[node][l].clear();
+        }
+    }
+};
@@ -0,0 +1,210 @@
+#pragma once
+#include "common.h"
+#include "searchAlgorithm.hpp"
+#include "threadPool.hpp"
+#include <random>
+#include <numeric>
+
+/*
+Inverted-file (IVF) index for approximate cosine similarity search.
+The rows of a collection are assigned to the nearest of n_lists centroids (spherical k-means),
+a search only scores the rows in the nprobe lists whose centroids are the most similar to the query.
+The index only keeps row indexes, the vectors stay in the collection,
+so the collection must report every row it adds, moves or removes.
+*/
+class IVFIndex{
+public:
+    // maximum number of rows per list used for training, the rest are only assigned
+    static const int MAX_SAMPLES_PER_LIST = 64;
+
+    bool trained() const { return centroids.rows() > 0; }
+    int nLists() const { return centroids.rows(); }
+    const MatrixF& getCentroids() const { return centroids; }
+    const std::vector<int>& getRowLists() const { return row_list; }
+    // bytes of the centroids and the lists
+    size_t nbytes() const {
+        return centroids.size() * sizeof(num_t) + 3 * row_list.size() * sizeof(int);
+    }
+
+    void clear(){
+        centroids.resize(0, centroids.cols());
+        lists.clear();
+        row_list.clear();
+        row_pos.clear();
+    }
+
+    // train the centroids on (a sample of) the rows of data, then assign all rows
+    void train(const MatrixFCRef& data, int n_lists, int n_iter, int n_threads){
+        const int n_rows = data.rows();
+        if (n_lists < 1 || n_lists > n_rows){
+            throw std::runtime_error("number of lists should be in [1, " + std::to_string(n_rows) + "]");
+        }
+        std::mt19937 rng(0);
+        std::vector<int> perm(n_rows);
+        std::iota(perm.begin(), perm.end(), 0);
+        std::shuffle(perm.begin(), perm.end(), rng);
+        const int n_samples = std::min(n_rows, n_lists * MAX_SAMPLES_PER_LIST);
+
+        // normalized samples, the centroids are initialized with the first n_lists of them
+        MatrixF samples(n_samples, data.cols());
+        for (int i = 0; i < n_samples; i++){
+            samples.row(i) = data.row(perm[i]).normalized();
+        }
+        centroids = samples.topRows(n_lists);
+
+        std::vector<int> sample_lists;
+        for (int it = 0; it < n_iter; it++){
+            sample_lists = assignBulk(samples, n_threads);
+            MatrixF sums = MatrixF::Zero(n_lists, data.cols());
+            std::vector<int> counts(n_lists, 0);
+            for (int i = 0; i < n_samples; i++){
+                sums.row(sample_lists[i]) += samples.row(i);
+                counts[sample_lists[i]]++;
+            }
+            for (int l = 0; l < n_lists; l++){
+                if (counts[l] == 0){
+                    // re-seed empty lists with a random sample
+                    centroids.row(l) = samples.row(rng() % n_samples);
+                    continue;
+                }
+                centroids.row(l) = sums.row(l).normalized();
+            }
+        }
+        resetLists(assignBulk(data, n_threads));
+    }
+
+    // set the centroids and the list of each row, e.g. when loading a saved index
+    void load(const MatrixFCRef& centroids_, const std::vector<int>& row_lists){
+        centroids = centroids_;
+        for (int l : row_lists){
+            if (l < 0 || l >= centroids.rows()){
+                throw std::runtime_error("invalid list index: " + std::to_string(l));
+            }
+        }
+        resetLists(row_lists);
+    }
+
+    // nearest list of each row, rows don't need to be normalized as only the order matters
+    std::vector<int> assignBulk(const MatrixFCRef& vectors, int n_threads) const {
+        const int n_rows = vectors.rows();
+        std::vector<int> ret(n_rows);
+        const int n_blocks = (n_rows + SearchAlgorithm::SCORE_BLOCK_ROWS - 1) / SearchAlgorithm::SCORE_BLOCK_ROWS;
+        n_threads = std::max(1, std::min(n_threads, n_blocks));
+        ThreadPool::instance().parallelFor(n_threads, [&](int t){
+            Eigen::Matrix<float, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor> scores;
+            for (int blk = t; blk < n_blocks; blk += n_threads){
+                const int start = blk * SearchAlgorithm::SCORE_BLOCK_ROWS;
+                const int len = std::min(SearchAlgorithm::SCORE_BLOCK_ROWS, n_rows - start);
+                scores.noalias() = vectors.middleRows(start, len) * centroids.transpose();
+                for (int i = 0; i < len; i++){
+                    scores.row(i).maxCoeff(&ret[start + i]);
+                }
+            }
+        });
+        return ret;
+    }
+
+    int assign(const RowFCRef& vec) const {
+        int ret;
+        Eigen::Vector<float, Eigen::Dynamic> scores = centroids * vec.transpose();
+        scores.maxCoeff(&ret);
+        return ret;
+    }
+
+    // a row is appended to the collection
+    void add(int row, int list){
+        if (row != (int)row_list.size()){
+            throw std::runtime_error("rows should be added in order");
+        }
+        row_list.push_back(list);
+        row_pos.push_back(lists[list].size());
+        lists[list].push_back(row);
+    }
+
+    // the vector of a row is changed
+    void reassign(int row, int list){
+        if (row_list[row] == list){
+            return;
+        }
+        detach(row);
+        row_list[row] = list;
+        row_pos[row] = lists[list].size();
+        lists[list].push_back(row);
+    }
+
+    // the row is removed from the collection, and the last row is moved to its position
+    void swapRemove(int row){
+        const int last = row_list.size() - 1;
+        detach(row);
+        if (row != last){
+            lists[row_list[last]][row_pos[last]] = row;
+            row_list[row] = row_list[last];
+            row_pos[row] = row_pos[last];
+        }
+        row_list.pop_back();
+        row_pos.pop_back();
+    }
+
+    /*
+    target: (N, feat_dim), target_norms: (N, ), query: (feat_dim, )
+    return the top-k (score, index) pairs among the rows in the nprobe nearest lists,
+    sorted with the larger score the first,
+    the lists are chosen by angle, the rows in them are scored with the metric, 
+    only the rows with a non-zero mask are selected if mask is given
+    */
+    template <typename NumT>
+    std::vector<std::pair<float, int>> search(
+        const MatrixFCRef& target, const VectorFCRef& target_norms, const Eigen::Vector<NumT, FEAT_DIM>& query, int k, int nprobe, 
+        SearchAlgorithm::Metric metric = SearchAlgorithm::Metric::COSINE, const uint8_t* mask = nullptr
+        ) const {
+        return search(target_norms, query, k, nprobe, metric, mask, [&](int row){ return target.row(row).dot(query.transpose()); });
+    }
+    // same as above, row_dot(row) is the dot product of a row and the query, e.g. on the quantized rows
+    template <typename NumT, typename RowDot>
+    std::vector<std::pair<float, int>> search(
+        const VectorFCRef& target_norms, const Eigen::Vector<NumT, FEAT_DIM>& query, int k, int nprobe, 
+        SearchAlgorithm::Metric metric, const uint8_t* mask, RowDot row_dot
+        ) const {
+        nprobe = std::max(1, std::min(nprobe, nLists()));
+        const float norm_query = query.norm();
+        Eigen::Vector<float, Eigen::Dynamic> centroid_scores = centroids * query;
+        std::vector<std::pair<float, int>> heap;
+        heap.reserve(k);
+        for (int l : SearchAlgorithm::topKIndices(centroid_scores, nprobe)){
+            for (int row : lists[l]){
+                if (mask && !mask[row]) continue;
+                float score = SearchAlgorithm::scoreFromDot(metric, row_dot(row), norm_query, target_norms[row]);
+                SearchAlgorithm::pushTopK(heap, k, score, row);
+            }
+        }
+        std::sort_heap(heap.begin(), heap.end(), SearchAlgorithm::largerScore);
+        return heap;
+    }
+
+private:
+    // (n_lists, feat_dim), normalized
+    MatrixF centroids;
+    // row indexes of each list
+    std::vector<std::vector<int>> lists;
+    // list of each row, and the position of the row in the list, for O(1) removal
+    std::vector<int> row_list;
+    std::vector<int> row_pos;
+
+    void resetLists(const std::vector<int>& row_lists){
+        lists.assign(centroids.rows(), std::vector<int>());
+        row_list.clear();
+        row_pos.clear();
+        for (int row = 0; row < row_lists.size(); row++){
+            add(row, row_lists[row]);
+        }
+    }
+
+    // remove the row from its list, the last row of the list is moved to its position
+    void detach(int row){
+        std::vector<int>& list = lists[row_list[row]];
+        const int pos = row_pos[row];
+        list[pos] = list.back();
+        row_pos[list[pos]] = pos;
+        list.pop_back();
+    }
+};
@@ -0,0 +1,307 @@
+#pragma once
+#include "common.h"
+#include "searchAlgorithm.hpp"
+#include "threadPool.hpp"
+#include <cstdint>
+#include <random>
+#include <numeric>
+#include <cstring>
+
+/*
+Product quantization (PQ) index for approximate cosine similarity search.
+The normalized rows are split into n_sub sub-vectors, each encoded as the nearest of (at most) 256 centroids
+of its subspace (k-means), so a row is stored as n_sub bytes.
+A search computes a table of the dot products of the query with every centroid once,
+then the score of a row is the sum of n_sub table lookups (asymmetric distance computation).
+The index only keeps the codes, the collection must report every row it adds, moves or removes.
+A row is saved as its codes followed by the float32 norm of the vector, so that a collection storing the rows as codes
+can restore them without the vectors (see encodeRow and addEncoded).
+*/
+class PQIndex{
+public:
+    // maximum number of rows per centroid used for training, the rest are only encoded
+    static const int MAX_SAMPLES_PER_CENTROID = 64;
+    static const int MAX_CENTROIDS = 256;
+    typedef Eigen::Matrix<uint8_t, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor> Codes;
+
+    PQIndex(int dim): dim(dim) {}
+
+    bool trained() const { return n_sub > 0; }
+    int nSub() const { return n_sub; }
+    int nCentroids() const { return n_centroids; }
+    // (n_sub * n_centroids, dim / n_sub), the centroids of subspace m are rows [m * n_centroids, (m + 1) * n_centroids)
+    const Eigen::MatrixXf& getCodebooks() const { return codebooks; }
+    // (n_rows, n_sub)
+    auto getCodes() const { return codes.topRows(n_rows); }
+    // bytes of the codebooks and the codes
+    size_t nbytes() const {
+        return codebooks.size() * sizeof(float) + (size_t)n_rows * n_sub;
+    }
+
+    void clear(){
+        n_sub = 0;
+        n_centroids = 0;
+        n_rows = 0;
+        codebooks.resize(0, 0);
+        codebook_norms.resize(0);
+        codes.resize(0, 0);
+    }
+
+    // train the codebooks on (a sample of) the rows of data, then encode all rows
+    void train(const MatrixFCRef& data, int n_sub_, int n_iter, int n_threads){
+        if (n_sub_ < 1 || dim % n_sub_ != 0){
+            throw std::runtime_error("number of subspaces should divide the dimension " + std::to_string(dim));
+        }
+        if (data.rows() < 1){
+            throw std::runtime_error("no rows to train on");
+        }
+        const int n_data = data.rows();
+        const int k = std::min(MAX_CENTROIDS, n_data);
+        const int dsub = dim / n_sub_;
+        std::mt19937 rng(0);
+        std::vector<int> perm(n_data);
+        std::iota(perm.begin(), perm.end(), 0);
+        std::shuffle(perm.begin(), perm.end(), rng);
+        const int n_samples = std::min(n_data, k * MAX_SAMPLES_PER_CENTROID);
+        MatrixF samples(n_samples, dim);
+        for (int i = 0; i < n_samples; i++){
+            samples.row(i) = normalized(data.row(perm[i]));
+        }
+
+        // k-means in each subspace, the centroids are initialized with the first k samples
+        Eigen::MatrixXf new_codebooks(n_sub_ * k, dsub);
+        const int n_tasks = std::max(1, std::min(n_threads, n_sub_));
+        ThreadPool::instance().parallelFor(n_tasks, [&](int t){
+            for (int m = t; m < n_sub_; m += n_tasks){
+                Eigen::MatrixXf sub = samples.middleCols(m * dsub, dsub);
+                Eigen::MatrixXf centroids = sub.topRows(k);
+                std::vector<int> assign(n_samples);
+                Eigen::MatrixXf dists;
+                for (int it = 0; it < n_iter; it++){
+                    // ||x - c||^2 = ||x||^2 - 2 x.c + ||c||^2, the first term does not change the nearest centroid
+                    dists.noalias() = sub * centroids.transpose() * -2.0f;
+                    dists.rowwise() += centroids.rowwise().squaredNorm().transpose();
+                    for (int i = 0; i < n_samples; i++){
+                        dists.row(i).minCoeff(&assign[i]);
+                    }
+                    Eigen::MatrixXf sums = Eigen::MatrixXf::Zero(k, dsub);
+                    std::vector<int> counts(k, 0);
+                    for (int i = 0; i < n_samples; i++){
+                        sums.row(assign[i]) += sub.row(i);
+                        counts[assign[i]]++;
+                    }
+                    for (int c = 0; c < k; c++){
+                        // empty centroids are re-seeded with a sample
+                        centroids.row(c) = counts[c] ? (sums.row(c) / counts[c]).eval() : sub.row((c * 7919 + it) % n_samples).eval();
+                    }
+                }
+                new_codebooks.middleRows(m * k, k) = centroids;
+            }
+        });
+        n_sub = n_sub_;
+        n_centroids = k;
+        codebooks = std::move(new_codebooks);
+        codebook_norms = codebooks.rowwise().squaredNorm();
+        n_rows = 0;
+        codes.resize(n_data, n_sub);
+        encodeBulk(data, 0, n_threads);
+        n_rows = n_data;
+    }
+
+    // set the codebooks and the codes of the rows, e.g. when loading a saved index
+    void load(const Eigen::MatrixXf& codebooks_, int n_sub_, const Codes& codes_){
+        if (n_sub_ < 1 || dim % n_sub_ != 0 || codebooks_.cols() != dim / n_sub_ || codebooks_.rows() % n_sub_ != 0){
+            throw std::runtime_error("invalid codebooks");
+        }
+        const int k = codebooks_.rows() / n_sub_;
+        if (k < 1 || k > MAX_CENTROIDS || codes_.cols() != n_sub_ || (codes_.rows() > 0 && codes_.maxCoeff() >= k)){
+            throw std::runtime_error("invalid codes");
+        }
+        n_sub = n_sub_;
+        n_centroids = k;
+        codebooks = codebooks_;
+        codebook_norms = codebooks.rowwise().squaredNorm();
+        codes = codes_;
+        n_rows = codes.rows();
+    }
+
+    // the saved row: codes (n_sub bytes) | norm: float32
+    std::string encodeRow(int row, float norm) const {
+        std::string ret(n_sub + sizeof(float), '\0');
+        std::memcpy(&ret[0], codes.row(row).data(), n_sub);
+        std::memcpy(&ret[n_sub], &norm, sizeof(float));
+        return ret;
+    }
+
+    // append a saved row, return false if it is not a row of the current codebooks, 
+    // rows saved without the norm are only accepted by loadCodes
+    bool addEncoded(int row, const std::string& blob, float& norm){
+        if (row != n_rows){
+            throw std::runtime_error("rows should be added in order");
+        }
+        if (blob.size() != n_sub + sizeof(float) || !validCodes(blob)){
+            return false;
+        }
+        if (n_rows >= codes.rows()){
+            codes.conservativeResize(std::max(16, (int)(codes.rows() * 1.5)), Eigen::NoChange);
+        }
+        std::memcpy(codes.row(n_rows++).data(), blob.data(), n_sub);
+        std::memcpy(&norm, &blob[n_sub], sizeof(float));
+        return true;
+    }
+
+    // the codes of a saved row, with or without the norm, return false if they are not of the current codebooks
+    bool loadCodes(int row, const std::string& blob){
+        if ((blob.size() != n_sub && blob.size() != n_sub + sizeof(float)) || !validCodes(blob)){
+            return false;
+        }
+        std::memcpy(codes.row(row).data(), blob.data(), n_sub);
+        return true;
+    }
+
+    // the approximate normalized vector of a row
+    Eigen::Matrix<float, 1, FEAT_DIM> decode(int row) const {
+        const int dsub = dim / n_sub;
+        Eigen::Matrix<float, 1, FEAT_DIM> ret(dim);
+        for (int m = 0; m < n_sub; m++){
+            ret.segment(m * dsub, dsub) = codebooks.row(m * n_centroids + codes(row, m));
+        }
+        return ret;
+    }
+
+    // the dot product of the approximate normalized vector of a row with vec
+    float dot(int row, const RowFCRef& vec) const {
+        const int dsub = dim / n_sub;
+        float ret = 0;
+        for (int m = 0; m < n_sub; m++){
+            ret += codebooks.row(m * n_centroids + codes(row, m)).dot(vec.segment(m * dsub, dsub));
+        }
+        return ret;
+    }
+
+    // rows [start, start + data.rows()) are encoded from data, should be within the capacity, 
+    // block by block, the distances to the centroids of a block are computed as matrix products
+    void encodeBulk(const MatrixFCRef& data, int start, int n_threads){
+        const int n = data.rows();
+        const int dsub = dim / n_sub;
+        const int n_blocks = (n + SearchAlgorithm::SCORE_BLOCK_ROWS - 1) / SearchAlgorithm::SCORE_BLOCK_ROWS;
+        n_threads = std::max(1, std::min(n_threads, n_blocks));
+        ThreadPool::instance().parallelFor(n_threads, [&](int t){
+            MatrixF block(SearchAlgorithm::SCORE_BLOCK_ROWS, dim);
+            Eigen::Matrix<float, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor> dists;
+            for (int blk = t; blk < n_blocks; blk += n_threads){
+                const int b = blk * SearchAlgorithm::SCORE_BLOCK_ROWS;
+                const int len = std::min(SearchAlgorithm::SCORE_BLOCK_ROWS, n - b);
+                for (int i = 0; i < len; i++){
+                    block.row(i) = normalized(data.row(b + i));
+                }
+                for (int m = 0; m < n_sub; m++){
+                    dists.noalias() = block.topRows(len).middleCols(m * dsub, dsub) * codebooks.middleRows(m * n_centroids, n_centroids).transpose() * -2.0f;
+                    dists.rowwise() += codebook_norms.segment(m * n_centroids, n_centroids).transpose();
+                    for (int i = 0; i < len; i++){
+                        int c;
+                        dists.row(i).minCoeff(&c);
+                        codes(start + b + i, m) = (uint8_t)c;
+                    }
+                }
+            }
+        });
+    }
+
+    // a row is appended to the collection
+    void add(int row, const RowFCRef& vec){
+        if (row != n_rows){
+            throw std::runtime_error("rows should be added in order");
+        }
+        if (n_rows >= codes.rows()){
+            codes.conservativeResize(std::max(16, (int)(codes.rows() * 1.5)), Eigen::NoChange);
+        }
+        encode(vec, n_rows++);
+    }
+
+    // the vector of a row is changed
+    void update(int row, const RowFCRef& vec){
+        encode(vec, row);
+    }
+
+    // the row is removed from the collection, and the last row is moved to its position
+    void swapRemove(int row){
+        const int last = n_rows - 1;
+        if (row != last){
+            codes.row(row) = codes.row(last);
+        }
+        n_rows--;
+    }
+
+    /*
+    query: (feat_dim, )
+    return the top-k (approximate score, index) pairs, sorted with the larger score the first,
+    the rows are split into ranges searched by multiple threads, 
+    only the rows with a non-zero mask are selected if mask is given
+    */
+    template <typename NumT>
+    std::vector<std::pair<float, int>> search(const Eigen::Vector<NumT, FEAT_DIM>& query, int k, int n_threads, const uint8_t* mask = nullptr) const {
+        const fp32 _eps = 1e-8;
+        const int dsub = dim / n_sub;
+        // table(m, c): dot product of the m-th sub-vector of the normalized query and the c-th centroid of subspace m
+        Eigen::Matrix<float, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor> table(n_sub, n_centroids);
+        const Eigen::Matrix<float, 1, FEAT_DIM> q = query.transpose() / (query.norm() + _eps);
+        for (int m = 0; m < n_sub; m++){
+            table.row(m).noalias() = q.segment(m * dsub, dsub) * codebooks.middleRows(m * n_centroids, n_centroids).transpose();
+        }
+
+        n_threads = std::max(1, std::min(n_threads, n_rows / SearchAlgorithm::MIN_ROWS_PER_THREAD));
+        std::vector<std::vector<std::pair<float, int>>> partials(n_threads);
+        ThreadPool::instance().parallelFor(n_threads, [&](int t){
+            const int start = (long long)n_rows * t / n_threads;
+            const int end = (long long)n_rows * (t + 1) / n_threads;
+            std::vector<std::pair<float, int>>& partial = partials[t];
+            partial.reserve(std::min(k, end - start));
+            for (int row = start; row < end; row++){
+                if (mask && !mask[row]) continue;
+                const uint8_t* code = codes.row(row).data();
+                float score = 0;
+                for (int m = 0; m < n_sub; m++){
+                    score += table(m, code[m]);
+                }
+                SearchAlgorithm::pushTopK(partial, k, score, row);
+            }
+            std::sort_heap(partial.begin(), partial.end(), SearchAlgorithm::largerScore);
+        });
+        return SearchAlgorithm::mergeTopK(partials, k);
+    }
+
+private:
+    int dim;
+    int n_sub = 0;
+    int n_centroids = 0;
+    int n_rows = 0;
+    Eigen::MatrixXf codebooks;
+    Eigen::VectorXf codebook_norms;     // squared
+    // rows beyond n_rows are spare capacity
+    Codes codes;
+
+    bool validCodes(const std::string& blob) const {
+        for (int m = 0; m < n_sub; m++){
+            if ((uint8_t)blob[m] >= n_centroids) return false;
+        }
+        return true;
+    }
+
+    static Eigen::Matrix<float, 1, FEAT_DIM> normalized(const RowFCRef& vec){
+        const float norm = vec.norm();
+        return norm > 0 ? (vec / norm).eval() : vec.eval();
+    }
+
+    void encode(const RowFCRef& vec, int row){
+        const int dsub = dim / n_sub;
+        const Eigen::Matrix<float, 1, FEAT_DIM> v = normalized(vec);
+        for (int m = 0; m < n_sub; m++){
+            int c;
+            Eigen::VectorXf dists = codebook_norms.segment(m * n_centroids, n_centroids) - 
+                2.0f * codebooks.middleRows(m * n_centroids, n_centroids) * v.segment(m * dsub, dsub).transpose();
+            dists.minCoeff(&c);
+            codes(row, m) = (uint8_t)c;
+        }
+    }
+};
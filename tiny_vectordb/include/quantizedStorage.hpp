@@ -0,0 +1,322 @@
+#pragma once
+#include "common.h"
+#include "searchAlgorithm.hpp"
+#include "threadPool.hpp"
+#include <cstdint>
+#include <cstring>
+
+/*
+Scalar quantized rows of a collection, scored instead of the float32 rows in a flat search, 
+or the only rows in memory if the collection does not keep the float32 rows.
+float16: each element is stored as a half precision float.
+int8: each row is stored as int8 codes and a float32 scale (max absolute value / 127), row ≈ scale * codes,
+    the queries are quantized the same way, and scored with integer dot products.
+The approximate scores only select the candidates, which are re-ranked on the float32 rows by the collection (or its caller),
+so the collection must report every row it adds, moves or removes.
+A row is saved as a BLOB of [uint8 type][float32 norm of the float32 row][int8 only: float32 scale][codes], 
+see encodeRow and addEncoded.
+*/
+class QuantizedStorage{
+public:
+    // the values are saved in the BLOBs
+    enum class Type{ NONE = 0, FP16 = 1, INT8 = 2 };
+    // number of rows scored at a time, the converted block stays in cache
+    static const int SCORE_BLOCK_ROWS = 128;
+
+    static Type parseType(const std::string& name){
+        if (name == "float32") return Type::NONE;
+        if (name == "float16") return Type::FP16;
+        if (name == "int8") return Type::INT8;
+        throw std::runtime_error("unknown dtype: " + name);
+    }
+    static std::string typeName(Type type){
+        switch (type){
+            case Type::FP16: return "float16";
+            case Type::INT8: return "int8";
+            default: return "float32";
+        }
+    }
+
+    QuantizedStorage(int dim): dim(dim), fp16_rows(0, dim), int8_rows(0, dim) {}
+
+    Type type() const { return type_; }
+    bool enabled() const { return type_ != Type::NONE; }
+    // bytes of the quantized rows
+    size_t nbytes() const {
+        switch (type_){
+            case Type::FP16: return (size_t)n_rows * dim * sizeof(Eigen::half);
+            case Type::INT8: return (size_t)n_rows * (dim * sizeof(int8_t) + sizeof(float));
+            default: return 0;
+        }
+    }
+
+    // pre-allocate memory for at least n rows
+    void reserve(int n){
+        if (!enabled() || n <= capacity()){
+            return;
+        }
+        if (type_ == Type::FP16){
+            fp16_rows.conservativeResize(n, Eigen::NoChange);
+        }
+        else{
+            int8_rows.conservativeResize(n, Eigen::NoChange);
+            scales.conservativeResize(n);
+        }
+    }
+
+    void clear(){
+        type_ = Type::NONE;
+        n_rows = 0;
+        fp16_rows.resize(0, dim);
+        int8_rows.resize(0, dim);
+        scales.resize(0);
+    }
+
+    // quantize all rows of data with the given type
+    void build(const MatrixFCRef& data, Type type){
+        clear();
+        type_ = type;
+        if (!enabled()){
+            return;
+        }
+        reserve(data.rows());
+        for (int row = 0; row < data.rows(); row++){
+            add(row, data.row(row));
+        }
+    }
+
+    // a row is appended to the collection
+    void add(int row, const RowFCRef& vec){
+        if (row != n_rows){
+            throw std::runtime_error("rows should be added in order");
+        }
+        if (n_rows >= capacity()){
+            reserve(std::max(16, (int)(capacity() * 1.5)));
+        }
+        n_rows++;
+        set(row, vec);
+    }
+
+    // the vector of a row is changed
+    void update(int row, const RowFCRef& vec){
+        set(row, vec);
+    }
+
+    // the row is removed from the collection, and the last row is moved to its position
+    void swapRemove(int row){
+        const int last = n_rows - 1;
+        if (row != last){
+            if (type_ == Type::FP16){
+                fp16_rows.row(row) = fp16_rows.row(last);
+            }
+            else{
+                int8_rows.row(row) = int8_rows.row(last);
+                scales[row] = scales[last];
+            }
+        }
+        n_rows--;
+    }
+
+    // the approximate float32 vector of a row
+    Eigen::Matrix<num_t, 1, FEAT_DIM> decode(int row) const {
+        if (type_ == Type::FP16){
+            return fp16_rows.row(row).cast<float>();
+        }
+        return scales[row] * int8_rows.row(row).cast<float>();
+    }
+
+    // approximate dot product of a row and a float32 vector
+    float dot(int row, const RowFCRef& vec) const {
+        if (type_ == Type::FP16){
+            return fp16_rows.row(row).cast<float>().dot(vec);
+        }
+        return scales[row] * int8_rows.row(row).cast<float>().dot(vec);
+    }
+
+    // the BLOB of a row, norm is the norm of the float32 row, which is not kept here
+    std::string encodeRow(int row, float norm) const {
+        std::string ret = encodeHeader(type_, norm, type_ == Type::INT8 ? scales[row] : 0.0f);
+        if (type_ == Type::FP16){
+            ret.append((const char*)fp16_rows.row(row).data(), dim * sizeof(Eigen::half));
+        }
+        else{
+            ret.append((const char*)int8_rows.row(row).data(), dim * sizeof(int8_t));
+        }
+        return ret;
+    }
+
+    // append a row from its BLOB, and set norm from it, 
+    // return false and leave the rows unchanged if the BLOB is empty (not saved) or of another type
+    bool addEncoded(int row, const std::string& blob, float& norm){
+        if (!enabled() || blob.size() != encodedSize(type_, dim) || (uint8_t)blob[0] != (uint8_t)type_){
+            return false;
+        }
+        add(row, Eigen::Matrix<num_t, 1, FEAT_DIM>::Zero(dim));
+        std::memcpy(&norm, &blob[1], sizeof(float));
+        const char* codes = &blob[1 + sizeof(float)];
+        if (type_ == Type::FP16){
+            std::memcpy(fp16_rows.row(row).data(), codes, dim * sizeof(Eigen::half));
+        }
+        else{
+            std::memcpy(&scales[row], codes, sizeof(float));
+            std::memcpy(int8_rows.row(row).data(), codes + sizeof(float), dim * sizeof(int8_t));
+        }
+        return true;
+    }
+
+    // quantize a float32 vector into a BLOB of the type, without a collection
+    static std::string encodeVector(const RowFCRef& vec, Type type){
+        QuantizedStorage storage(vec.size());
+        storage.build(vec, type);
+        if (!storage.enabled()){
+            throw std::runtime_error("no quantized encoding of float32");
+        }
+        return storage.encodeRow(0, vec.norm());
+    }
+
+    // the approximate float32 vector of a BLOB, whose dimension is given by its size
+    static std::vector<num_t> decodeVector(const std::string& blob){
+        const Type type = blob.empty() ? Type::NONE : (Type)(uint8_t)blob[0];
+        const long long n_codes = (long long)blob.size() - (long long)encodedSize(type, 0);
+        const int dim = type == Type::FP16 ? n_codes / sizeof(Eigen::half) : n_codes;
+        if ((type != Type::FP16 && type != Type::INT8) || dim < 1 || (FEAT_DIM != Eigen::Dynamic && dim != FEAT_DIM)){
+            throw std::runtime_error("invalid quantized encoding of " + std::to_string(blob.size()) + " bytes");
+        }
+        QuantizedStorage storage(dim);
+        storage.type_ = type;
+        float norm;
+        if (!storage.addEncoded(0, blob, norm)){
+            throw std::runtime_error("invalid quantized encoding of " + std::to_string(blob.size()) + " bytes");
+        }
+        Eigen::Matrix<num_t, 1, FEAT_DIM> vec = storage.decode(0);
+        return std::vector<num_t>(vec.data(), vec.data() + dim);
+    }
+
+    /*
+    target_norms: (N, ) norms of the float32 rows, queries: (Q, feat_dim)
+    return the top-k (approximate score, index) pairs of each query, sorted with the larger score the first,
+    the rows are split into ranges searched by multiple threads as in SearchAlgorithm::similarityTopKBatch, 
+    only the rows with a non-zero mask are selected if mask is given
+    */
+    std::vector<std::vector<std::pair<float, int>>> searchTopKBatch(
+        const VectorFCRef& target_norms, const MatrixFCRef& queries, int k, int n_threads, 
+        SearchAlgorithm::Metric metric = SearchAlgorithm::Metric::COSINE, const uint8_t* mask = nullptr
+        ) const {
+        const int n_queries = queries.rows();
+        Eigen::Vector<float, Eigen::Dynamic> norm_queries = queries.rowwise().norm();
+        // int8 rows are scored against int8 queries with integer dot products
+        Int8Rows query_codes(type_ == Type::INT8 ? n_queries : 0, dim);
+        Eigen::Vector<float, Eigen::Dynamic> query_scales(query_codes.rows());
+        for (int q = 0; q < query_codes.rows(); q++){
+            query_scales[q] = quantizeInt8(queries.row(q), query_codes.row(q));
+        }
+
+        n_threads = std::max(1, std::min(n_threads, n_rows / SearchAlgorithm::MIN_ROWS_PER_THREAD));
+        std::vector<std::vector<std::vector<std::pair<float, int>>>> partials(
+            n_queries, std::vector<std::vector<std::pair<float, int>>>(n_threads)
+        );
+        ThreadPool::instance().parallelFor(n_threads, [&](int t){
+            const int start = (long long)n_rows * t / n_threads;
+            const int end = (long long)n_rows * (t + 1) / n_threads;
+            const int k_local = std::min(k, end - start);
+            MatrixF block(type_ == Type::FP16 ? SCORE_BLOCK_ROWS : 0, dim);
+            Eigen::Matrix<float, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor> block_scores(n_queries, SCORE_BLOCK_ROWS);
+            for (int q = 0; q < n_queries; q++){
+                partials[q][t].reserve(k_local);
+            }
+            for (int b = start; b < end; b += SCORE_BLOCK_ROWS){
+                const int len = std::min(SCORE_BLOCK_ROWS, end - b);
+                if (type_ == Type::FP16){
+                    block.topRows(len) = fp16_rows.middleRows(b, len).cast<float>();
+                    block_scores.leftCols(len).noalias() = queries * block.topRows(len).transpose();
+                }
+                else{
+                    for (int q = 0; q < n_queries; q++){
+                        for (int i = 0; i < len; i++){
+                            block_scores(q, i) = query_scales[q] * scales[b + i] * dotInt8(query_codes.row(q).data(), int8_rows.row(b + i).data(), dim);
+                        }
+                    }
+                }
+                for (int q = 0; q < n_queries; q++){
+                    for (int i = 0; i < len; i++){
+                        if (mask && !mask[b + i]) continue;
+                        SearchAlgorithm::pushTopK(partials[q][t], k_local, SearchAlgorithm::scoreFromDot(metric, block_scores(q, i), norm_queries[q], target_norms[b + i]), b + i);
+                    }
+                }
+            }
+            for (int q = 0; q < n_queries; q++){
+                std::sort_heap(partials[q][t].begin(), partials[q][t].end(), SearchAlgorithm::largerScore);
+            }
+        });
+        std::vector<std::vector<std::pair<float, int>>> ret(n_queries);
+        for (int q = 0; q < n_queries; q++){
+            ret[q] = SearchAlgorithm::mergeTopK(partials[q], k);
+        }
+        return ret;
+    }
+
+    // query: (feat_dim, )
+    template <typename NumT>
+    std::vector<std::pair<float, int>> searchTopK(
+        const VectorFCRef& target_norms, const Eigen::Vector<NumT, FEAT_DIM>& query, int k, int n_threads, 
+        SearchAlgorithm::Metric metric = SearchAlgorithm::Metric::COSINE, const uint8_t* mask = nullptr
+        ) const {
+        MatrixF queries = query.transpose();
+        return searchTopKBatch(target_norms, queries, k, n_threads, metric, mask)[0];
+    }
+
+private:
+    typedef Eigen::Matrix<int8_t, Eigen::Dynamic, FEAT_DIM, Eigen::RowMajor> Int8Rows;
+    int dim;
+    Type type_ = Type::NONE;
+    int n_rows = 0;
+    // rows beyond n_rows are spare capacity
+    Eigen::Matrix<Eigen::half, Eigen::Dynamic, FEAT_DIM, Eigen::RowMajor> fp16_rows;
+    Int8Rows int8_rows;
+    Eigen::Vector<float, Eigen::Dynamic> scales;
+
+    static size_t encodedSize(Type type, int dim){
+        return 1 + sizeof(float) + (type == Type::FP16 ? dim * sizeof(Eigen::half) : sizeof(float) + dim * sizeof(int8_t));
+    }
+
+    static std::string encodeHeader(Type type, float norm, float scale){
+        std::string ret(1 + sizeof(float) + (type == Type::INT8 ? sizeof(float) : 0), '\0');
+        ret[0] = (char)(uint8_t)type;
+        std::memcpy(&ret[1], &norm, sizeof(float));
+        if (type == Type::INT8){
+            std::memcpy(&ret[1 + sizeof(float)], &scale, sizeof(float));
+        }
+        return ret;
+    }
+
+    int capacity() const {
+        return type_ == Type::FP16 ? fp16_rows.rows() : int8_rows.rows();
+    }
+
+    void set(int row, const RowFCRef& vec){
+        if (type_ == Type::FP16){
+            fp16_rows.row(row) = vec.cast<Eigen::half>();
+            return;
+        }
+        scales[row] = quantizeInt8(vec, int8_rows.row(row));
+    }
+
+    // symmetric quantization, vec ≈ scale * codes, return the scale
+    template <typename CodesT>
+    static float quantizeInt8(const RowFCRef& vec, CodesT&& codes){
+        const float max_abs = vec.cwiseAbs().maxCoeff();
+        const float scale = max_abs > 0 ? max_abs / 127.0f : 1.0f;
+        codes = (vec / scale).array().round().cwiseMax(-127.0f).cwiseMin(127.0f).template cast<int8_t>();
+        return scale;
+    }
+
+    // a plain loop over int32 products, vectorized by the compiler, of fixed length in the fixed-dimension modules
+    static int dotInt8(const int8_t* a, const int8_t* b, int dim){
+        int acc = 0;
+        const int n = featDim(dim);
+        for (int d = 0; d < n; d++){
+            acc += (int)a[d] * (int)b[d];
+        }
+        return acc;
+    }
+};
@@ -0,0 +1,83 @@
+#pragma once
+#include "common.h"
+#include <algorithm>
+#include <unordered_map>
+#include <variant>
+
+// an attribute value of a row, None (missing), an integer or a string
+typedef std::variant<std::monostate, long long, std::string> Attribute;
+
+/*
+Optional per-row attributes of a collection, one column per key,
+so that search filters on them are evaluated without going through python.
+A column is only as long as its last set row, the rows beyond are missing,
+so appending rows costs nothing, the collection must report every row it moves or removes.
+*/
+class RowAttributes{
+public:
+    bool empty() const { return columns.empty(); }
+
+    std::vector<std::string> keys() const {
+        std::vector<std::string> ret;
+        for (auto& kv : columns){
+            ret.push_back(kv.first);
+        }
+        std::sort(ret.begin(), ret.end());
+        return ret;
+    }
+
+    void clear(){
+        columns.clear();
+    }
+
+    void set(const std::string& key, int row, Attribute value){
+        std::vector<Attribute>& column = columns[key];
+        if (row >= column.size()){
+            if (std::holds_alternative<std::monostate>(value)){
+                return;
+            }
+            column.resize(row + 1);
+        }
+        column[row] = std::move(value);
+    }
+
+    Attribute get(const std::string& key, int row) const {
+        auto it = columns.find(key);
+        if (it == columns.end() || row >= it->second.size()){
+            return Attribute();
+        }
+        return it->second[row];
+    }
+
+    // the row is removed from the collection, and the last row is moved to its position
+    void swapRemove(int row, int last){
+        for (auto& kv : columns){
+            std::vector<Attribute>& column = kv.second;
+            if (row != last && row < column.size()){
+                column[row] = last < column.size() ? std::move(column[last]) : Attribute();
+            }
+            if (column.size() > last){
+                column.resize(last);
+            }
+        }
+    }
+
+    // clear mask[row] for the rows whose attribute of key is not one of the values, mask: (n_rows, )
+    void filter(const std::string& key, const std::vector<Attribute>& values, std::vector<uint8_t>& mask) const {
+        auto it = columns.find(key);
+        const int n_set = it == columns.end() ? 0 : it->second.size();
+        const bool allow_missing = std::find(values.begin(), values.end(), Attribute()) != values.end();
+        for (int row = 0; row < mask.size(); row++){
+            if (!mask[row]) continue;
+            if (row >= n_set){
+                mask[row] = allow_missing;
+            }
+            else{
+                mask[row] = std::find(values.begin(), values.end(), it->second[row]) != values.end();
+            }
+        }
+    }
+
+private:
+    std::unordered_map<std::string, std::vector<Attribute>> columns;
+};
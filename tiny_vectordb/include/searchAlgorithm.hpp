@@ -1,30 +1,306 @@
 #pragma once
 #include "common.h"
+#include "threadPool.hpp"
+#include <algorithm>
+#include <cstdint>
+#include <string>
+#include <type_traits>
 
 namespace SearchAlgorithm {
 
-std::vector<int> topKIndices(const Eigen::Vector<float, Eigen::Dynamic> scores, int k);
+// minimum number of rows for a thread to work on, 
+// smaller collections are not worth the cost of dispatching tasks
+const int MIN_ROWS_PER_THREAD = 8192;
+// number of rows scored at a time when selecting with a bounded heap, 
+// the block of scores stays in cache and no O(N) buffer is allocated
+const int SCORE_BLOCK_ROWS = 1024;
 
-/* target: (N, feat_dim), query: (feat_dim, ) */
-template <typename NumT>
-inline Eigen::Vector<float, Eigen::Dynamic> cosineSimilarity(const MatrixF& target, const Eigen::Vector<NumT, FEAT_DIM>& query_matrix){
+std::vector<int> topKIndices(const Eigen::Vector<float, Eigen::Dynamic>& scores, int k);
+
+// whether to select top-k by scoring all rows and partial sorting, 
+// rather than by streaming the scores through a bounded heap, 
+// the heap is only worth it if a small part of the rows are kept
+inline bool useFullSelection(int k, int n_rows){
+    return (long long)k * 4 >= n_rows;
+}
+
+// comparison of (score, index) pairs, the larger score the first
+inline bool largerScore(const std::pair<float, int>& a, const std::pair<float, int>& b){
+    return a.first > b.first;
+}
+
+// push a candidate into a bounded min-heap that keeps the k largest scores
+inline void pushTopK(std::vector<std::pair<float, int>>& heap, int k, float score, int idx){
+    if (heap.size() < k){
+        heap.emplace_back(score, idx);
+        std::push_heap(heap.begin(), heap.end(), largerScore);
+    }
+    else if (k > 0 && score > heap.front().first){
+        std::pop_heap(heap.begin(), heap.end(), largerScore);
+        heap.back() = std::make_pair(score, idx);
+        std::push_heap(heap.begin(), heap.end(), largerScore);
+    }
+}
+
+/* 
+merge partial top-k candidates of (score, index) into the final top-k, 
+return sorted candidates with the larger score the first
+*/
+std::vector<std::pair<float, int>> mergeTopK(std::vector<std::vector<std::pair<float, int>>>& partials, int k);
+
+/*
+similarity metrics, the larger score the closer:
+COSINE: cosine similarity, 
+IP: inner product, the norms are not used, for normalized vectors it equals COSINE, 
+L2: negative squared euclidean distance, computed from the inner product and the norms
+*/
+enum class Metric{ COSINE, IP, L2 };
+
+inline Metric parseMetric(const std::string& name){
+    if (name == "cosine") return Metric::COSINE;
+    if (name == "ip") return Metric::IP;
+    if (name == "l2") return Metric::L2;
+    throw std::runtime_error("unknown metric: " + name);
+}
+inline std::string metricName(Metric metric){
+    switch (metric){
+        case Metric::IP: return "ip";
+        case Metric::L2: return "l2";
+        default: return "cosine";
+    }
+}
+
+// score of a row from its inner product with the query, and the l2 norms of both
+template <Metric M>
+inline float scoreFromDot(float dot, float norm_query, float norm_row){
     const fp32 _eps = 1e-8;
+    if constexpr (M == Metric::COSINE){
+        return dot / (norm_query * norm_row + _eps);
+    }
+    else if constexpr (M == Metric::IP){
+        return dot;
+    }
+    else{
+        return 2 * dot - norm_query * norm_query - norm_row * norm_row;
+    }
+}
+// runtime dispatched version, for the approximate indexes scoring a few rows
+inline float scoreFromDot(Metric metric, float dot, float norm_query, float norm_row){
+    switch (metric){
+        case Metric::IP: return scoreFromDot<Metric::IP>(dot, norm_query, norm_row);
+        case Metric::L2: return scoreFromDot<Metric::L2>(dot, norm_query, norm_row);
+        default: return scoreFromDot<Metric::COSINE>(dot, norm_query, norm_row);
+    }
+}
+
+// call func with the metric as a compile-time constant, so that kernels are specialized for each metric
+template <typename Func>
+inline auto dispatchMetric(Metric metric, Func&& func){
+    switch (metric){
+        case Metric::IP: return func(std::integral_constant<Metric, Metric::IP>());
+        case Metric::L2: return func(std::integral_constant<Metric, Metric::L2>());
+        default: return func(std::integral_constant<Metric, Metric::COSINE>());
+    }
+}
+
+/* target: (N, feat_dim), target_norms: (N, ), query: (feat_dim, ) */
+template <Metric M, typename NumT>
+inline Eigen::Vector<float, Eigen::Dynamic> similarity(
+    const MatrixFCRef& target, const VectorFCRef& target_norms, const Eigen::Vector<NumT, FEAT_DIM>& query_matrix
+    ){
     if (target.cols() != query_matrix.size()){
         throw std::runtime_error("query size not match");
     }
     Eigen::Matrix<NumT, Eigen::Dynamic, 1> search_scores = target * query_matrix;
-    float norm_query = query_matrix.norm();
-    Eigen::Vector<float, Eigen::Dynamic> norm_collection = target.rowwise().norm();
-    search_scores = search_scores.array() / (norm_query * norm_collection.array() + _eps);
+    if constexpr (M != Metric::IP){
+        float norm_query = query_matrix.norm();
+        for (int i = 0; i < search_scores.size(); i++){
+            search_scores[i] = scoreFromDot<M>(search_scores[i], norm_query, target_norms[i]);
+        }
+    }
     return search_scores;
 }
 template <typename NumT>
-inline Eigen::Vector<float, Eigen::Dynamic> cosineSimilarity(const MatrixF& target, const std::vector<NumT>& query){
+inline Eigen::Vector<float, Eigen::Dynamic> cosineSimilarity(
+    const MatrixFCRef& target, const VectorFCRef& target_norms, const Eigen::Vector<NumT, FEAT_DIM>& query_matrix
+    ){
+    return similarity<Metric::COSINE>(target, target_norms, query_matrix);
+}
+/* target: (N, feat_dim), query: (feat_dim, ) */
+template <typename NumT>
+inline Eigen::Vector<float, Eigen::Dynamic> cosineSimilarity(const MatrixFCRef& target, const Eigen::Vector<NumT, FEAT_DIM>& query_matrix){
+    Eigen::Vector<float, Eigen::Dynamic> norm_collection = target.rowwise().norm();
+    return cosineSimilarity(target, norm_collection, query_matrix);
+}
+template <typename NumT>
+inline Eigen::Vector<float, Eigen::Dynamic> cosineSimilarity(
+    const MatrixFCRef& target, const VectorFCRef& target_norms, const std::vector<NumT>& query
+    ){
     if (target.cols() != query.size()){
         throw std::runtime_error("query size not match");
     }
-    Eigen::Matrix<NumT, FEAT_DIM, 1> query_matrix = Eigen::Map<const Eigen::Matrix<NumT, FEAT_DIM, 1>>(query.data());
+    Eigen::Matrix<NumT, FEAT_DIM, 1> query_matrix = Eigen::Map<const Eigen::Matrix<NumT, FEAT_DIM, 1>>(query.data(), query.size());
+    return cosineSimilarity(target, target_norms, query_matrix);
+}
+template <typename NumT>
+inline Eigen::Vector<float, Eigen::Dynamic> cosineSimilarity(const MatrixFCRef& target, const std::vector<NumT>& query){
+    if (target.cols() != query.size()){
+        throw std::runtime_error("query size not match");
+    }
+    Eigen::Matrix<NumT, FEAT_DIM, 1> query_matrix = Eigen::Map<const Eigen::Matrix<NumT, FEAT_DIM, 1>>(query.data(), query.size());
     return cosineSimilarity(target, query_matrix);
 }
 
+/* target: (N, feat_dim), target_norms: (N, ), queries: (Q, feat_dim), return: (Q, N) */
+template <Metric M>
+inline Eigen::Matrix<float, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor> similarityBatch(
+    const MatrixFCRef& target, const VectorFCRef& target_norms, const MatrixFCRef& queries
+    ){
+    // one matrix-matrix product for all queries
+    Eigen::Matrix<float, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor> search_scores = queries * target.transpose();
+    if constexpr (M != Metric::IP){
+        Eigen::Vector<float, Eigen::Dynamic> norm_queries = queries.rowwise().norm();
+        for (int q = 0; q < search_scores.rows(); q++){
+            for (int i = 0; i < search_scores.cols(); i++){
+                search_scores(q, i) = scoreFromDot<M>(search_scores(q, i), norm_queries[q], target_norms[i]);
+            }
+        }
+    }
+    return search_scores;
+}
+
+/* 
+target: (N, feat_dim), target_norms: (N, ), query: (feat_dim, )
+The rows of target are split into ranges, each thread scores its range and keeps a partial top-k,
+the partial results are merged at the end.
+mask: (N, ) or nullptr, only the rows with a non-zero mask are selected
+return the top-k (score, index) pairs, sorted with the larger score the first
+*/
+template <Metric M, typename NumT>
+inline std::vector<std::pair<float, int>> similarityTopK(
+    const MatrixFCRef& target, const VectorFCRef& target_norms, const Eigen::Vector<NumT, FEAT_DIM>& query_matrix, int k, int n_threads, 
+    const uint8_t* mask = nullptr
+    ){
+    const int n_rows = target.rows();
+    const float norm_query = M == Metric::IP ? 0 : query_matrix.norm();
+
+    n_threads = std::max(1, std::min(n_threads, n_rows / MIN_ROWS_PER_THREAD));
+    std::vector<std::vector<std::pair<float, int>>> partials(n_threads);
+    ThreadPool::instance().parallelFor(n_threads, [&](int t){
+        const int start = (long long)n_rows * t / n_threads;
+        const int end = (long long)n_rows * (t + 1) / n_threads;
+        const int k_local = std::min(k, end - start);
+        std::vector<std::pair<float, int>>& partial = partials[t];
+        partial.reserve(k_local);
+
+        if (!mask && useFullSelection(k_local, end - start)){
+            Eigen::Vector<float, Eigen::Dynamic> search_scores = similarity<M>(
+                target.middleRows(start, end - start), target_norms.segment(start, end - start), query_matrix
+            );
+            std::vector<int> local_indexes = topKIndices(search_scores, k_local);
+            for (int i = 0; i < k_local; i++){
+                partial.push_back(std::make_pair(search_scores[local_indexes[i]], local_indexes[i] + start));
+            }
+            return;
+        }
+
+        // fused scoring and selection, block by block
+        Eigen::Vector<float, Eigen::Dynamic> block_scores(SCORE_BLOCK_ROWS);
+        for (int b = start; b < end; b += SCORE_BLOCK_ROWS){
+            const int len = std::min(SCORE_BLOCK_ROWS, end - b);
+            block_scores.head(len).noalias() = target.middleRows(b, len) * query_matrix;
+            for (int i = 0; i < len; i++){
+                if (mask && !mask[b + i]) continue;
+                // the norms are not read for inner product
+                pushTopK(partial, k_local, scoreFromDot<M>(block_scores[i], norm_query, M == Metric::IP ? 0 : target_norms[b + i]), b + i);
+            }
+        }
+        std::sort_heap(partial.begin(), partial.end(), largerScore);
+    });
+    return mergeTopK(partials, k);
+}
+
+/* 
+target: (N, feat_dim), target_norms: (N, ), queries: (Q, feat_dim)
+Batched version of similarityTopK, each thread scores its range of rows against all queries.
+return the top-k (score, index) pairs of each query, sorted with the larger score the first
+*/
+template <Metric M>
+inline std::vector<std::vector<std::pair<float, int>>> similarityTopKBatch(
+    const MatrixFCRef& target, const VectorFCRef& target_norms, const MatrixFCRef& queries, int k, int n_threads, 
+    const uint8_t* mask = nullptr
+    ){
+    const int n_rows = target.rows();
+    const int n_queries = queries.rows();
+    Eigen::Vector<float, Eigen::Dynamic> norm_queries = queries.rowwise().norm();
+
+    n_threads = std::max(1, std::min(n_threads, n_rows / MIN_ROWS_PER_THREAD));
+    // partials[q][t]: partial top-k of query q in the range of thread t
+    std::vector<std::vector<std::vector<std::pair<float, int>>>> partials(
+        n_queries, std::vector<std::vector<std::pair<float, int>>>(n_threads)
+    );
+    ThreadPool::instance().parallelFor(n_threads, [&](int t){
+        const int start = (long long)n_rows * t / n_threads;
+        const int end = (long long)n_rows * (t + 1) / n_threads;
+        const int k_local = std::min(k, end - start);
+
+        if (!mask && useFullSelection(k_local, end - start)){
+            auto search_scores = similarityBatch<M>(
+                target.middleRows(start, end - start), target_norms.segment(start, end - start), queries
+            );
+            for (int q = 0; q < n_queries; q++){
+                std::vector<int> local_indexes = topKIndices(search_scores.row(q).transpose(), k_local);
+                partials[q][t].reserve(k_local);
+                for (int i = 0; i < k_local; i++){
+                    partials[q][t].push_back(std::make_pair(search_scores(q, local_indexes[i]), local_indexes[i] + start));
+                }
+            }
+            return;
+        }
+
+        Eigen::Matrix<float, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor> block_scores(n_queries, SCORE_BLOCK_ROWS);
+        for (int q = 0; q < n_queries; q++){
+            partials[q][t].reserve(k_local);
+        }
+        for (int b = start; b < end; b += SCORE_BLOCK_ROWS){
+            const int len = std::min(SCORE_BLOCK_ROWS, end - b);
+            block_scores.leftCols(len).noalias() = queries * target.middleRows(b, len).transpose();
+            for (int q = 0; q < n_queries; q++){
+                for (int i = 0; i < len; i++){
+                    if (mask && !mask[b + i]) continue;
+                    pushTopK(partials[q][t], k_local, scoreFromDot<M>(block_scores(q, i), norm_queries[q], M == Metric::IP ? 0 : target_norms[b + i]), b + i);
+                }
+            }
+        }
+        for (int q = 0; q < n_queries; q++){
+            std::sort_heap(partials[q][t].begin(), partials[q][t].end(), largerScore);
+        }
+    });
+
+    std::vector<std::vector<std::pair<float, int>>> ret(n_queries);
+    for (int q = 0; q < n_queries; q++){
+        ret[q] = mergeTopK(partials[q], k);
+    }
+    return ret;
+}
+/* 
+target: (N, feat_dim), target_norms: (N, ), query: (feat_dim, )
+only score the given rows, e.g. the few rows allowed by a selective filter, without going through the others
+return the top-k (score, index) pairs, sorted with the larger score the first
+*/
+template <Metric M, typename NumT>
+inline std::vector<std::pair<float, int>> similarityTopKRows(
+    const MatrixFCRef& target, const VectorFCRef& target_norms, const Eigen::Vector<NumT, FEAT_DIM>& query_matrix, 
+    const std::vector<int>& rows, int k
+    ){
+    const float norm_query = M == Metric::IP ? 0 : query_matrix.norm();
+    std::vector<std::pair<float, int>> heap;
+    heap.reserve(std::min(k, (int)rows.size()));
+    for (int row : rows){
+        pushTopK(heap, k, scoreFromDot<M>(target.row(row).dot(query_matrix.transpose()), norm_query, M == Metric::IP ? 0 : target_norms[row]), row);
+    }
+    std::sort_heap(heap.begin(), heap.end(), largerScore);
+    return heap;
+}
+
 }
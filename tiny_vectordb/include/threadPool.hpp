@@ -0,0 +1,98 @@
+#pragma once
+
+#include <condition_variable>
+#include <exception>
+#include <functional>
+#include <mutex>
+#include <queue>
+#include <thread>
+#include <vector>
+
+// A minimal thread pool shared by all collections of the module,
+// worker threads are created lazily and kept alive to avoid spawning threads on every search
+class ThreadPool{
+public:
+    static ThreadPool& instance(){
+        static ThreadPool pool;
+        return pool;
+    }
+
+    ~ThreadPool(){
+        {
+            std::unique_lock<std::mutex> lock(mtx_);
+            stop_ = true;
+        }
+        cv_.notify_all();
+        for (auto& w : workers_){
+            if (w.joinable()) w.join();
+        }
+    }
+
+    // run func(0), func(1), ..., func(n_tasks - 1) in parallel and wait for all of them,
+    // the calling thread runs one of the tasks itself
+    void parallelFor(int n_tasks, const std::function<void(int)>& func){
+        if (n_tasks <= 1){
+            if (n_tasks == 1) func(0);
+            return;
+        }
+        ensureWorkers(n_tasks - 1);
+
+        int remaining = n_tasks - 1;
+        std::exception_ptr error = nullptr;
+        std::mutex done_mtx;
+        std::condition_variable done_cv;
+        {
+            std::unique_lock<std::mutex> lock(mtx_);
+            for (int i = 1; i < n_tasks; i++){
+                tasks_.push([&, i](){
+                    std::exception_ptr e = nullptr;
+                    try { func(i); }
+                    catch (...) { e = std::current_exception(); }
+                    std::unique_lock<std::mutex> done_lock(done_mtx);
+                    if (e && !error) error = e;
+                    if (--remaining == 0) done_cv.notify_one();
+                });
+            }
+        }
+        cv_.notify_all();
+
+        std::exception_ptr e_self = nullptr;
+        try { func(0); }
+        catch (...) { e_self = std::current_exception(); }
+
+        std::unique_lock<std::mutex> done_lock(done_mtx);
+        done_cv.wait(done_lock, [&](){ return remaining == 0; });
+        if (e_self) std::rethrow_exception(e_self);
+        if (error) std::rethrow_exception(error);
+    }
+
+private:
+    ThreadPool() = default;
+
+    void ensureWorkers(int n){
+        std::unique_lock<std::mutex> lock(mtx_);
+        while ((int)workers_.size() < n){
+            workers_.emplace_back([this](){ workerLoop(); });
+        }
+    }
+
+    void workerLoop(){
+        while (true){
+            std::function<void()> task;
+            {
+                std::unique_lock<std::mutex> lock(mtx_);
+                cv_.wait(lock, [this](){ return stop_ || !tasks_.empty(); });
+                if (stop_ && tasks_.empty()) return;
+                task = std::move(tasks_.front());
+                tasks_.pop();
+            }
+            task();
+        }
+    }
+
+    std::vector<std::thread> workers_;
+    std::queue<std::function<void()>> tasks_;
+    std::mutex mtx_;
+    std::condition_variable cv_;
+    bool stop_ = false;
+};
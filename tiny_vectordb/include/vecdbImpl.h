@@ -2,63 +2,331 @@
 
 #include "common.h"
 #include "pybind11/pytypes.h"
+#include "pybind11/numpy.h"
 #include "b64enc.h"
+#include "ivfIndex.hpp"
+#include "hnswIndex.hpp"
+#include "quantizedStorage.hpp"
+#include "pqIndex.hpp"
+#include "rowAttributes.hpp"
+#include <optional>
 #include <string>
 #include <vector>
+#include <cstring>
+#include <unordered_map>
+#include <unordered_set>
+#include <shared_mutex>
 
 namespace py = pybind11;
 
+// restricts a search to the rows matching all the given criteria
+struct SearchFilter{
+    std::optional<StringVector> ids;            // allowed ids
+    std::optional<std::string> prefix;          // id prefix
+    // the attribute of each key is one of the values
+    std::unordered_map<std::string, std::vector<Attribute>> where;
+    // one byte per row in the order of getAllIds, non-zero if allowed
+    std::optional<std::string> mask;
+};
+
 template <typename NumT>
 class VectorCollectionImpl{
 public:
-    VectorCollectionImpl();
+    // dim should be FEAT_DIM, unless the module is built with a runtime dimension (FEAT_DIM = Eigen::Dynamic)
+    VectorCollectionImpl(int dim = FEAT_DIM);
     ~VectorCollectionImpl();
-    static const int dim = FEAT_DIM;
+    const int dim;
     int size();
+    int capacity();
+    // approximate bytes held in memory: the rows (mapped or not), their norms, the quantized rows and the indexes
+    size_t memoryBytes();
+    // pre-allocate memory for at least n vectors
+    void reserve(int n);
 
     // add vectors to the collection, addBulk will log modification
     // addRaw will not log modification, and will not check id duplication
     void addBulk(StringVector ids, const std::vector<std::vector<NumT>> vectors);
+    // the *Buffer methods take any C-contiguous float32 buffer (numpy array, memoryview...) of shape (n, dim), 
+    // the data is read in place without conversion
+    void addBulkBuffer(StringVector ids, py::buffer vectors);
     void addRawEncBulk(StringVector ids, const std::vector<std::string> enc_vectors);
+    // add vectors encoded by VectorBinaryEncode, i.e. the BLOBs in the database, 
+    // decoded in place into the reserved rows, call reserve first when loading in chunks
+    void addRawBinBulk(StringVector ids, const std::vector<std::string> bin_vectors);
     void addRawBulk(StringVector ids, const std::vector<std::vector<NumT>> vectors);
+    // add rows from their quantized BLOBs (see QuantizedStorage), or their saved pq rows if the rows are stored as pq codes, 
+    // when the float32 rows are not kept, 
+    // return the ids that are not added as their BLOBs are empty or of another dtype, to be added by addRawBinBulk
+    StringVector addRawQuantizedBulk(StringVector ids, const std::vector<std::string> blobs);
+
+    // use external memory (e.g. a copy-on-write mapping of a segment file) as the storage of an empty collection, 
+    // vectors: writable float32 buffer of shape (capacity, dim), norms: writable float32 buffer of shape (capacity, ), 
+    // the first ids.size() rows are occupied, the rest is spare capacity for added vectors, 
+    // the buffers are read and modified in place and must be kept alive by the caller, 
+    // they are only copied into vector_chunk when the capacity is exceeded, 
+    // quantized: the saved quantized BLOB of each id, or an empty one, if the dtype is quantized, 
+    // the rows without a BLOB of the dtype are quantized from the buffer, and their ids are returned to save the BLOBs
+    StringVector mapBuffer(StringVector ids, py::buffer vectors, py::buffer norms, const std::vector<std::string>& quantized);
+    bool isMapped();
 
     // set will add the vector if the id does not exist, otherwise update the vector
     void setBulk(StringVector ids, const std::vector<std::vector<NumT>> vectors);
+    void setBulkBuffer(StringVector ids, py::buffer vectors);
 
-    inline bool has(const std::string& id);
-    inline bool update(const std::string& id, const std::vector<NumT> vec);
-    inline std::vector<NumT> get(const std::string& id);
+    bool has(const std::string& id);
+    bool update(const std::string& id, const std::vector<NumT> vec);
+    // the vectors are approximate if the float32 rows are not kept, except the ones changed since the last flush
+    std::vector<NumT> get(const std::string& id);
     std::vector<std::vector<NumT>> getBulk(const StringVector& id);
+    // return a numpy array of shape (n, dim), raise error if any id not exists
+    py::array_t<NumT> getBulkArray(const StringVector& ids);
     StringVector getAllIds();
 
+    // deletion does not keep the order of the remaining vectors, 
+    // the last vectors are moved into the deleted positions
     void deleteBulk(const StringVector& ids);
     // void removeBulk(const StringVector& ids);
 
-    // return the topk ids and scores
-    py::tuple search(const std::vector<NumT>& query, int topk = -1);
+    // number of threads used for searching
+    void setNumThreads(int n);
+    int getNumThreads();
+
+    // return the topk ids and scores, 
+    // the rows are split into ranges searched by multiple threads if the collection is large, 
+    // index: "flat", "ivf", "hnsw" or "pq" to choose the search engine, 
+    // or empty for the hnsw index if built, then the ivf index, then the pq index if trained, otherwise flat
+    // filter: only the allowed rows are selected, nullptr for all rows, 
+    // if a few rows are allowed, they are scored directly whatever the index
+    std::tuple<StringVector, std::vector<float>> search(
+        const std::vector<NumT>& query, int topk = -1, const std::string& index = "", const SearchFilter* filter = nullptr
+        );
+    std::tuple<StringVector, std::vector<float>> searchBuffer(
+        py::buffer query, int topk = -1, const std::string& index = "", const SearchFilter* filter = nullptr
+        );
+    // search multiple queries at once, return ([ids1, ids2, ...], [scores1, scores2, ...])
+    std::tuple<std::vector<StringVector>, std::vector<std::vector<float>>> searchBatch(
+        const std::vector<std::vector<NumT>>& queries, int topk = -1, const std::string& index = "", const SearchFilter* filter = nullptr
+        );
+    std::tuple<std::vector<StringVector>, std::vector<std::vector<float>>> searchBatchBuffer(
+        py::buffer queries, int topk = -1, const std::string& index = "", const SearchFilter* filter = nullptr
+        );
     std::vector<float> score(const std::vector<NumT>& query);
 
+    // optional per-row attributes used by search filters, None, an integer or a string for each key, 
+    // removed with the row
+    void setAttributes(const std::string& key, const StringVector& ids, const std::vector<Attribute>& values);
+    std::vector<Attribute> getAttributes(const std::string& key, const StringVector& ids);
+    StringVector attributeKeys();
+
+    // optional product quantization index for approximate search, 
+    // the rows are encoded as n_sub bytes, the top (topk * rerank) candidates are re-ranked on the float32 rows, 
+    // once trained, it is maintained on every modification
+    void trainPQ(int n_sub, int n_iter = 10);
+    void dropPQ();
+    bool isPQTrained();
+    // return (ids, codebooks, n_sub, rows), rows are the saved rows (see PQIndex::encodeRow) in the order of ids, for saving the index, 
+    // only the rows of the given ids that exist if ids is given, e.g. the changed ones
+    std::tuple<StringVector, py::array_t<float>, int, py::list> dumpPQ(const std::optional<StringVector>& ids);
+    // restore a saved index, ids that are not in the saved index are encoded with the codebooks, 
+    // with no ids on an empty collection, only the codebooks are restored, to add the saved rows by addRawQuantizedBulk
+    void loadPQ(const StringVector& ids, py::buffer codebooks, int n_sub, const std::vector<std::string>& rows);
+
+    // similarity metric of all searches: "cosine" (default), "ip" (inner product) or "l2" (negative squared distance), 
+    // the hnsw and pq indexes find their candidates by angle, which are re-scored with the metric, 
+    // so they are only exact for normalized vectors with other metrics
+    void setMetric(const std::string& name);
+    std::string getMetric();
+
+    // dtype of the rows scored by a flat search: "float32", or "float16" / "int8" for a quantized copy of the rows, 
+    // the top (topk * rerank) candidates of the quantized scores are re-ranked on the float32 rows, 
+    // no re-ranking if rerank is 0, then the scores are approximate, 
+    // cannot be changed once the float32 rows are dropped
+    void setDtype(const std::string& dtype);
+    std::string getDtype();
+    void setRerank(int n);
+    int getRerank();
+    // bytes of the quantized rows
+    size_t quantizedBytes();
+    // return (ids, BLOBs) of the quantized rows of the given ids that exist, for saving them
+    std::tuple<StringVector, py::list> dumpQuantized(const StringVector& ids);
+
+    // drop the float32 rows and only keep the quantized ones (and the norms of the float32 rows), 
+    // requires a quantized dtype, or a trained pq index, whose codes then store the rows and which can no longer be trained or dropped, 
+    // then every search scores the quantized rows and returns the top (topk * rerank) candidates with approximate scores, 
+    // which should be re-ranked by the caller with the float32 vectors saved on disk, 
+    // the vectors changed since the last flush are kept until they are flushed, see getPending, 
+    // the float32 rows can only be kept again when the collection is empty
+    void setKeepRows(bool keep);
+    bool getKeepRows();
+    // return (ids, vectors) of the given ids that are changed since the last flush when the float32 rows are not kept, 
+    // i.e. the exact vectors that are not on disk yet
+    std::tuple<StringVector, py::array_t<NumT>> getPending(const StringVector& ids);
+
+    // optional IVF index for approximate search, 
+    // once trained, it is maintained on every modification and used by search and searchBatch
+    void trainIndex(int n_lists, int n_iter = 10);
+    void dropIndex();
+    bool isIndexTrained();
+    // number of lists to probe in a search, exhaustive search if not less than the number of lists
+    void setNprobe(int n);
+    int getNprobe();
+    // return (ids, centroids, lists), the list of each id, for saving the index, 
+    // only the lists of the given ids that exist if ids is given, e.g. the changed ones
+    std::tuple<StringVector, py::array_t<NumT>, std::vector<int>> dumpIndex(const std::optional<StringVector>& ids);
+    // restore a saved index, ids that are not in the saved index are assigned to their nearest lists
+    void loadIndex(const StringVector& ids, py::buffer centroids, const std::vector<int>& lists);
+
+    // optional HNSW graph index for approximate search, 
+    // once built, every added or updated vector is linked into the graph, the nodes of the deleted vectors are reused, 
+    // and the graph is rebuilt when the free nodes outnumber the live ones
+    void buildHNSW(int M = 16, int ef_construction = 200);
+    void dropHNSW();
+    bool hasHNSW();
+    // size of the beam in a search, the larger the more accurate and slower
+    void setEfSearch(int ef);
+    int getEfSearch();
+    // {M, ef_construction, entry, max_level, n_nodes, n_deleted}
+    py::dict hnswInfo();
+    // nodes changed since the last dump, or all nodes, for saving the graph, 
+    // [(node, id or None if freed, level, links), ...], links are raw bytes of int32 arrays
+    py::list dumpHNSW(bool all);
+    // restore a graph saved by dumpHNSW, nodes should be sorted and complete, 
+    // the vectors of the nodes are taken from the collection
+    void loadHNSW(
+        int M, int ef_construction, int entry, int max_level, 
+        const std::vector<std::tuple<int, std::optional<std::string>, int, std::string>>& nodes
+        );
+
     // return the gathered modifications in python dict and set mod_map to empty
+    // the GIL is released while gathering
     // the python dict is in the form of 
-    // {update / add: ([id1, id2, ...], [vector1, vector2, ...]) }
+    // {update / add: ([id1, id2, ...], [vector1, vector2, ...]) }, vectors encoded as bytes by VectorBinaryEncode
     // or {delete: ([id1, id2, ...], )}
     // the actual disk IO will be done in python
     py::dict flush();
+    // merge the modifications returned by a flush back into mod_map, if they failed to be written to disk, 
+    // they are older than the ones logged since the flush, 
+    // the vectors are taken back as the pending vectors if the float32 rows are not kept
+    void restoreModifications(
+        const StringVector& add_ids, const std::vector<std::string>& add_values, 
+        const StringVector& update_ids, const std::vector<std::string>& update_values, const StringVector& delete_ids
+        );
 
     void print();
 private:
-    // identifiers and vector_chunk should have the same size
-    // these two variables are used to store the data
+    // reader/writer lock, 
+    // public methods take a shared lock for reading or a unique lock for writing, 
+    // and the *NoLock methods are for internal use by the methods already holding the lock
+    std::shared_mutex rw_mtx_;
+    void reserveNoLock(int n);
+    void addBulkNoLock(const StringVector& ids, const MatrixFCRef& vectors);
+    void addRawBulkNoLock(const StringVector& ids, const MatrixFCRef& vectors);
+    void setBulkNoLock(const StringVector& ids, const MatrixFCRef& vectors);
+    bool hasNoLock(const std::string& id);
+    bool updateNoLock(const std::string& id, const RowFCRef& vec);
+    std::vector<NumT> getNoLock(const std::string& id);
+    std::tuple<StringVector, std::vector<float>> searchNoLock(
+        const Eigen::Vector<NumT, FEAT_DIM>& query, int topk, const std::string& index, const SearchFilter* filter
+        );
+    std::tuple<std::vector<StringVector>, std::vector<std::vector<float>>> searchBatchNoLock(
+        const MatrixFCRef& queries, int topk, const std::string& index, const SearchFilter* filter
+        );
+
+    // the occupied rows and their norms, in vector_chunk or in the mapped buffers, 
+    // no rows if the float32 rows are not kept
+    Eigen::Map<const MatrixF> rowsNoLock();
+    Eigen::Map<const Eigen::Vector<float, Eigen::Dynamic>> normsNoLock();
+    // all rows (up to the capacity) and their norms, to be modified, in vector_chunk or in the mapped buffers
+    Eigen::Map<MatrixF> chunkNoLock();
+    Eigen::Map<Eigen::Vector<float, Eigen::Dynamic>> chunkNormsNoLock();
+    int capacityNoLock();
+    // copy the mapped buffers into vector_chunk, when the capacity of the mapped buffers is exceeded
+    void materializeNoLock();
+    // the given ids that exist and their rows, or all ids and rows if ids is not given
+    std::pair<StringVector, std::vector<int>> existingRowsNoLock(const std::optional<StringVector>& ids);
+
+    // false if only the quantized rows are kept, see setKeepRows
+    bool keep_rows_;
+    // the exact vectors of the ids added or updated since the last flush, if the float32 rows are not kept
+    std::unordered_map<std::string, std::vector<NumT>> pending_;
+    // whether the rows are stored as the codes of the pq index, i.e. not kept without a quantized dtype
+    bool pqStorageNoLock();
+    // the float32 vector of a row, or the one decoded from the quantized row or the pq codes if the float32 rows are not kept
+    Eigen::Matrix<NumT, 1, FEAT_DIM> rowVectorNoLock(int row);
+    // the dot product of the decoded row with the query, if the float32 rows are not kept
+    float approxDotNoLock(int row, const RowFCRef& query);
+    // all rows as rowVectorNoLock, decoded into a temporary matrix if the float32 rows are not kept, e.g. for training
+    MatrixF decodedRowsNoLock();
+    // top-k of the listed rows, scored on the decoded rows
+    std::vector<std::pair<float, int>> approxTopKRowsNoLock(const Eigen::Vector<NumT, FEAT_DIM>& query, const std::vector<int>& rows, int k);
+
+    // identifiers and the first n_rows rows of vector_chunk should have the same size
+    // these two variables are used to store the data,
+    // vector_chunk may have more rows than n_rows (the capacity), to amortize re-allocation on add, 
+    // vector_chunk is empty if the float32 rows are not kept, and vector_norms still has the capacity
     StringVector* identifiers;
     MatrixF* vector_chunk;
+    int n_rows;
+    static constexpr float growth_factor = 1.5;
+
+    int n_threads;
+
+    IVFIndex* ivf_index;
+    int nprobe;
+    HNSWIndex* hnsw_index;      // nullptr if not built
+    int ef_search;
+    // the rows read by the graph, built per call as the buffers move on modification
+    HNSWSpace hnswSpaceNoLock();
+    void rebuildHNSWNoLock(int M, int ef_construction);
+    PQIndex* pq_index;
+    enum class SearchEngine{ FLAT, IVF, HNSW, PQ };
+    SearchEngine selectEngineNoLock(const std::string& index);
+    QuantizedStorage* quantized;
+    int rerank;
+    SearchAlgorithm::Metric metric;
+    // number of candidates to re-rank for topk results
+    int nCandidatesNoLock(int topk);
+    // whether a flat search of topk should score the quantized rows
+    bool useQuantizedNoLock(int topk);
+    // re-score the candidates on the float32 rows with the metric and keep the topk, 
+    // skipped if rerank is 0, unless forced because the candidates are not scored with the metric, 
+    // if the float32 rows are not kept, all candidates are kept for the caller, re-scored on the quantized rows if forced
+    void rerankNoLock(const Eigen::Vector<NumT, FEAT_DIM>& query, std::vector<std::pair<float, int>>& candidates, int topk, bool force = false);
+    RowAttributes* attributes;
+    // the rows allowed by a search filter
+    struct RowFilter{
+        std::vector<uint8_t> mask;      // (n_rows, ), empty if all rows are allowed
+        int n_allowed;
+        // if less than 1 / SPARSE_FILTER_RATIO of the rows are allowed, they are listed and scored directly
+        bool sparse;
+        std::vector<int> rows;
+        const uint8_t* maskData() const { return mask.empty() ? nullptr : mask.data(); }
+    };
+    static const int SPARSE_FILTER_RATIO = 16;
+    RowFilter rowFilterNoLock(const SearchFilter* filter);
+    // top-k of a single query with the engine, among the rows allowed by the filter
+    std::vector<std::pair<float, int>> searchTopKNoLock(
+        const Eigen::Vector<NumT, FEAT_DIM>& query, int topk, SearchEngine engine, const RowFilter& filter, int n_threads_
+        );
+    std::vector<std::pair<float, int>> hnswSearchNoLock(const Eigen::Vector<NumT, FEAT_DIM>& query, int topk, const RowFilter& filter);
+
+    // cached l2 norm of each row in vector_chunk, maintained on every modification
+    // so that searching does not need to go through the whole chunk twice
+    Eigen::Vector<float, Eigen::Dynamic>* vector_norms;
+
+    // external storage set by mapBuffer, nullptr if the data is in vector_chunk
+    NumT* mapped_vectors_;
+    float* mapped_norms_;
+    int mapped_capacity_;
 
     // id2idx_ is used to store the mapping from id to index for fast retrieval
-    std::map<std::string, int> id2idx_;
+    // hash map, for O(1) lookup, reserved together with vector_chunk
+    std::unordered_map<std::string, int> id2idx_;
     void reIndex();
 
     // mod_map is used to store the modification of the vector collection
     // the modification will be applied to the vector collection when flush() is called
-    std::map<std::string, ModificaionType> mod_map;
+    std::unordered_map<std::string, ModificaionType> mod_map;
 
     // DiskIOVirtual *diskIO;
 };
@@ -82,4 +350,40 @@ namespace VectorStringEncode {
         std::vector<NumT> vec((NumT*)vec_uchar.data(), (NumT*)vec_uchar.data() + vec_uchar.size() / sizeof(NumT));
         return vec;
     }
-}
\ No newline at end of file
+}
+
+// on-disk format, raw bytes of the vector in native byte order (little-endian on supported platforms), 
+// stored as BLOB in sqlite, same as the bytes wrapped by VectorStringEncode without the base64 layer
+namespace VectorBinaryEncode {
+    template <typename NumT>
+    inline std::string encode(const NumT* data, int size){
+        return std::string((const char*)data, (const char*)data + size * sizeof(NumT));
+    }
+
+    template <typename NumT>
+    inline void decodeTo(const std::string& encoded, NumT* dst, int size){
+        if (encoded.size() != size * sizeof(NumT)){
+            throw std::runtime_error("invalid encoded bytes, expect " + 
+                std::to_string(size * sizeof(NumT)) + " bytes, got " + std::to_string(encoded.size())
+                );
+        }
+        std::memcpy(dst, encoded.data(), encoded.size());
+    }
+}
+
+// on-disk format of a quantized row, stored as BLOB in sqlite next to the float32 vector, 
+// [uint8 type][float32 norm][int8 only: float32 scale][codes], see QuantizedStorage
+namespace VectorQuantizedEncode {
+    template <typename NumT>
+    inline std::string encode(const std::vector<NumT>& vec, const std::string& dtype){
+        if (vec.empty() || (FEAT_DIM != Eigen::Dynamic && vec.size() != FEAT_DIM)){
+            throw std::runtime_error("vector size not match");
+        }
+        return QuantizedStorage::encodeVector(Eigen::Map<const Eigen::Matrix<NumT, 1, FEAT_DIM>>(vec.data(), vec.size()), QuantizedStorage::parseType(dtype));
+    }
+
+    template <typename NumT>
+    inline std::vector<NumT> decode(const std::string& encoded){
+        return QuantizedStorage::decodeVector(encoded);
+    }
+}
@@ -1,14 +1,25 @@
+from __future__ import annotations
 
 # https://ninja-build.org/manual.html
 from ninja import ninja_syntax
 import pybind11
-import os, sysconfig, subprocess, platform, sys, dataclasses, time
-from .config import CACHE_DIR, SRC_DIR, HEADER_DIR, BUILD_DIR, BIN_DIR
-from .jit_utils import initEigenSrc, checkCommandExists
+from typing import TYPE_CHECKING, Optional, Iterable
+from types import ModuleType
+import os, sysconfig, subprocess, platform, sys, dataclasses, shutil, hashlib, functools
+import importlib.util
+from .config import CACHE_DIR, SRC_DIR, HEADER_DIR, BUILD_DIR, BIN_DIR, PREBUILT_DIRS
+from .jit_utils import initEigenSrc, checkCommandExists, autoCompileConfig, FileLock, installFile
+if TYPE_CHECKING:
+    from .wrap import CompileConfig
 
 eigen_version = "3.4.0"
-eigen_src_path = os.path.join(CACHE_DIR, f"eigen{eigen_version}")
+# an existing Eigen source tree can be given to build without network access
+eigen_src_path = os.getenv("TVDB_EIGEN_DIR", os.path.join(CACHE_DIR, f"eigen{eigen_version}"))
 ensureEigen = lambda : initEigenSrc(eigen_src_path, eigen_version)
+# the dimensions built by `python -m tiny_vectordb build` if none is given
+AOT_DIMS = [128, 256, 384, 512, 768, 1024, 1536]
+# "dimension" of the module built with FEAT_DIM = Eigen::Dynamic, which serves collections of any dimension
+RUNTIME_DIM = -1
 
 
 @dataclasses.dataclass(frozen=True)
@@ -18,51 +29,70 @@ class PlatformBasicConfig:
     obj_suffix = ".obj" if platform.system() == "Windows" else ".o"
     py_includes = sysconfig.get_config_var('INCLUDEPY')
 
-def _getPathToThisCompile(m_name: str):
-    # m_name: module name
-    return {
-        "bin": os.path.join(BIN_DIR, m_name),
-        "scripts": os.path.join(BUILD_DIR, "scripts_"+ m_name),
-        "lib": os.path.join(BIN_DIR, "lib"),
-    }
+@functools.lru_cache(maxsize=None)
+def _sourceDigest() -> str:
+    h = hashlib.sha256()
+    for _d in [SRC_DIR, HEADER_DIR]:
+        for _f in sorted(os.listdir(_d)):
+            h.update(_f.encode())
+            with open(os.path.join(_d, _f), "rb") as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+@functools.lru_cache(maxsize=None)
+def _compilerVersion(cxx: str) -> str:
+    try:
+        return subprocess.check_output([cxx, "--version"], stderr=subprocess.STDOUT).decode(errors="replace")
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+@functools.lru_cache(maxsize=None)
+def _nativeTarget() -> str:
+    """ Identity of the CPU, for the modules built with -march=native """
+    if os.path.exists("/proc/cpuinfo"):
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith(("flags", "Features")):
+                    return line
+    return platform.machine() + platform.processor()
+
+def _cacheKey(
+        feat_dim: int, 
+        cxx: str, 
+        additional_compile_flags: list[str], 
+        additional_link_flags: list[str]
+        ) -> str:
+    """
+    Content hash of everything the module depends on, 
+    i.e. the sources, the compiler, the flags, Eigen and Python, and the CPU if the flags target the native one, 
+    so that a module is never reused with other inputs
+    """
+    h = hashlib.sha256()
+    for part in [
+        _get_module_name(feat_dim), _sourceDigest(), cxx, _compilerVersion(cxx), 
+        " ".join(additional_compile_flags), " ".join(additional_link_flags), 
+        eigen_version, PlatformBasicConfig.ext_suffix, pybind11.__version__, 
+        _nativeTarget() if any("native" in _f for _f in additional_compile_flags) else "", 
+        ]:
+        h.update(part.encode())
+        h.update(b"\0")
+    return h.hexdigest()[:16]
 
 def _writeNinja(
         feat_dim: int, 
+        script_dir: str, 
+        built_file: str, 
         cxx = "g++", 
         additional_compile_flags = [],
         additional_link_flags = []
         ):
+    """ Write build.ninja into script_dir, which builds the module into built_file """
     if not checkCommandExists(cxx):
         raise RuntimeError(f"{cxx} not found.")
 
     module_name = _get_module_name(feat_dim)
-    __path = _getPathToThisCompile(module_name)
-    script_dir = __path["scripts"]
-    bin_dir = __path["bin"]
-    lib_dir = __path["lib"]
-
     ninja_build_file = os.path.join(script_dir, "build.ninja")
-    for _d in [bin_dir, lib_dir, script_dir]:
-        if not os.path.exists(_d):
-            os.makedirs(_d, exist_ok=True)
-    
-    __lock_file = os.path.join(script_dir, "writing.lock")
-    __wait_time = 0
-    __reuse = False
-    while os.path.exists(__lock_file):
-        __wait_time += 0.1
-        __reuse = True  # if the lock file exists, it means the module is being built by another process
-        time.sleep(0.1)
-        if __wait_time > 3:
-            raise RuntimeError(
-                "Waiting for lock file timeout. Please check if there is another build process running.\n"
-                "If not, please remove the lock file at '{}' manually.".format(__lock_file)
-                )
-    if __reuse:
-        # should be written by another concurrent process
-        return module_name, script_dir, bin_dir
-
-    open(__lock_file, "w").close()
+    os.makedirs(script_dir, exist_ok=True)
     with open(ninja_build_file, "w") as build_file:
         writer = ninja_syntax.Writer(build_file)
         writer.comment("This file is generated by build.py")
@@ -85,6 +115,7 @@ def _writeNinja(
                 "-DNDEBUG",
                 "-O2",
                 "-funroll-loops",
+                "-pthread",
             ] + additional_compile_flags
 
             if platform.system() == "Windows":
@@ -95,6 +126,7 @@ def _writeNinja(
             link_flags = [
                 "-shared",
                 "-lstdc++",
+                "-pthread",
                 # "-static"
             ] + additional_link_flags
             if platform.system() == "Darwin":
@@ -106,14 +138,13 @@ def _writeNinja(
 
             writer.rule("compile", "$CXX -MMD -MF $out.d $CXX_FLAGS $in -c -o $out", depfile="$out.d", description="compile $out")
             for _m in to_compile:
-                writer.build(os.path.join(bin_dir, f"{_m}{feat_dim}{PlatformBasicConfig.obj_suffix}"), "compile", os.path.join(SRC_DIR, f"{_m}.cpp"))
+                writer.build(os.path.join(script_dir, f"{_m}{PlatformBasicConfig.obj_suffix}"), "compile", os.path.join(SRC_DIR, f"{_m}.cpp"))
             for _m in to_compile_lib:
-                writer.build(os.path.join(lib_dir, f"{_m}{PlatformBasicConfig.obj_suffix}"), "compile", os.path.join(SRC_DIR, f"{_m}.cpp"))
+                writer.build(os.path.join(script_dir, f"{_m}{PlatformBasicConfig.obj_suffix}"), "compile", os.path.join(SRC_DIR, f"{_m}.cpp"))
             
             writer.rule("link", "$CXX $LINK_FLAGS $in -o $out", description="link $out")
-            writer.build(os.path.join(bin_dir, f"{module_name}{PlatformBasicConfig.ext_suffix}"), "link", \
-                            [os.path.join(bin_dir, f"{_m}{feat_dim}{PlatformBasicConfig.obj_suffix}") for _m in to_compile] + \
-                            [os.path.join(lib_dir, f"{_m}{PlatformBasicConfig.obj_suffix}") for _m in to_compile_lib])
+            writer.build(built_file, "link", \
+                            [os.path.join(script_dir, f"{_m}{PlatformBasicConfig.obj_suffix}") for _m in to_compile + to_compile_lib])
         
         elif cxx == "cl" and platform.system() == "Windows":
             # TODO: to be implemented...
@@ -121,75 +152,126 @@ def _writeNinja(
 
         else:
             raise NotImplementedError(f"Unsupported compiler: {cxx} in {platform.system()}")
-    os.remove(__lock_file)
-        
-    return module_name, script_dir, bin_dir
 
 def _get_module_name(feat_dim):
-    return f"vecdbImpl{feat_dim}"
+    return "vecdbImplDyn" if feat_dim == RUNTIME_DIM else f"vecdbImpl{feat_dim}"
+
+def _getModuleFile(bin_dir: str, feat_dim: int) -> str:
+    m_name = _get_module_name(feat_dim)
+    return os.path.join(bin_dir, m_name, f"{m_name}{PlatformBasicConfig.ext_suffix}")
 
 def compile(
         feat_dim, 
         quite = False, 
         cxx: str = "g++",
         additional_compile_flags = [],
-        additional_link_flags = []
+        additional_link_flags = [], 
+        force = False
         ) -> str:
-    
-    if not os.getenv("TVDB_FORCE_COMPILE", False):
-        # if the module is already compiled, return the module name
-        _m_name = _get_module_name(feat_dim)
-        _bin_dir = _getPathToThisCompile(_m_name)["bin"]
-        _aim_file = os.path.join(_bin_dir, f"{_m_name}{PlatformBasicConfig.ext_suffix}")
-        if os.path.exists(_aim_file):
-            return f"{_bin_dir}.{_m_name}".split(os.path.sep)[-1]
-
-    # else, compile the module, 
-    module_name, script_dir, bin_dir = _writeNinja(
-        feat_dim, 
-        cxx=cxx, 
-        additional_compile_flags=additional_compile_flags, 
-        additional_link_flags=additional_link_flags
-        )
-
-    def print_(*args, **kwargs):
-        if not quite:
-            print(*args, **kwargs)
-    SP_STDOUT = subprocess.DEVNULL if quite else sys.stdout
-
-    print_("\033[1;30m", end="\r")
-    print_("----------------------------------------")
-
-    subprocess.check_call(["ninja", "-t", "commands"], cwd = script_dir, stdout=SP_STDOUT)
-    print_("----------------------------------------")
-
-    __buid_lock = os.path.join(script_dir, "building.lock")
-    _sleep_time = 0
-    _reuse = False
-    while os.path.exists(__buid_lock):
-        time.sleep(0.1)
-        _reuse = True   # if the lock file exists, it means the module is being built by another process
-        _sleep_time += 0.1
-        if _sleep_time > 10:
-            raise RuntimeError(
-                "Waiting for building timeout. Please check if there is another build process running.\n"
-                "If not, please remove the lock file at '{}' manually.".format(__buid_lock)
-                )
-    if _reuse and os.path.exists(os.path.join(bin_dir, f"{module_name}{PlatformBasicConfig.ext_suffix}")):
-        # return without building it again
-        return f"{bin_dir}.{module_name}".split(os.path.sep)[-1]
-
-    open(__buid_lock, "w").close()
-    try:
+    """
+    Build the module of the dimension if it is not in the cache, return the path of the module. 
+    The modules are cached under BIN_DIR by the content hash of their inputs (see _cacheKey). 
+    Concurrent processes building the same module wait on an OS file lock, which is released if its holder dies, 
+    the module is built in a private directory, then moved into the cache with an atomic rename, 
+    so that it is either absent or complete for any reader.
+    """
+    key = _cacheKey(feat_dim, cxx, additional_compile_flags, additional_link_flags)
+    m_file = _getModuleFile(os.path.join(BIN_DIR, key), feat_dim)
+    force = force or bool(os.getenv("TVDB_FORCE_COMPILE", False))
+    if not force and os.path.exists(m_file):
+        return m_file
+
+    ensureEigen()
+    with FileLock(os.path.join(BUILD_DIR, f"{key}.lock")):
+        if not force and os.path.exists(m_file):
+            # built by another process while waiting for the lock
+            return m_file
+
+        script_dir = os.path.join(BUILD_DIR, f"scripts_{_get_module_name(feat_dim)}_{key}")
+        built_file = os.path.join(script_dir, os.path.basename(m_file))
+        _writeNinja(
+            feat_dim, script_dir, built_file, 
+            cxx=cxx, 
+            additional_compile_flags=additional_compile_flags, 
+            additional_link_flags=additional_link_flags
+            )
+
+        def print_(*args, **kwargs):
+            if not quite:
+                print(*args, **kwargs)
+        SP_STDOUT = subprocess.DEVNULL if quite else sys.stdout
+
+        print_("\033[1;30m", end="\r")
+        print_("----------------------------------------")
+        subprocess.check_call(["ninja", "-t", "commands"], cwd = script_dir, stdout=SP_STDOUT)
+        print_("----------------------------------------")
+
         subprocess.check_call("ninja", cwd = script_dir, stdout=SP_STDOUT)
-    except subprocess.CalledProcessError as e:
-        raise e
-    finally:
-        os.remove(__buid_lock)
+        with open(os.path.join(script_dir, "compile_commands.json"), "w") as f:
+            # ninja -t compdb > compile_commands.json
+            subprocess.check_call(["ninja", "-t", "compdb"], cwd = script_dir, stdout=f, stderr=SP_STDOUT)
+        installFile(built_file, m_file)
+        print_("\033[0m", end="\r")
+    return m_file
 
-    with open(os.path.join(script_dir, "compile_commands.json"), "w") as f:
-        # ninja -t compdb > compile_commands.json
-        subprocess.check_call(["ninja", "-t", "compdb"], cwd = script_dir, stdout=f, stderr=SP_STDOUT)
+def findModule(feat_dim: int, compile_config: Optional[CompileConfig] = None) -> Optional[str]:
+    """
+    Path to the built module of the dimension, the prebuilt directories are searched before the cache, 
+    the cache is looked up with compile_config (auto-detected if not given, skipped if no compiler is found), 
+    None if the module is not built
+    """
+    for _d in PREBUILT_DIRS:
+        _f = _getModuleFile(_d, feat_dim)
+        if os.path.exists(_f):
+            return _f
+    if compile_config is None:
+        try:
+            compile_config = autoCompileConfig()
+        except RuntimeError:
+            return None
+    key = _cacheKey(feat_dim, **compile_config)
+    _f = _getModuleFile(os.path.join(BIN_DIR, key), feat_dim)
+    return _f if os.path.exists(_f) else None
 
-    print_("\033[0m", end="\r")
-    return f"{bin_dir}.{module_name}".split(os.path.sep)[-1]
\ No newline at end of file
+def load(feat_dim: int, quite = False, compile_config: Optional[CompileConfig] = None) -> ModuleType:
+    """
+    Import the module of the dimension, compile it if not built (or TVDB_FORCE_COMPILE is set), 
+    the compiler is only needed when compiling
+    """
+    m_name = _get_module_name(feat_dim)
+    if m_name in sys.modules:
+        return sys.modules[m_name]
+    m_file = None if os.getenv("TVDB_FORCE_COMPILE", False) else findModule(feat_dim, compile_config)
+    if m_file is None:
+        m_file = compile(feat_dim, quite = quite, **(compile_config or autoCompileConfig()))
+    spec = importlib.util.spec_from_file_location(m_name, m_file)
+    assert spec is not None and spec.loader is not None
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    sys.modules[m_name] = module
+    return module
+
+def build(
+        feat_dims: Iterable[int] = AOT_DIMS, 
+        out_dir: Optional[str] = None, 
+        quite = False, 
+        compile_config: Optional[CompileConfig] = None
+        ) -> list[str]:
+    """
+    Build the modules of the dimensions ahead of time, return the paths of the modules, 
+    the runtime-dimension module can be built with RUNTIME_DIM, 
+    if out_dir is given, the modules are also copied into it, 
+    the directory is relocatable and can be used with TVDB_PREBUILT_DIR on machines without a compiler, 
+    the modules should be built without -march=native if the machines have different CPUs
+    """
+    if compile_config is None:
+        compile_config = autoCompileConfig()
+    ret = []
+    for feat_dim in feat_dims:
+        m_file = compile(feat_dim, quite = quite, **compile_config)
+        if out_dir is not None:
+            dst = _getModuleFile(out_dir, feat_dim)
+            installFile(m_file, dst)
+            m_file = dst
+        ret.append(m_file)
+    return ret
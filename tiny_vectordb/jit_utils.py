@@ -1,5 +1,5 @@
 from __future__ import annotations
-import os, subprocess, platform, time, random
+import os, subprocess, platform, shutil
 from typing import TYPE_CHECKING
 from .config import CACHE_DIR
 if TYPE_CHECKING:
@@ -10,32 +10,70 @@ def checkCommandExists(cmd: str) -> bool:
         return subprocess.call(["where", cmd], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
     return subprocess.call(["which", cmd], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
 
+class FileLock:
+    """
+    Exclusive advisory lock on a file, blocks until acquired, 
+    the OS releases it when the holder exits or crashes, so it never goes stale
+    """
+    def __init__(self, path: str):
+        self.path = path
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._f = open(self.path, "a+")
+        if platform.system() == "Windows":
+            import msvcrt
+            while True:
+                try:
+                    # LK_LOCK gives up after 10 attempts, retry until acquired
+                    msvcrt.locking(self._f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+        else:
+            import fcntl
+            fcntl.flock(self._f.fileno(), fcntl.LOCK_EX)
+        return self
+    def __exit__(self, *_):
+        if platform.system() == "Windows":
+            import msvcrt
+            self._f.seek(0)
+            msvcrt.locking(self._f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(self._f.fileno(), fcntl.LOCK_UN)
+        self._f.close()
 
-def initEigenSrc(eigen_src_path: str, eigen_version: str = "3.4.0"):
-    if not os.path.exists(eigen_src_path):
-        os.makedirs(eigen_src_path)
-
-    __downloading_lock_file = os.path.join(CACHE_DIR, "downloading.lock")
-    while os.path.exists(__downloading_lock_file):
-        print(f"Find lock file [{__downloading_lock_file}], waiting...")
-        time.sleep(random.random() * 1 + 1)     # wait for 1~2 seconds, avoid resource competition
+def installFile(src: str, dst: str):
+    """ Copy src to dst with an atomic rename, so that dst is either the old or the complete new file """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = f"{dst}.tmp{os.getpid()}"
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
 
-    if os.listdir(eigen_src_path) == [] or \
-        not os.path.exists(os.path.join(eigen_src_path, "Eigen", "src", "Core")):
+def initEigenSrc(eigen_src_path: str, eigen_version: str = "3.4.0"):
+    ready = lambda: os.path.exists(os.path.join(eigen_src_path, "Eigen", "src", "Core"))
+    if ready():
+        return
+    with FileLock(os.path.join(CACHE_DIR, "downloading.lock")):
+        if ready():
+            # downloaded by another process while waiting for the lock
+            return
+        if os.path.exists(eigen_src_path) and os.listdir(eigen_src_path):
+            raise RuntimeError(f"'{eigen_src_path}' is not empty but does not contain Eigen, please remove it or set TVDB_EIGEN_DIR.")
 
         print("Downloading Eigen...")
         if not checkCommandExists("git"):
             raise RuntimeError("git not found.")
-        
-        open(__downloading_lock_file, "w").close()
-        try:
-            subprocess.check_call([
-                "git", "clone", "--depth=1", f"--branch={eigen_version}",
-                "https://gitlab.com/libeigen/eigen.git", eigen_src_path]
-                )
-        except: pass
-        finally:
-            os.remove(__downloading_lock_file)
+        # cloned aside and renamed into place, so that an interrupted download is never taken for Eigen
+        tmp = f"{eigen_src_path}.tmp{os.getpid()}"
+        shutil.rmtree(tmp, ignore_errors=True)
+        subprocess.check_call([
+            "git", "clone", "--depth=1", f"--branch={eigen_version}",
+            "https://gitlab.com/libeigen/eigen.git", tmp]
+            )
+        if os.path.exists(eigen_src_path):
+            os.rmdir(eigen_src_path)
+        os.rename(tmp, eigen_src_path)
 
 # TODO: improve this...
 def autoCompileConfig() -> CompileConfig:
@@ -1,6 +1,7 @@
 from __future__ import annotations
 from typing import TYPE_CHECKING, Optional, Literal
-from .vector_collection import VectorCollectionAbstract, NumVar, _VectorCollectionEncodingAbstract, CollectionChanges
+from .vector_collection import VectorCollectionAbstract, NumVar, _VectorCollectionEncodingAbstract, CollectionChanges, IndexType, Metric
+from .vector_collection import Attribute, SearchFilter, _AttributeChanges, _restoreChanges
 import base64
 import numpy as np
 
@@ -9,6 +10,7 @@ if TYPE_CHECKING:
 
 
 np_dtype = np.float32
+disk_dtype = np.dtype("<f4")     # the BLOB format on disk, raw little-endian float32
 class _VectorCollectionEncoding_Numpy(_VectorCollectionEncodingAbstract[NumVar]):
     def encode(self, vectors: list[NumVar]) -> str:
         return base64.b64encode(bytes(
@@ -18,19 +20,35 @@ class _VectorCollectionEncoding_Numpy(_VectorCollectionEncodingAbstract[NumVar])
         return list(np.frombuffer(base64.b64decode(enc_vectors), dtype=np_dtype))
 
 class VectorCollection_Numpy(VectorCollectionAbstract[NumVar]):
+    # the buffer grows geometrically, so that adding vectors is amortized
+    GROWTH_FACTOR = 1.5
+    # number of rows scored at a time, bounds the temporary memory of a search to (n_queries, SCORE_CHUNK_ROWS)
+    SCORE_CHUNK_ROWS = 65536
     def __init__(
             self, parent: Optional[VectorDatabase],
             name: str,
             dimension: int,
+            metric: Metric = "cosine", 
             **_
             ):
+        if metric not in ("cosine", "ip", "l2"):
+            raise ValueError(f"Unknown metric: {metric}")
         self.__name = name
+        self.metric = metric
         self.__database = parent
         self._dimension = dimension
-        self._ids: np.ndarray = np.array([], dtype = np_dtype)                # dim: (n, dimension)
-        self._vec: np.ndarray = np.array([], dtype=str)     # dim: (n, )
+        # the first _n rows of _buffer are the vectors, the rest is spare capacity
+        self._buffer: np.ndarray = np.zeros((0, dimension), dtype=np_dtype)    # dim: (capacity, dimension)
+        self._norms: np.ndarray = np.zeros((0, ), dtype=np_dtype)              # dim: (capacity, ), l2 norms of the rows
+        self._n = 0
+        self._ids: list[str] = []                   # dim: (n, )
+        self._id2row: dict[str, int] = {}
 
         self._changes: dict[str, Literal["ADD", "DELETE", "UPDATE"]] = {}
+        # key -> id -> attribute
+        self._attributes: dict[str, dict[str, Attribute]] = {}
+        self._attribute_changes = _AttributeChanges()
+        self._flushed_attributes = _AttributeChanges()
 
         self._encoding = _VectorCollectionEncoding_Numpy[NumVar]()
 
@@ -46,6 +64,49 @@ class VectorCollection_Numpy(VectorCollectionAbstract[NumVar]):
     @property
     def dim(self) -> int:
         return self._dimension
+    @property
+    def _vectors(self) -> np.ndarray:
+        """ View of the vectors, dim: (n, dimension) """
+        return self._buffer[:self._n]
+    
+    def _reserve(self, n: int) -> None:
+        if n <= len(self._buffer):
+            return
+        buffer = np.empty((max(n, int(len(self._buffer) * self.GROWTH_FACTOR)), self._dimension), dtype=np_dtype)
+        buffer[:self._n] = self._vectors
+        norms = np.empty((len(buffer), ), dtype=np_dtype)
+        norms[:self._n] = self._norms[:self._n]
+        self._buffer = buffer
+        self._norms = norms
+    
+    def _setRows(self, rows: list[int] | slice, vectors: np.ndarray) -> None:
+        """ Write vectors into rows of the buffer, and keep the norms up to date """
+        self._buffer[rows] = vectors
+        self._norms[rows] = np.linalg.norm(vectors, axis=1)
+    
+    def _setData(self, ids: list[str], vectors: np.ndarray, norms: Optional[np.ndarray] = None) -> None:
+        """ 
+        Replace all data, vectors (and norms) are used as the buffers without copying, 
+        the rows after the ids are spare capacity, the norms are computed if not given
+        """
+        if len(vectors) < len(ids) or (norms is not None and len(norms) != len(vectors)):
+            raise ValueError("Length of ids and vectors not match")
+        self._ids = list(ids)
+        self._id2row = {id: row for row, id in enumerate(self._ids)}
+        self._buffer = vectors
+        if norms is None:
+            norms = np.empty((len(vectors), ), dtype=np_dtype)
+            for start in range(0, len(vectors), self.SCORE_CHUNK_ROWS):
+                norms[start: start + self.SCORE_CHUNK_ROWS] = np.linalg.norm(vectors[start: start + self.SCORE_CHUNK_ROWS], axis=1)
+        self._norms = norms
+        self._n = len(ids)
+    
+    def _rows(self, ids: list[str]) -> list[int]:
+        """ Rows of the ids, will raise error if any id not exists """
+        try:
+            return [self._id2row[id] for id in ids]
+        except KeyError:
+            raise ValueError("Some ids not exists")
     
     def addBlock(self, ids: list[str], vectors: list[list[NumVar]]):
         """
@@ -59,20 +120,17 @@ class VectorCollection_Numpy(VectorCollectionAbstract[NumVar]):
         # make sure all ids are unique
         if len(ids) != len(set(ids)):
             raise ValueError("Ids are not unique")
-
-        np_ids = np.array(ids, dtype=str)
-        np_vectors = np.array(vectors, dtype=np_dtype)
-
         # make sure all ids are not exists
-        if np.isin(self._ids, np_ids).any():
+        if any(id in self._id2row for id in ids):
             raise ValueError("Some ids already exists")
-        
-        if len(self) == 0:
-            self._ids = np_ids
-            self._vectors = np_vectors
-        else:
-            self._ids = np.concatenate([self._ids, np_ids])
-            self._vectors = np.concatenate([self._vectors, np_vectors])
+
+        np_vectors = np.asarray(vectors, dtype=np_dtype).reshape(len(ids), self._dimension)
+        self._reserve(self._n + len(ids))
+        self._setRows(slice(self._n, self._n + len(ids)), np_vectors)
+        for id in ids:
+            self._id2row[id] = len(self._ids)
+            self._ids.append(id)
+        self._n += len(ids)
 
         # log modifications
         for id in ids:
@@ -83,24 +141,28 @@ class VectorCollection_Numpy(VectorCollectionAbstract[NumVar]):
 
     def deleteBlock(self, ids: list[str]) -> None:
         """
-        Delete a bulk of elements, will raise error if id not exists
+        Delete a bulk of elements, will raise error if id not exists, 
+        the last vectors are moved into the deleted positions
         """
         if len(ids) == 0:
             return
-        if len(ids) > len(self):
-            raise ValueError("Length of ids to delete is larger than length of collection")
-        
-        np_ids = np.array(ids, dtype=str)
-
-        # make sure all ids exists in self._ids
-        if not np.isin(np_ids, self._ids).all():
-            raise ValueError("Some ids not exists")
-
-        mask = np.ones(len(self), dtype=bool)
-        mask[np.isin(self._ids, np_ids)] = False
-    
-        self._ids = self._ids[mask]
-        self._vectors = self._vectors[mask]
+        if len(ids) != len(set(ids)):
+            raise ValueError("Ids are not unique")
+        # in descending order, so that the last row moved into a hole is never a row that is still to be deleted
+        for row in sorted(self._rows(ids), reverse=True):
+            last = self._n - 1
+            del self._id2row[self._ids[row]]
+            if row != last:
+                self._buffer[row] = self._buffer[last]
+                self._norms[row] = self._norms[last]
+                self._ids[row] = self._ids[last]
+                self._id2row[self._ids[row]] = row
+            self._ids.pop()
+            self._n -= 1
+        for column in self._attributes.values():
+            for id in ids:
+                column.pop(id, None)
+        self._attribute_changes.onDelete(ids)
 
         # log modifications
         for id in ids:
@@ -119,32 +181,22 @@ class VectorCollection_Numpy(VectorCollectionAbstract[NumVar]):
             raise ValueError("Length of ids and vectors not match")
         if len(ids) == 0:
             return
+        if len(ids) != len(set(ids)):
+            raise ValueError("Ids are not unique")
 
-        np_ids = np.array(ids)
-        np_vectors = np.array(vectors, dtype = np_dtype)
-
+        np_vectors = np.asarray(vectors, dtype=np_dtype).reshape(len(ids), self._dimension)
+        exists = np.array([id in self._id2row for id in ids], dtype=bool)
         # update
-        mask = np.isin(self._ids, np_ids)
-        self._ids[mask] = np_ids
-        self._vectors[mask] = np_vectors
+        update_ids = [id for id, e in zip(ids, exists) if e]
+        self._setRows(self._rows(update_ids), np_vectors[exists])
         # log modifications
-        for id in np_ids[mask]:
+        for id in update_ids:
             if id in self._changes and self._changes[id] == "ADD":
                 # if id is added and then updated, keep it as "ADD"
                 continue
             self._changes[id] = "UPDATE"
-
         # add
-        mask = ~mask
-        self._ids = np.concatenate([self._ids, np_ids[mask]])
-        self._vectors = np.concatenate([self._vectors, np_vectors[mask]])
-        # log modifications
-        for id in np_ids[mask]:
-            if id in self._changes and self._changes[id] == "DELETE":
-                # if id is deleted and then updated, remove it from changes
-                del self._changes[id]
-            else:
-                self._changes.update({id: "UPDATE"})
+        self.addBlock([id for id, e in zip(ids, exists) if not e], np_vectors[~exists])
 
     def update(self, id: str, vector: list[NumVar]) -> bool:
         """
@@ -152,7 +204,7 @@ class VectorCollection_Numpy(VectorCollectionAbstract[NumVar]):
         """
         if not self.has(id):
             return False
-        self._vectors[self._ids == id] = np.array(vector, dtype = np_dtype)
+        self._setRows([self._id2row[id]], np.asarray(vector, dtype = np_dtype).reshape(1, self._dimension))
         # log modifications
         if id in self._changes and self._changes[id] == "ADD":
             # if id is added and then updated, keep it as "ADD"
@@ -165,13 +217,13 @@ class VectorCollection_Numpy(VectorCollectionAbstract[NumVar]):
         """
         Check if id exists
         """
-        return bool(np.isin(self._ids, np.array([id])).any())
+        return id in self._id2row
     
     def keys(self) -> list[str]:
         """
         Return all ids in this collection
         """
-        return self._ids.tolist()
+        return list(self._ids)
     
     def get(self, id: str) -> list[NumVar]:
         """
@@ -179,44 +231,149 @@ class VectorCollection_Numpy(VectorCollectionAbstract[NumVar]):
         """
         if not self.has(id):
             return []
-        return self._vectors[self._ids == id][0].tolist()
+        return self._buffer[self._id2row[id]].tolist()
     
-    def getBlock(self, ids: list[str]) -> list[list[NumVar]]:
+    def getBlock(self, ids: list[str], as_numpy: bool = False) -> list[list[NumVar]]:
         """
-        Get a bulk of vectors by ids, will raise error if any id not exists
+        Get a bulk of vectors by ids, in the order of ids, will raise error if any id not exists
+        if as_numpy is True, return a numpy array of shape (n, dim) instead
         """
-        if len(ids) == 0:
-            return []
-        if len(ids) > len(self):
-            raise ValueError("Length of ids to get is larger than length of collection")
-        if not all(self.has(id) for id in ids):
-            raise ValueError("Some ids not exists")
+        block = self._buffer[self._rows(ids)]
+        return block if as_numpy else block.tolist()
+    
+    def setAttributes(self, key: str, ids: list[str], values: list[Optional[Attribute]]) -> None:
+        """
+        Set an attribute (an integer or a string) of each id, for search filters, 
+        None removes the attribute, will raise error if id not exists
+        """
+        if len(ids) != len(values):
+            raise ValueError("Length of ids and values not match")
+        self._rows(ids)
+        column = self._attributes.setdefault(key, {})
+        for id, value in zip(ids, values):
+            if value is None:
+                column.pop(id, None)
+            else:
+                column[id] = value
+        self._attribute_changes.onSet(key, ids, values)
+    
+    def getAttributes(self, key: str, ids: list[str]) -> list[Optional[Attribute]]:
+        """ Return the attribute of each id, None if not set """
+        column = self._attributes.get(key, {})
+        return [column.get(id) for id in ids]
+    
+    def _filterMask(self, filter: SearchFilter) -> np.ndarray:
+        """
+        Mask of the vectors matching the filter, shape (n, )
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if "mask" in filter:
+            mask &= np.asarray(filter["mask"], dtype=bool)
+        if "ids" in filter:
+            ids_mask = np.zeros(len(self), dtype=bool)
+            ids_mask[[self._id2row[id] for id in filter["ids"] if id in self._id2row]] = True
+            mask &= ids_mask
+        if "prefix" in filter:
+            prefix = filter["prefix"]
+            mask &= np.fromiter((id.startswith(prefix) for id in self._ids), dtype=bool, count=len(self))
+        for key, values in filter.get("where", {}).items():
+            values = list(values) if isinstance(values, (list, tuple)) else [values]
+            column = self._attributes.get(key, {})
+            mask &= np.array([column.get(id) in values for id in self._ids], dtype=bool)
+        return mask
 
-        return self._vectors[np.isin(self._ids, np.array(ids))].tolist()
+    def _scores(
+        self, queries: np.ndarray, norm_queries: Optional[np.ndarray] = None, start: int = 0, end: Optional[int] = None
+        ) -> np.ndarray:
+        """
+        Scores of the vectors [start, end) for queries of shape (q, dim) with the metric, shape (q, end - start), 
+        norm_queries: (q, 1), computed if not given
+        """
+        if end is None:
+            end = self._n
+        if norm_queries is None:
+            norm_queries = np.linalg.norm(queries, axis=1)[:, None]
+        dots = np.dot(queries, self._buffer[start:end].T)
+        if self.metric == "ip":
+            return dots
+        norms = self._norms[None, start:end]
+        if self.metric == "l2":
+            dots *= 2
+            dots -= norms ** 2
+            dots -= norm_queries ** 2
+            return dots
+        dots /= norm_queries * norms
+        return dots
+    
+    def _topK(self, queries: np.ndarray, k: int, mask: Optional[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Top-k rows and scores for queries of shape (q, dim), sorted with the larger score the first, both (q, k), 
+        the rows are scored by chunks of SCORE_CHUNK_ROWS, 
+        a chunk is reduced to its top-k with argpartition before the next one is scored
+        """
+        n_allowed = self._n if mask is None else int(mask.sum())
+        if k == -1 or k > n_allowed:
+            k = n_allowed
+        norm_queries = np.linalg.norm(queries, axis=1)[:, None]
+        best_rows = np.empty((len(queries), 0), dtype=np.intp)
+        best_scores = np.empty((len(queries), 0), dtype=np_dtype)
+        if k == 0:
+            return best_rows, best_scores
+        if k == self._n:
+            # all rows are selected, no need to keep the scores bounded
+            best_scores = np.empty((len(queries), self._n), dtype=np_dtype)
+            best_rows = np.broadcast_to(np.arange(self._n), best_scores.shape)
+        for start in range(0, self._n, self.SCORE_CHUNK_ROWS):
+            end = min(self._n, start + self.SCORE_CHUNK_ROWS)
+            scores = self._scores(queries, norm_queries, start, end)
+            if mask is not None:
+                scores[:, ~mask[start:end]] = -np.inf
+            if k == self._n:
+                best_scores[:, start:end] = scores
+                continue
+            scores = np.concatenate([best_scores, scores], axis=1)
+            rows = np.concatenate([best_rows, np.broadcast_to(np.arange(start, end), (len(queries), end - start))], axis=1)
+            if scores.shape[1] > k:
+                part = np.argpartition(scores, -k, axis=1)[:, -k:]
+                scores = np.take_along_axis(scores, part, axis=1)
+                rows = np.take_along_axis(rows, part, axis=1)
+            best_scores, best_rows = scores, rows
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        return np.take_along_axis(best_rows, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+    def search(
+        self, query: list[NumVar], k: int = -1, index: Optional[IndexType] = None, filter: Optional[SearchFilter] = None
+        ) -> tuple[list[str], list[float]]:
+        """
+        Search for top-k vectors, return ids and scores, 
+        the search is always exhaustive, index is ignored
+        """
+        ids, scores = self.searchBatch([query], k, index, filter)
+        return ids[0], scores[0]
     
-    def search(self, query: list[NumVar], k: int = -1) -> tuple[list[str], list[float]]:
+    def searchBatch(
+        self, queries: list[list[NumVar]], k: int = -1, index: Optional[IndexType] = None, filter: Optional[SearchFilter] = None
+        ) -> tuple[list[list[str]], list[list[float]]]:
         """
-        Search for top-k vectors, return ids and scores
+        Search for top-k vectors of multiple queries, return ids and scores for each query, 
+        the queries are scored together with one matrix product per chunk of rows
         """
-        query_np = np.array(query, dtype = np_dtype)
-        scores = np.dot(self._vectors, query_np) / (np.linalg.norm(self._vectors, axis=1) * np.linalg.norm(query_np))
-        if k == -1:
-            k = len(self)
-            
-        topk_indices = np.argsort(scores)[::-1][:k]
-        return self._ids[topk_indices].tolist(), scores[topk_indices].tolist()
+        queries_np = np.asarray(queries, dtype = np_dtype).reshape(-1, self._dimension)
+        mask = None if filter is None else self._filterMask(filter)
+        rows, scores = self._topK(queries_np, k, mask)
+        return [[self._ids[i] for i in row] for row in rows], scores.tolist()
     
-    def load(self, ids: list[str], enc_vectors: list[str]) -> None:
+    def load(self, ids: list[str], enc_vectors: list[bytes]) -> None:
         """
         Load a bulk of elements, should be called when the collection is empty
+        enc_vectors are raw float32 bytes, base64 encoded strings are also accepted
         """
         if len(self) != 0:
             raise RuntimeError("Collection is not empty, cannot load data")
-        vectors = np.zeros(shape = (len(ids), self._dimension))
-        for i, enc_vector in enumerate(enc_vectors):
-            vectors[i] = self.encoding.decode(enc_vector)
-        self._ids = np.array(ids)
-        self._vectors = vectors
+        if enc_vectors and isinstance(enc_vectors[0], str):
+            enc_vectors = [base64.b64decode(enc_vector) for enc_vector in enc_vectors]
+        vectors = np.frombuffer(b"".join(enc_vectors), dtype=disk_dtype).astype(np_dtype).reshape(-1, self._dimension)
+        self._setData(ids, vectors)
     
     def loadFromDisk(self) -> None:
         """
@@ -225,8 +382,49 @@ class VectorCollection_Numpy(VectorCollectionAbstract[NumVar]):
         """
         if not self.database:
             return 
-        ids, enc_vectors = self.database.disk_io.getTableData(self.name)
-        self.load(ids, enc_vectors)
+        if len(self) != 0:
+            raise RuntimeError("Collection is not empty, cannot load data")
+        # stream the table by chunks into the pre-allocated array
+        disk_io = self.database.disk_io
+        vectors = np.empty(shape = (disk_io.countTable(self.name), self._dimension), dtype = np_dtype)
+        all_ids: list[str] = []
+        for ids, enc_vectors in disk_io.iterTableData(self.name):
+            vectors[len(all_ids): len(all_ids) + len(ids)] = \
+                np.frombuffer(b"".join(enc_vectors), dtype=disk_dtype).reshape(-1, self._dimension)
+            all_ids.extend(ids)
+        self._setData(all_ids, vectors)
+        self._loadAttributes()
+
+    def loadFromSegment(self) -> bool:
+        """
+        Memory-map the segment file of the collection, and apply the changes logged after it is written, 
+        the mapping is copy-on-write, modifications are never written back to the segment file, 
+        return False and load nothing if the changes are not covered by the log, 
+        Should be called when the collection is attached to a database with "mmap" storage and is empty
+        """
+        if not self.database or self.database.segment_io is None:
+            return False
+        if len(self) != 0:
+            raise RuntimeError("Collection is not empty, cannot load data")
+        # the stored norms are used, so that the vectors are only paged in when searched
+        ids, vectors, norms, generation = self.database.segment_io.read(self.name)
+        changes = self.database.disk_io.getLoggedChanges(self.name, generation)
+        if changes is None:
+            return False
+        self._setData(ids, vectors, norms)
+        set_ids, enc_vectors, delete_ids = changes
+        self.setBlock(set_ids, np.frombuffer(b"".join(enc_vectors), dtype=disk_dtype).reshape(-1, self._dimension))
+        self.deleteBlock([id for id in delete_ids if id in self._id2row])
+        # the changes are already in the database
+        self._changes = {}
+        self._attribute_changes.take()
+        self._loadAttributes()
+        return True
+    
+    def _loadAttributes(self) -> None:
+        assert self.database is not None
+        for key, (ids, values) in self.database.disk_io.getAttributes(self.name).items():
+            self._attributes[key] = dict(zip(ids, values))
 
     def flush(self) -> CollectionChanges:
         """
@@ -240,31 +438,45 @@ class VectorCollection_Numpy(VectorCollectionAbstract[NumVar]):
             "DELETE": ([], None)
         }
         for id, change_type in self._changes.items():
-            if change_type == "ADD":
-                changes["ADD"][0].append(id)
-                changes["ADD"][1].append(self.encoding.encode(self._vectors[self._ids == id][0]))
-            elif change_type == "UPDATE":
-                changes["UPDATE"][0].append(id)
-                changes["UPDATE"][1].append(self.encoding.encode(self._vectors[self._ids == id][0]))
-            elif change_type == "DELETE":
-                changes["DELETE"][0].append(id)
-            else:
+            if change_type not in changes:
                 raise RuntimeError(f"Unknown change type {change_type}")
+            changes[change_type][0].append(id)
+        # encode the changed vectors with a single gather and conversion
+        for change_type in ("ADD", "UPDATE"):
+            ids = changes[change_type][0]
+            enc_vectors = changes[change_type][1]
+            assert enc_vectors is not None
+            block = self._buffer[self._rows(ids)].astype(disk_dtype)
+            enc_vectors.extend(row.tobytes() for row in block)
         
         self._changes = {}  # reset
+        self._flushed_attributes = self._attribute_changes.take()
 
         if not self.database:
             return changes
         
-        ids_add, enc_vectors_add = changes["ADD"]
-        for identifier, enc_vector in zip(ids_add, enc_vectors_add):
-            self.database.disk_io.insetToTable(self.name, identifier, enc_vector)
-        ids_update, enc_vectors_update = changes["UPDATE"]
-        for identifier, enc_vector in zip(ids_update, enc_vectors_update):
-            self.database.disk_io.updateTable(self.name, identifier, enc_vector)
-        for identifier in changes["DELETE"][0]:
-            self.database.disk_io.deleteFromTable(self.name, identifier)
+        try:
+            self._flushed_attributes.save(self.database, self.name)
+            self.database.disk_io.insertBulk(self.name, *changes["ADD"])
+            self.database.disk_io.upsertBulk(self.name, *changes["UPDATE"])
+            self.database.disk_io.deleteBulk(self.name, changes["DELETE"][0])
+        except:
+            self.restore(changes)
+            raise
         return changes
+    
+    def restore(self, changes: CollectionChanges) -> None:
+        """
+        Merge the changes returned by the last flush back into the modification log, 
+        should be called if the transaction they are written in is rolled back
+        """
+        _restoreChanges(self._changes, changes)
+        self._attribute_changes.restore(self._flushed_attributes)
+        self._flushed_attributes = _AttributeChanges()
+
+    def memoryBytes(self) -> int:
+        """ Approximate bytes held in memory, of the buffer and the norms """
+        return self._buffer.nbytes + self._norms.nbytes
 
     def __len__(self) -> int:
         return len(self._ids)
@@ -0,0 +1,104 @@
+"""
+Flat segment files of the collections, used by the "mmap" storage engine.
+
+A segment is a snapshot of a collection in a single file, which can be memory-mapped and searched in place,
+so that the startup does not read the vectors and processes on the same host share the page cache.
+The sqlite database remains the source of truth, and logs the ids changed after the snapshot (see SqliteIO), 
+which are applied on top of the mapping when it is loaded, so that a commit does not rewrite the segment.
+The mapping is copy-on-write, the modifications only copy the pages they touch, 
+and the added vectors take the spare rows reserved in the file, which are holes of a sparse file on most file systems.
+
+File layout (little-endian):
+    header (HEADER_SIZE bytes) | vectors: float32 (capacity, dim) | norms: float32 (capacity, ) | ids: json list of n ids, utf-8
+"""
+import os, json, mmap, struct
+from typing import Iterator, Optional
+import numpy as np
+
+MAGIC = b"TVDBSEG\0"
+HEADER_FORMAT = "<8sIIqqqq"    # magic, format version, dim, n, capacity, generation, size of ids in bytes
+HEADER_SIZE = 64               # padded, so that the vectors are aligned
+SEGMENT_VERSION = 2
+disk_dtype = np.dtype("<f4")
+
+class SegmentIO:
+    def __init__(self, db_path: str) -> None:
+        if db_path == ":memory:" or not db_path:
+            raise ValueError("Segment files require the database to be a file")
+        self.segment_dir = os.path.abspath(db_path) + ".segments"
+        os.makedirs(self.segment_dir, exist_ok=True)
+
+    def segmentPath(self, name: str) -> str:
+        return os.path.join(self.segment_dir, f"{name}.seg")
+
+    def readHeader(self, name: str) -> Optional[tuple[int, int, int, int]]:
+        """ Return (dim, n, capacity, generation) of the segment, or None if the segment does not exist or is invalid """
+        try:
+            with open(self.segmentPath(name), "rb") as f:
+                header = f.read(struct.calcsize(HEADER_FORMAT))
+        except FileNotFoundError:
+            return None
+        if len(header) != struct.calcsize(HEADER_FORMAT):
+            return None
+        magic, version, dim, n, capacity, generation, _ = struct.unpack(HEADER_FORMAT, header)
+        if magic != MAGIC or version != SEGMENT_VERSION:
+            return None
+        return dim, n, capacity, generation
+
+    def read(self, name: str) -> tuple[list[str], np.ndarray, np.ndarray, int]:
+        """
+        Memory-map the segment copy-on-write, return (ids, vectors, norms, generation),
+        the arrays are views of the mapped file of all rows up to the capacity, and keep the mapping alive, 
+        writes to them go to private pages and are never written back to the file
+        """
+        with open(self.segmentPath(name), "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_COPY)
+        _, _, dim, n, capacity, generation, ids_size = struct.unpack_from(HEADER_FORMAT, mm)
+        vectors_offset = HEADER_SIZE
+        norms_offset = vectors_offset + capacity * dim * disk_dtype.itemsize
+        ids_offset = norms_offset + capacity * disk_dtype.itemsize
+        vectors = np.frombuffer(mm, dtype=disk_dtype, count=capacity * dim, offset=vectors_offset).reshape(capacity, dim)
+        norms = np.frombuffer(mm, dtype=disk_dtype, count=capacity, offset=norms_offset)
+        ids = json.loads(mm[ids_offset: ids_offset + ids_size].decode("utf-8"))
+        return ids, vectors, norms, generation
+
+    def write(self, name: str, dim: int, generation: int, ids: list[str], chunks: Iterator[np.ndarray], capacity: int = 0) -> None:
+        """
+        Write the segment from chunks of vectors in the order of ids, with spare rows up to the capacity, 
+        the file is replaced atomically, processes mapping the old file keep a valid mapping
+        """
+        path = self.segmentPath(name)
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        capacity = max(capacity, len(ids))
+        norms: list[np.ndarray] = []
+        ids_bytes = json.dumps(ids).encode("utf-8")
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(struct.pack(
+                    HEADER_FORMAT, MAGIC, SEGMENT_VERSION, dim, len(ids), capacity, generation, len(ids_bytes)
+                    ).ljust(HEADER_SIZE, b"\0"))
+                n = 0
+                for chunk in chunks:
+                    chunk = np.ascontiguousarray(chunk, dtype=disk_dtype).reshape(-1, dim)
+                    f.write(chunk.tobytes())
+                    norms.append(np.linalg.norm(chunk, axis=1).astype(disk_dtype))
+                    n += len(chunk)
+                if n != len(ids):
+                    raise ValueError(f"Number of vectors ({n}) does not match number of ids ({len(ids)})")
+                # the spare rows are skipped, and read as zeros
+                f.seek(HEADER_SIZE + capacity * dim * disk_dtype.itemsize)
+                for norm in norms:
+                    f.write(norm.tobytes())
+                f.seek(HEADER_SIZE + capacity * (dim + 1) * disk_dtype.itemsize)
+                f.write(ids_bytes)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def remove(self, name: str) -> None:
+        if os.path.exists(self.segmentPath(name)):
+            os.remove(self.segmentPath(name))
@@ -16,7 +16,7 @@
 // }
 
 // sort using std::nth_element
-std::vector<int> SearchAlgorithm::topKIndices(const Eigen::Vector<float, Eigen::Dynamic> scores, int k){
+std::vector<int> SearchAlgorithm::topKIndices(const Eigen::Vector<float, Eigen::Dynamic>& scores, int k){
     std::vector<int> ret;
     std::vector<std::pair<float, int>> scores_idx;
     scores_idx.reserve(scores.size());
@@ -35,4 +35,25 @@ std::vector<int> SearchAlgorithm::topKIndices(const Eigen::Vector<float, Eigen::
         ret.push_back(scores_idx[i].second);
     }
     return ret;
-}
\ No newline at end of file
+}
+
+std::vector<std::pair<float, int>> SearchAlgorithm::mergeTopK(std::vector<std::vector<std::pair<float, int>>>& partials, int k){
+    if (partials.size() == 1){
+        // a single partial result is already sorted
+        return std::move(partials[0]);
+    }
+    std::vector<std::pair<float, int>> merged;
+    size_t total = 0;
+    for (auto& p : partials){
+        total += p.size();
+    }
+    merged.reserve(total);
+    for (auto& p : partials){
+        merged.insert(merged.end(), p.begin(), p.end());
+    }
+    k = std::min(k, (int)merged.size());
+    std::nth_element(merged.begin(), merged.begin() + k, merged.end(), largerScore);
+    merged.resize(k);
+    std::sort(merged.begin(), merged.end(), largerScore);
+    return merged;
+}
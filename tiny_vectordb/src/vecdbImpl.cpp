@@ -11,19 +11,172 @@
 namespace py = pybind11;
 
 template <typename NumT>
-VectorCollectionImpl<NumT>::VectorCollectionImpl(){
-    vector_chunk = new MatrixF(0, FEAT_DIM);
+VectorCollectionImpl<NumT>::VectorCollectionImpl(int dim): dim(dim){
+    if (dim < 1 || (FEAT_DIM != Eigen::Dynamic && dim != FEAT_DIM)){
+        throw std::runtime_error("invalid dimension " + std::to_string(dim) + " for the module of dimension " + std::to_string(FEAT_DIM));
+    }
+    vector_chunk = new MatrixF(0, dim);
+    vector_norms = new Eigen::Vector<float, Eigen::Dynamic>(0);
     identifiers = new StringVector();
+    n_rows = 0;
+    n_threads = 1;
+    mapped_vectors_ = nullptr;
+    mapped_norms_ = nullptr;
+    mapped_capacity_ = 0;
+    keep_rows_ = true;
+    ivf_index = new IVFIndex();
+    nprobe = 16;
+    hnsw_index = nullptr;
+    ef_search = 64;
+    pq_index = new PQIndex(dim);
+    quantized = new QuantizedStorage(dim);
+    rerank = 4;
+    metric = SearchAlgorithm::Metric::COSINE;
+    attributes = new RowAttributes();
 }
 
 template <typename NumT>
 VectorCollectionImpl<NumT>::~VectorCollectionImpl(){
+    delete ivf_index;
+    delete hnsw_index;
+    delete pq_index;
+    delete quantized;
+    delete attributes;
     delete vector_chunk;
+    delete vector_norms;
     delete identifiers;
 }
 
 template <typename NumT> 
-int VectorCollectionImpl<NumT>::size(){return vector_chunk->rows();}
+int VectorCollectionImpl<NumT>::size(){
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    return n_rows;
+}
+
+template <typename NumT> 
+int VectorCollectionImpl<NumT>::capacity(){
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    return capacityNoLock();
+}
+
+template <typename NumT> 
+int VectorCollectionImpl<NumT>::capacityNoLock(){
+    return mapped_vectors_ ? mapped_capacity_ : vector_norms->size();
+}
+
+template <typename NumT>
+size_t VectorCollectionImpl<NumT>::memoryBytes(){
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    size_t ret = (size_t)n_rows * ((keep_rows_ ? dim : 0) + 1) * sizeof(NumT) + pending_.size() * dim * sizeof(NumT);
+    ret += quantized->nbytes() + ivf_index->nbytes() + pq_index->nbytes();
+    if (hnsw_index){
+        ret += hnsw_index->nbytes();
+    }
+    return ret;
+}
+
+template <typename NumT>
+void VectorCollectionImpl<NumT>::setNumThreads(int n){
+    if (n < 1){
+        throw std::runtime_error("number of threads should be positive");
+    }
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    n_threads = n;
+}
+
+template <typename NumT>
+int VectorCollectionImpl<NumT>::getNumThreads(){
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    return n_threads;
+}
+
+template <typename NumT>
+void VectorCollectionImpl<NumT>::reserve(int n){
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    reserveNoLock(n);
+}
+
+template <typename NumT>
+void VectorCollectionImpl<NumT>::reserveNoLock(int n){
+    if (n <= capacityNoLock()){
+        return;
+    }
+    materializeNoLock();
+    // row-major with fixed columns, resizing rows keeps the occupied part in place
+    if (keep_rows_){
+        vector_chunk->conservativeResize(n, Eigen::NoChange);
+    }
+    vector_norms->conservativeResize(n);
+    quantized->reserve(n);
+    identifiers->reserve(n);
+    id2idx_.reserve(n);
+}
+
+template <typename NumT>
+Eigen::Map<const MatrixF> VectorCollectionImpl<NumT>::rowsNoLock(){
+    // the first n_rows rows of the row-major chunk are contiguous
+    return Eigen::Map<const MatrixF>(mapped_vectors_ ? mapped_vectors_ : vector_chunk->data(), keep_rows_ ? n_rows : 0, dim);
+}
+
+template <typename NumT>
+Eigen::Map<const Eigen::Vector<float, Eigen::Dynamic>> VectorCollectionImpl<NumT>::normsNoLock(){
+    return Eigen::Map<const Eigen::Vector<float, Eigen::Dynamic>>(mapped_norms_ ? mapped_norms_ : vector_norms->data(), n_rows);
+}
+
+template <typename NumT>
+Eigen::Map<MatrixF> VectorCollectionImpl<NumT>::chunkNoLock(){
+    return Eigen::Map<MatrixF>(mapped_vectors_ ? mapped_vectors_ : vector_chunk->data(), capacityNoLock(), dim);
+}
+
+template <typename NumT>
+Eigen::Map<Eigen::Vector<float, Eigen::Dynamic>> VectorCollectionImpl<NumT>::chunkNormsNoLock(){
+    return Eigen::Map<Eigen::Vector<float, Eigen::Dynamic>>(mapped_norms_ ? mapped_norms_ : vector_norms->data(), capacityNoLock());
+}
+
+template <typename NumT>
+void VectorCollectionImpl<NumT>::materializeNoLock(){
+    if (!mapped_vectors_){
+        return;
+    }
+    *vector_chunk = rowsNoLock();
+    *vector_norms = normsNoLock();
+    mapped_vectors_ = nullptr;
+    mapped_norms_ = nullptr;
+}
+
+template <typename NumT>
+bool VectorCollectionImpl<NumT>::pqStorageNoLock(){
+    return !keep_rows_ && !quantized->enabled();
+}
+
+template <typename NumT>
+Eigen::Matrix<NumT, 1, FEAT_DIM> VectorCollectionImpl<NumT>::rowVectorNoLock(int row){
+    if (keep_rows_){
+        return rowsNoLock().row(row);
+    }
+    // the pq codes are of the normalized row
+    return quantized->enabled() ? quantized->decode(row) : (pq_index->decode(row) * normsNoLock()[row]).eval();
+}
+
+template <typename NumT>
+float VectorCollectionImpl<NumT>::approxDotNoLock(int row, const RowFCRef& query){
+    return quantized->enabled() ? quantized->dot(row, query) : pq_index->dot(row, query) * normsNoLock()[row];
+}
+
+template <typename NumT>
+MatrixF VectorCollectionImpl<NumT>::decodedRowsNoLock(){
+    MatrixF ret(n_rows, dim);
+    for (int row = 0; row < n_rows; row++){
+        ret.row(row) = rowVectorNoLock(row);
+    }
+    return ret;
+}
+
+template <typename NumT>
+bool VectorCollectionImpl<NumT>::isMapped(){
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    return mapped_vectors_ != nullptr;
+}
 
 template <typename NumT>
 void VectorCollectionImpl<NumT>::reIndex(){
@@ -33,33 +186,86 @@ void VectorCollectionImpl<NumT>::reIndex(){
     }
 }
 
+// copy python lists of vectors into a matrix, checking the dimension of each vector
+template <typename NumT>
+static MatrixF toMatrix(const std::vector<std::vector<NumT>>& vectors, int dim){
+    MatrixF ret(vectors.size(), dim);
+    for (int i = 0; i < vectors.size(); i++){
+        if (vectors[i].size() != dim){
+            throw std::runtime_error("vector size not match: " + 
+                std::to_string(vectors[i].size()) + " vs. " + std::to_string(dim)
+                );
+        }
+        ret.row(i) = Eigen::Map<const Eigen::Matrix<NumT, 1, FEAT_DIM>>(vectors[i].data(), dim);
+    }
+    return ret;
+}
+
+// view a buffer as a (n, dim) matrix without copying, 
+// the buffer should be of float32 and C-contiguous, 1-dimensional buffer is viewed as a single row
+template <typename NumT>
+static Eigen::Map<const MatrixF> bufferAsMatrix(const py::buffer_info& info, int dim){
+    if (info.itemsize != sizeof(NumT) || info.format.back() != py::format_descriptor<NumT>::c){
+        throw std::runtime_error("buffer should be of float32, got format: " + info.format);
+    }
+    if (info.ndim == 1 && info.shape[0] == dim && info.strides[0] == sizeof(NumT)){
+        return Eigen::Map<const MatrixF>((const NumT*)info.ptr, 1, dim);
+    }
+    if (info.ndim != 2 || info.shape[1] != dim){
+        throw std::runtime_error("buffer should be of shape (n, " + std::to_string(dim) + ")");
+    }
+    if (info.shape[0] > 1 && (info.strides[1] != sizeof(NumT) || info.strides[0] != sizeof(NumT) * dim)){
+        throw std::runtime_error("buffer should be C-contiguous");
+    }
+    return Eigen::Map<const MatrixF>((const NumT*)info.ptr, info.shape[0], dim);
+}
+
 template <typename NumT>
 void VectorCollectionImpl<NumT>::addBulk(StringVector ids, const std::vector<std::vector<NumT>> vectors){
-    if (ids.size() != vectors.size()){
+    MatrixF vector_matrix = toMatrix(vectors, dim);
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    addBulkNoLock(ids, vector_matrix);
+}
+
+template <typename NumT>
+void VectorCollectionImpl<NumT>::addBulkBuffer(StringVector ids, py::buffer vectors){
+    py::buffer_info info = vectors.request();
+    py::gil_scoped_release release;
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    addBulkNoLock(ids, bufferAsMatrix<NumT>(info, dim));
+}
+
+template <typename NumT>
+void VectorCollectionImpl<NumT>::addBulkNoLock(const StringVector& ids, const MatrixFCRef& vectors){
+    if (ids.size() != vectors.rows()){
         throw std::runtime_error("ids and vectors size not match");
     }
 
     // duplicate ids check
-    std::set<std::string> id_set(ids.begin(), ids.end());
+    std::unordered_set<std::string> id_set(ids.begin(), ids.end());
     if (id_set.size() != ids.size()){
         throw std::runtime_error("ids are not unique");
     }
     for (int i = 0; i < ids.size(); i++){
-        if (has(ids[i])){
+        if (hasNoLock(ids[i])){
             throw std::runtime_error("id already exists");
         }
     }
 
-    addRawBulk(ids, vectors);
+    addRawBulkNoLock(ids, vectors);
 
     // log modifications
     for (int i = 0; i < ids.size(); i++){
-        if (mod_map.find(ids[i]) != mod_map.end()){
-            assert(mod_map[ids[i]] == ModificaionType::DELETE && "Impossible error??");
-            mod_map[ids[i]] = ModificaionType::UPDATE;
+        if (!keep_rows_){
+            pending_[ids[i]] = std::vector<NumT>(vectors.row(i).data(), vectors.row(i).data() + dim);
+        }
+        auto it = mod_map.find(ids[i]);
+        if (it != mod_map.end()){
+            assert(it->second == ModificaionType::DELETE && "Impossible error??");
+            it->second = ModificaionType::UPDATE;
         }
         else{
-            mod_map[ids[i]] = ModificaionType::ADD;
+            mod_map.emplace(ids[i], ModificaionType::ADD);
         }
     }
 }
@@ -67,6 +273,7 @@ void VectorCollectionImpl<NumT>::addBulk(StringVector ids, const std::vector<std
 
 template <typename NumT>
 void VectorCollectionImpl<NumT>::addRawEncBulk(StringVector ids, const std::vector<std::string> enc_vectors){
+    // decoding does not touch the collection, lock only for the insertion
     std::vector<std::vector<NumT>> vectors = std::vector<std::vector<NumT>>(enc_vectors.size());
     for (int i = 0; i < enc_vectors.size(); i++){
         vectors[i] = VectorStringEncode::decode<NumT>(enc_vectors[i]);
@@ -74,42 +281,239 @@ void VectorCollectionImpl<NumT>::addRawEncBulk(StringVector ids, const std::vect
     addRawBulk(ids, vectors);
 }
 
+template <typename NumT>
+void VectorCollectionImpl<NumT>::addRawBinBulk(StringVector ids, const std::vector<std::string> bin_vectors){
+    if (ids.size() != bin_vectors.size()){
+        throw std::runtime_error("ids and vectors size not match");
+    }
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    if (!keep_rows_){
+        // decoded into a temporary matrix, only the quantized rows are kept
+        MatrixF vectors(ids.size(), dim);
+        for (int i = 0; i < bin_vectors.size(); i++){
+            VectorBinaryEncode::decodeTo<NumT>(bin_vectors[i], vectors.row(i).data(), dim);
+        }
+        addRawBulkNoLock(ids, vectors);
+        return;
+    }
+    int old_size = n_rows;
+    if (old_size + ids.size() > capacityNoLock()){
+        reserveNoLock(std::max((int)(old_size + ids.size()), (int)(capacityNoLock() * growth_factor)));
+    }
+    auto chunk = chunkNoLock();
+
+    // decode straight into the spare capacity of the chunk, without an intermediate matrix, 
+    // n_rows is only advanced after all rows are decoded, so a decoding error leaves the collection unchanged
+    for (int i = 0; i < bin_vectors.size(); i++){
+        VectorBinaryEncode::decodeTo<NumT>(bin_vectors[i], chunk.row(old_size + i).data(), dim);
+    }
+    n_rows = old_size + ids.size();
+    identifiers -> insert(identifiers->end(), ids.begin(), ids.end());
+    chunkNormsNoLock().segment(old_size, ids.size()) = chunk.middleRows(old_size, ids.size()).rowwise().norm();
+    for (int i = 0; i < ids.size(); i++){
+        id2idx_[ids[i]] = i + old_size;
+    }
+    if (ivf_index->trained()){
+        std::vector<int> lists = ivf_index->assignBulk(chunk.middleRows(old_size, ids.size()), n_threads);
+        for (int i = 0; i < ids.size(); i++){
+            ivf_index->add(old_size + i, lists[i]);
+        }
+    }
+    if (quantized->enabled()){
+        for (int i = 0; i < ids.size(); i++){
+            quantized->add(old_size + i, chunk.row(old_size + i));
+        }
+    }
+    if (hnsw_index){
+        for (int i = 0; i < ids.size(); i++){
+            hnsw_index->addRow(old_size + i, hnswSpaceNoLock());
+        }
+    }
+    if (pq_index->trained()){
+        for (int i = 0; i < ids.size(); i++){
+            pq_index->add(old_size + i, chunk.row(old_size + i));
+        }
+    }
+}
+
+template <typename NumT>
+StringVector VectorCollectionImpl<NumT>::addRawQuantizedBulk(StringVector ids, const std::vector<std::string> blobs){
+    if (ids.size() != blobs.size()){
+        throw std::runtime_error("ids and vectors size not match");
+    }
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    if (keep_rows_){
+        throw std::runtime_error("the float32 rows are kept, add them instead");
+    }
+    const int old_size = n_rows;
+    if (old_size + ids.size() > capacityNoLock()){
+        reserveNoLock(std::max((int)(old_size + ids.size()), (int)(capacityNoLock() * growth_factor)));
+    }
+    StringVector skipped;
+    for (int i = 0; i < ids.size(); i++){
+        const bool added = quantized->enabled() ? 
+            quantized->addEncoded(n_rows, blobs[i], (*vector_norms)[n_rows]) : pq_index->addEncoded(n_rows, blobs[i], (*vector_norms)[n_rows]);
+        if (!added){
+            skipped.push_back(ids[i]);
+            continue;
+        }
+        id2idx_[ids[i]] = n_rows;
+        identifiers->push_back(ids[i]);
+        n_rows++;
+    }
+    // the indexes are usually restored after loading, otherwise they are given the decoded rows
+    const bool pq_index_rows = pq_index->trained() && !pqStorageNoLock();
+    if (ivf_index->trained() || hnsw_index || pq_index_rows){
+        for (int row = old_size; row < n_rows; row++){
+            const Eigen::Matrix<NumT, 1, FEAT_DIM> vec = rowVectorNoLock(row);
+            if (ivf_index->trained()){
+                ivf_index->add(row, ivf_index->assign(vec));
+            }
+            if (hnsw_index){
+                hnsw_index->addRow(row, hnswSpaceNoLock());
+            }
+            if (pq_index_rows){
+                pq_index->add(row, vec);
+            }
+        }
+    }
+    return skipped;
+}
+
 template <typename NumT>
 void VectorCollectionImpl<NumT>::addRawBulk(StringVector ids, const std::vector<std::vector<NumT>> vectors){
-    int old_size = vector_chunk->rows();
+    MatrixF vector_matrix = toMatrix(vectors, dim);
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    addRawBulkNoLock(ids, vector_matrix);
+}
 
-    // re-allocate memory for vector_chunk
-    MatrixF* new_chunk = new MatrixF(ids.size() + old_size, FEAT_DIM);
-    new_chunk->block(0, 0, old_size, FEAT_DIM) = vector_chunk->block(0, 0, old_size, FEAT_DIM);
-    delete vector_chunk;
-    this->vector_chunk = new_chunk;
+template <typename NumT>
+void VectorCollectionImpl<NumT>::addRawBulkNoLock(const StringVector& ids, const MatrixFCRef& vectors){
+    if (ids.size() != vectors.rows()){
+        throw std::runtime_error("ids and vectors size not match");
+    }
+    int old_size = n_rows;
+
+    // re-allocate memory for the chunk only if capacity is exceeded,
+    // grow geometrically so that streaming insertion is amortized O(1) per vector
+    if (old_size + ids.size() > capacityNoLock()){
+        reserveNoLock(std::max((int)(old_size + ids.size()), (int)(capacityNoLock() * growth_factor)));
+    }
+    n_rows = old_size + ids.size();
 
     // update identifiers
-    // no need to re-allocate memory
     identifiers -> insert(identifiers->end(), ids.begin(), ids.end());
 
     // update matrix
-    // std::cout << "!! DEBUG: " << vectors[0].size() << " " << FEAT_DIM << std::endl;
-    for (int i = 0; i < ids.size(); i++){
-        if (vectors[i].size() != FEAT_DIM){
-            throw std::runtime_error("vector size not match: " + 
-                std::to_string(vectors[i].size()) + " vs. " + std::to_string(FEAT_DIM)
-                );
-        }
-        for (int j = 0; j < FEAT_DIM; j++){
-            (*vector_chunk)(i + old_size, j) = vectors[i][j];
-        }
+    if (keep_rows_){
+        chunkNoLock().middleRows(old_size, ids.size()) = vectors;
     }
+    chunkNormsNoLock().segment(old_size, ids.size()) = vectors.rowwise().norm();
 
     // update index
     for (int i = 0; i < ids.size(); i++){
         id2idx_[ids[i]] = i + old_size;
     }
+    if (ivf_index->trained()){
+        std::vector<int> lists = ivf_index->assignBulk(vectors, n_threads);
+        for (int i = 0; i < ids.size(); i++){
+            ivf_index->add(old_size + i, lists[i]);
+        }
+    }
+    // the graph may read the quantized rows
+    if (quantized->enabled()){
+        for (int i = 0; i < ids.size(); i++){
+            quantized->add(old_size + i, vectors.row(i));
+        }
+    }
+    if (hnsw_index){
+        for (int i = 0; i < ids.size(); i++){
+            hnsw_index->addRow(old_size + i, hnswSpaceNoLock());
+        }
+    }
+    if (pq_index->trained()){
+        for (int i = 0; i < ids.size(); i++){
+            pq_index->add(old_size + i, vectors.row(i));
+        }
+    }
+}
+
+template <typename NumT>
+StringVector VectorCollectionImpl<NumT>::mapBuffer(StringVector ids, py::buffer vectors, py::buffer norms, const std::vector<std::string>& quantized_rows){
+    py::buffer_info info = vectors.request();
+    py::buffer_info info_norms = norms.request();
+    py::gil_scoped_release release;
+    auto vector_matrix = bufferAsMatrix<NumT>(info, dim);
+    if (info_norms.format.back() != py::format_descriptor<float>::c || info_norms.ndim != 1 || info_norms.strides[0] != sizeof(float)){
+        throw std::runtime_error("norms should be a contiguous 1-dimensional float32 buffer");
+    }
+    if (info.readonly || info_norms.readonly){
+        throw std::runtime_error("buffers should be writable");
+    }
+    if (ids.size() > vector_matrix.rows() || info_norms.shape[0] != vector_matrix.rows()){
+        throw std::runtime_error("ids, vectors and norms size not match");
+    }
+    if (!quantized_rows.empty() && quantized_rows.size() != ids.size()){
+        throw std::runtime_error("ids and quantized rows size not match");
+    }
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    if (n_rows != 0){
+        throw std::runtime_error("collection is not empty, cannot map buffer");
+    }
+    if (!keep_rows_){
+        throw std::runtime_error("the float32 rows are not kept, cannot map buffer");
+    }
+    ivf_index->clear();
+    pq_index->clear();
+    delete hnsw_index;
+    hnsw_index = nullptr;
+    mapped_vectors_ = const_cast<NumT*>(vector_matrix.data());
+    mapped_norms_ = (float*)info_norms.ptr;
+    mapped_capacity_ = vector_matrix.rows();
+    n_rows = ids.size();
+    *identifiers = std::move(ids);
+    id2idx_.reserve(n_rows);
+    for (int i = 0; i < n_rows; i++){
+        id2idx_[(*identifiers)[i]] = i;
+    }
+    // release the memory of the empty chunk
+    vector_chunk->resize(0, dim);
+    vector_norms->resize(0);
+    StringVector requantized;
+    if (quantized->enabled()){
+        // the saved BLOBs are restored, so that only the rows without one are read from the buffer
+        quantized->build(MatrixF(0, dim), quantized->type());
+        quantized->reserve(mapped_capacity_);
+        float norm;
+        for (int i = 0; i < n_rows; i++){
+            if (i < quantized_rows.size() && quantized->addEncoded(i, quantized_rows[i], norm)){
+                continue;
+            }
+            quantized->add(i, rowsNoLock().row(i));
+            requantized.push_back((*identifiers)[i]);
+        }
+    }
+    return requantized;
 }
 
 template <typename NumT>
 void VectorCollectionImpl<NumT>::setBulk(StringVector ids, const std::vector<std::vector<NumT>> vectors){
-    if (ids.size() != vectors.size()){
+    MatrixF vector_matrix = toMatrix(vectors, dim);
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    setBulkNoLock(ids, vector_matrix);
+}
+
+template <typename NumT>
+void VectorCollectionImpl<NumT>::setBulkBuffer(StringVector ids, py::buffer vectors){
+    py::buffer_info info = vectors.request();
+    py::gil_scoped_release release;
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    setBulkNoLock(ids, bufferAsMatrix<NumT>(info, dim));
+}
+
+template <typename NumT>
+void VectorCollectionImpl<NumT>::setBulkNoLock(const StringVector& ids, const MatrixFCRef& vectors){
+    if (ids.size() != vectors.rows()){
         throw std::runtime_error("ids and vectors size not match");
     }
 
@@ -118,14 +522,14 @@ void VectorCollectionImpl<NumT>::setBulk(StringVector ids, const std::vector<std
     to_add_index.reserve(ids.size());   // reserve memory to avoid re-allocate on push_back
 
     // duplicate ids check
-    std::set<std::string> id_set(ids.begin(), ids.end());
+    std::unordered_set<std::string> id_set(ids.begin(), ids.end());
     if (id_set.size() != ids.size()){
         throw std::runtime_error("ids are not unique");
     }
     for (int i = 0; i < ids.size(); i++){
-        if (has(ids[i])){
+        if (hasNoLock(ids[i])){
             // if exist, update
-            update(ids[i], vectors[i]);
+            updateNoLock(ids[i], vectors.row(i));
         }
         else{
             // not exist, mark as need to add
@@ -135,40 +539,71 @@ void VectorCollectionImpl<NumT>::setBulk(StringVector ids, const std::vector<std
 
     // collect ids and vectors to add
     StringVector to_add_ids = StringVector(to_add_index.size());
-    std::vector<std::vector<NumT>> to_add_vectors = std::vector<std::vector<NumT>>(to_add_index.size());
+    MatrixF to_add_vectors = MatrixF(to_add_index.size(), dim);
     for (int i = 0; i < to_add_index.size(); i++){
         to_add_ids[i] = ids[to_add_index[i]];
-        to_add_vectors[i] = vectors[to_add_index[i]];
+        to_add_vectors.row(i) = vectors.row(to_add_index[i]);
     }
 
     // add new vectors
-    addBulk(to_add_ids, to_add_vectors);
+    addBulkNoLock(to_add_ids, to_add_vectors);
 }
 
 template <typename NumT> 
 bool VectorCollectionImpl<NumT>::has(const std::string& id){
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    return hasNoLock(id);
+}
+
+template <typename NumT> 
+bool VectorCollectionImpl<NumT>::hasNoLock(const std::string& id){
     // return std::find(identifiers.begin(), identifiers.end(), id) != identifiers.end();
     return id2idx_.find(id) != id2idx_.end();
 }
 
 template <typename NumT>
-bool VectorCollectionImpl<NumT>::update(const std::string& id, std::vector<NumT> vec){
-    if (vec.size() != FEAT_DIM){
+bool VectorCollectionImpl<NumT>::update(const std::string& id, const std::vector<NumT> vec){
+    if (vec.size() != dim){
         throw std::runtime_error("vector size not match");
     }
-    if (!has(id)){
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    return updateNoLock(id, Eigen::Map<const Eigen::Matrix<NumT, 1, FEAT_DIM>>(vec.data(), dim));
+}
+
+template <typename NumT>
+bool VectorCollectionImpl<NumT>::updateNoLock(const std::string& id, const RowFCRef& vec){
+    auto it_idx = id2idx_.find(id);
+    if (it_idx == id2idx_.end()){
         return false;
     }
 
-    for (int i = 0; i < FEAT_DIM; i++){
-        (*vector_chunk)(id2idx_[id], i) = vec[i];
+    int idx = it_idx->second;
+    if (keep_rows_){
+        chunkNoLock().row(idx) = vec;
+    }
+    else{
+        pending_[id] = std::vector<NumT>(vec.data(), vec.data() + dim);
+    }
+    chunkNormsNoLock()(idx) = vec.norm();
+    if (ivf_index->trained()){
+        ivf_index->reassign(idx, ivf_index->assign(vec));
+    }
+    if (quantized->enabled()){
+        quantized->update(idx, vec);
+    }
+    if (hnsw_index){
+        hnsw_index->updateRow(idx, hnswSpaceNoLock());
+    }
+    if (pq_index->trained()){
+        pq_index->update(idx, vec);
     }
     // record modification
-    if (mod_map.find(id) == mod_map.end()){
-        mod_map[id] = ModificaionType::UPDATE;
+    auto it_mod = mod_map.find(id);
+    if (it_mod == mod_map.end()){
+        mod_map.emplace(id, ModificaionType::UPDATE);
     }
     else{
-        assert(mod_map[id] == ModificaionType::ADD && "Impossible error??");
+        assert(it_mod->second == ModificaionType::ADD && "Impossible error??");
         // do nothing, it must be a ADD, keep it as ADD
     }
     return true;
@@ -176,103 +611,999 @@ bool VectorCollectionImpl<NumT>::update(const std::string& id, std::vector<NumT>
 
 template <typename NumT> 
 std::vector<NumT> VectorCollectionImpl<NumT>::get(const std::string& id){
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    return getNoLock(id);
+}
+
+template <typename NumT> 
+std::vector<NumT> VectorCollectionImpl<NumT>::getNoLock(const std::string& id){
     auto it = id2idx_.find(id);
     if (it == id2idx_.end()){
         return std::vector<NumT>();
     }
-    int idx = it->second;
-    return std::vector<NumT>(vector_chunk->row(idx).data(), vector_chunk->row(idx).data() + FEAT_DIM);
+    auto it_pending = pending_.find(id);
+    if (it_pending != pending_.end()){
+        return it_pending->second;
+    }
+    Eigen::Matrix<NumT, 1, FEAT_DIM> row = rowVectorNoLock(it->second);
+    return std::vector<NumT>(row.data(), row.data() + dim);
 }
 
 template <typename NumT>
 std::vector<std::vector<NumT>> VectorCollectionImpl<NumT>::getBulk(const StringVector& ids){
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
     std::vector<std::vector<NumT>> result(ids.size());
     for (int i = 0; i < ids.size(); i++){
-        result[i] = get(ids[i]);
+        result[i] = getNoLock(ids[i]);
+    }
+    return result;
+}
+
+template <typename NumT>
+py::array_t<NumT> VectorCollectionImpl<NumT>::getBulkArray(const StringVector& ids){
+    py::array_t<NumT> result({(py::ssize_t)ids.size(), (py::ssize_t)dim});
+    NumT* result_ptr = result.mutable_data();
+    {
+        py::gil_scoped_release release;
+        std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+        Eigen::Map<MatrixF> result_matrix(result_ptr, ids.size(), dim);
+        for (int i = 0; i < ids.size(); i++){
+            auto it = id2idx_.find(ids[i]);
+            if (it == id2idx_.end()){
+                throw std::runtime_error("id not found: " + ids[i]);
+            }
+            auto it_pending = pending_.find(ids[i]);
+            if (it_pending != pending_.end()){
+                result_matrix.row(i) = Eigen::Map<const Eigen::Matrix<NumT, 1, FEAT_DIM>>(it_pending->second.data(), dim);
+            }
+            else{
+                result_matrix.row(i) = rowVectorNoLock(it->second);
+            }
+        }
     }
     return result;
 }
 
 template <typename NumT>
 std::vector<std::string> VectorCollectionImpl<NumT>::getAllIds(){
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
     return std::vector<std::string>(identifiers->begin(), identifiers->end());
 }
 
 template <typename NumT>
 void VectorCollectionImpl<NumT>::deleteBulk(const StringVector& ids_del){
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    // duplicate ids check
+    std::unordered_set<std::string> id_set(ids_del.begin(), ids_del.end());
+    if (id_set.size() != ids_del.size()){
+        throw std::runtime_error("ids are not unique");
+    }
     // check if all ids exist and gather all indexes to be deleted
-    int new_size = vector_chunk->rows() - ids_del.size();
-    std::unique_ptr<int> delete_rowIndexes = std::unique_ptr<int>(new int[ids_del.size()]);
-    std::unique_ptr<int> keep_rowIndexes = std::unique_ptr<int>(new int[new_size]);
+    std::vector<int> delete_rowIndexes = std::vector<int>(ids_del.size());
     for (int i = 0; i < ids_del.size(); i++){
         auto it = id2idx_.find(ids_del[i]);
         if (it == id2idx_.end()){
             throw std::runtime_error("id not found");
         }
-        delete_rowIndexes.get()[i] = it->second;
+        delete_rowIndexes[i] = it->second;
     }
-    // sort indexes in asending order
-    std::sort(delete_rowIndexes.get(), delete_rowIndexes.get() + ids_del.size());
-    
-    // copy rows to keep to new matrix using double pointers
-    int delete_rowIndexes_offset = 0;
-    for (int i=0; i < vector_chunk->rows(); i++){
-        if (delete_rowIndexes_offset < ids_del.size() && delete_rowIndexes.get()[delete_rowIndexes_offset] == i){
-            delete_rowIndexes_offset++;
-            continue;
+    // sort indexes in descending order, 
+    // so that the last row moved into a hole is never a row that is still to be deleted
+    std::sort(delete_rowIndexes.begin(), delete_rowIndexes.end(), std::greater<int>());
+    auto chunk_norms = chunkNormsNoLock();
+
+    // swap-remove: move the last row into the hole and patch only the index of the moved row,
+    // cost is O(k) instead of rebuilding the chunk and the whole index
+    for (int idx : delete_rowIndexes){
+        int last = n_rows - 1;
+        id2idx_.erase((*identifiers)[idx]);
+        if (ivf_index->trained()){
+            ivf_index->swapRemove(idx);
         }
-        keep_rowIndexes.get()[i - delete_rowIndexes_offset] = i;
+        if (hnsw_index){
+            hnsw_index->swapRemoveRow(idx, hnswSpaceNoLock());
+        }
+        if (quantized->enabled()){
+            quantized->swapRemove(idx);
+        }
+        if (pq_index->trained()){
+            pq_index->swapRemove(idx);
+        }
+        attributes->swapRemove(idx, last);
+        if (idx != last){
+            if (keep_rows_){
+                chunkNoLock().row(idx) = chunkNoLock().row(last);
+            }
+            chunk_norms(idx) = chunk_norms(last);
+            (*identifiers)[idx] = std::move((*identifiers)[last]);
+            id2idx_[(*identifiers)[idx]] = idx;
+        }
+        identifiers->pop_back();
+        n_rows--;
     }
-
-    // allocate new matrix and identifiers
-    MatrixF* new_chunk = new MatrixF(new_size, FEAT_DIM);
-    StringVector* new_identifiers = new StringVector(new_size);
-
-    for (int i = 0; i < vector_chunk->rows() - ids_del.size(); i++){
-        new_chunk->row(i) = vector_chunk->row(keep_rowIndexes.get()[i]);
-        new_identifiers->at(i) = identifiers->at(keep_rowIndexes.get()[i]);
+    // the freed nodes of the graph are reused by the added rows, 
+    // rebuild when they outnumber the live ones, as the repaired links degrade the graph
+    if (hnsw_index && hnsw_index->nDeleted() > n_rows){
+        rebuildHNSWNoLock(hnsw_index->getM(), hnsw_index->getEfConstruction());
     }
 
-    // update and free memory
-    delete vector_chunk;
-    delete identifiers;
-    this->vector_chunk = new_chunk;
-    this->identifiers = new_identifiers;
-    reIndex();
-
     // log modifications
     for (int i = 0; i < ids_del.size(); i++){
-        if (mod_map.find(ids_del[i]) != mod_map.end()){
-            if (mod_map[ids_del[i]] == ModificaionType::ADD){
-                mod_map.erase(ids_del[i]);
+        pending_.erase(ids_del[i]);
+        auto it = mod_map.find(ids_del[i]);
+        if (it != mod_map.end()){
+            if (it->second == ModificaionType::ADD){
+                mod_map.erase(it);
                 continue;
             }
+            it->second = ModificaionType::DELETE;
+            continue;
         }
-        mod_map[ids_del[i]] = ModificaionType::DELETE;
+        mod_map.emplace(ids_del[i], ModificaionType::DELETE);
     }
 }
 
 template <typename NumT>
 std::vector<float> VectorCollectionImpl<NumT>::score(const std::vector<NumT> &query){
-    auto search_scores = SearchAlgorithm::cosineSimilarity(*vector_chunk, query);
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    if (query.size() != dim){
+        throw std::runtime_error("query size not match");
+    }
+    Eigen::Vector<NumT, FEAT_DIM> query_matrix = Eigen::Map<const Eigen::Vector<NumT, FEAT_DIM>>(query.data(), dim);
+    if (!keep_rows_){
+        // approximate scores on the quantized rows
+        std::vector<float> ret(n_rows);
+        const float norm_query = query_matrix.norm();
+        for (int row = 0; row < n_rows; row++){
+            ret[row] = SearchAlgorithm::scoreFromDot(metric, approxDotNoLock(row, query_matrix.transpose()), norm_query, normsNoLock()[row]);
+        }
+        return ret;
+    }
+    auto search_scores = SearchAlgorithm::dispatchMetric(metric, [&](auto m){
+        return SearchAlgorithm::similarity<decltype(m)::value>(rowsNoLock(), normsNoLock(), query_matrix);
+    });
     return std::vector<float>(search_scores.data(), search_scores.data() + search_scores.size());
 }
 
 template <typename NumT>
-py::tuple VectorCollectionImpl<NumT>::search(const std::vector<NumT>& query, int topk){
-    if (topk > size() or topk == -1){
-        topk = size();
+std::tuple<StringVector, std::vector<float>> VectorCollectionImpl<NumT>::search(
+    const std::vector<NumT>& query, int topk, const std::string& index, const SearchFilter* filter
+    ){
+    if (query.size() != dim){
+        throw std::runtime_error("query size not match");
     }
-    Eigen::Vector<float, Eigen::Dynamic> search_scores = SearchAlgorithm::cosineSimilarity(*vector_chunk, query);
-    std::vector<int> topk_indexes = SearchAlgorithm::topKIndices(search_scores, topk);
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    return searchNoLock(Eigen::Map<const Eigen::Vector<NumT, FEAT_DIM>>(query.data(), dim), topk, index, filter);
+}
+
+template <typename NumT>
+std::tuple<StringVector, std::vector<float>> VectorCollectionImpl<NumT>::searchBuffer(
+    py::buffer query, int topk, const std::string& index, const SearchFilter* filter
+    ){
+    py::buffer_info info = query.request();
+    py::gil_scoped_release release;
+    auto query_matrix = bufferAsMatrix<NumT>(info, dim);
+    if (query_matrix.rows() != 1){
+        throw std::runtime_error("query should be a single vector");
+    }
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    return searchNoLock(query_matrix.row(0).transpose(), topk, index, filter);
+}
+
+template <typename NumT>
+std::tuple<StringVector, std::vector<float>> VectorCollectionImpl<NumT>::searchNoLock(
+    const Eigen::Vector<NumT, FEAT_DIM>& query, int topk, const std::string& index, const SearchFilter* filter
+    ){
+    const RowFilter row_filter = rowFilterNoLock(filter);
+    if (topk > row_filter.n_allowed or topk == -1){
+        topk = row_filter.n_allowed;
+    }
+    std::vector<std::pair<float, int>> topk_pairs = searchTopKNoLock(query, topk, selectEngineNoLock(index), row_filter, n_threads);
+    // approximate search may find less than topk rows
+    topk = topk_pairs.size();
 
     StringVector topk_ids = StringVector(topk);
     std::vector<float> topk_scores = std::vector<float>(topk);
     for (int i = 0; i < topk; i++){
-        topk_ids[i] = identifiers->at(topk_indexes[i]);
-        topk_scores[i] = search_scores[topk_indexes[i]];
+        topk_ids[i] = identifiers->at(topk_pairs[i].second);
+        topk_scores[i] = topk_pairs[i].first;
+    }
+    return std::make_tuple(topk_ids, topk_scores);
+}
+
+template <typename NumT>
+std::vector<std::pair<float, int>> VectorCollectionImpl<NumT>::searchTopKNoLock(
+    const Eigen::Vector<NumT, FEAT_DIM>& query, int topk, SearchEngine engine, const RowFilter& filter, int n_threads_
+    ){
+    std::vector<std::pair<float, int>> topk_pairs;
+    if (topk <= 0){
+        return topk_pairs;
+    }
+    // without the float32 rows, the candidates are scored on the quantized rows, and all kept for the caller to re-rank
+    const int n_keep = keep_rows_ ? topk : nCandidatesNoLock(topk);
+    if (filter.sparse && !keep_rows_){
+        return approxTopKRowsNoLock(query, filter.rows, n_keep);
+    }
+    if (filter.sparse){
+        return SearchAlgorithm::dispatchMetric(metric, [&](auto m){
+            return SearchAlgorithm::similarityTopKRows<decltype(m)::value>(rowsNoLock(), normsNoLock(), query, filter.rows, topk);
+        });
+    }
+    const uint8_t* mask = filter.maskData();
+    switch (engine){
+        case SearchEngine::HNSW:
+            topk_pairs = hnswSearchNoLock(query, topk, filter);
+            break;
+        case SearchEngine::IVF:
+            if (keep_rows_){
+                topk_pairs = ivf_index->search(rowsNoLock(), normsNoLock(), query, topk, nprobe, metric, mask);
+                break;
+            }
+            topk_pairs = ivf_index->search(normsNoLock(), query, n_keep, nprobe, metric, mask, [&](int row){
+                return approxDotNoLock(row, query.transpose());
+            });
+            break;
+        case SearchEngine::PQ:
+            topk_pairs = pq_index->search(query, nCandidatesNoLock(topk), n_threads_, mask);
+            rerankNoLock(query, topk_pairs, topk, metric != SearchAlgorithm::Metric::COSINE);
+            break;
+        default:
+            if (useQuantizedNoLock(topk)){
+                topk_pairs = quantized->searchTopK(normsNoLock(), query, nCandidatesNoLock(topk), n_threads_, metric, mask);
+                rerankNoLock(query, topk_pairs, topk);
+            }
+            else{
+                topk_pairs = SearchAlgorithm::dispatchMetric(metric, [&](auto m){
+                    return SearchAlgorithm::similarityTopK<decltype(m)::value>(rowsNoLock(), normsNoLock(), query, topk, n_threads_, mask);
+                });
+            }
+    }
+    return topk_pairs;
+}
+
+template <typename NumT>
+typename VectorCollectionImpl<NumT>::RowFilter VectorCollectionImpl<NumT>::rowFilterNoLock(const SearchFilter* filter){
+    RowFilter ret;
+    ret.n_allowed = n_rows;
+    ret.sparse = false;
+    if (!filter){
+        return ret;
+    }
+    ret.mask.assign(n_rows, 1);
+    if (filter->mask){
+        if (filter->mask->size() != n_rows){
+            throw std::runtime_error("mask size not match");
+        }
+        for (int row = 0; row < n_rows; row++){
+            ret.mask[row] = (*filter->mask)[row] != 0;
+        }
+    }
+    if (filter->ids){
+        std::vector<uint8_t> listed(n_rows, 0);
+        for (const std::string& id : *filter->ids){
+            auto it = id2idx_.find(id);
+            if (it != id2idx_.end()){
+                listed[it->second] = 1;
+            }
+        }
+        for (int row = 0; row < n_rows; row++){
+            ret.mask[row] &= listed[row];
+        }
+    }
+    if (filter->prefix){
+        const std::string& prefix = *filter->prefix;
+        for (int row = 0; row < n_rows; row++){
+            if (ret.mask[row] && (*identifiers)[row].compare(0, prefix.size(), prefix) != 0){
+                ret.mask[row] = 0;
+            }
+        }
+    }
+    for (auto& kv : filter->where){
+        attributes->filter(kv.first, kv.second, ret.mask);
+    }
+    ret.n_allowed = std::count(ret.mask.begin(), ret.mask.end(), 1);
+    ret.sparse = (long long)ret.n_allowed * SPARSE_FILTER_RATIO <= n_rows;
+    if (ret.sparse){
+        ret.rows.reserve(ret.n_allowed);
+        for (int row = 0; row < n_rows; row++){
+            if (ret.mask[row]){
+                ret.rows.push_back(row);
+            }
+        }
+    }
+    return ret;
+}
+
+template <typename NumT>
+std::tuple<std::vector<StringVector>, std::vector<std::vector<float>>> VectorCollectionImpl<NumT>::searchBatch(
+    const std::vector<std::vector<NumT>>& queries, int topk, const std::string& index, const SearchFilter* filter
+    ){
+    MatrixF query_matrix = toMatrix(queries, dim);
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    return searchBatchNoLock(query_matrix, topk, index, filter);
+}
+
+template <typename NumT>
+std::tuple<std::vector<StringVector>, std::vector<std::vector<float>>> VectorCollectionImpl<NumT>::searchBatchBuffer(
+    py::buffer queries, int topk, const std::string& index, const SearchFilter* filter
+    ){
+    py::buffer_info info = queries.request();
+    py::gil_scoped_release release;
+    auto query_matrix = bufferAsMatrix<NumT>(info, dim);
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    return searchBatchNoLock(query_matrix, topk, index, filter);
+}
+
+template <typename NumT>
+std::tuple<std::vector<StringVector>, std::vector<std::vector<float>>> VectorCollectionImpl<NumT>::searchBatchNoLock(
+    const MatrixFCRef& queries, int topk, const std::string& index, const SearchFilter* filter
+    ){
+    const RowFilter row_filter = rowFilterNoLock(filter);
+    if (topk > row_filter.n_allowed or topk == -1){
+        topk = row_filter.n_allowed;
+    }
+    std::vector<std::vector<std::pair<float, int>>> topk_pairs;
+    const SearchEngine engine = selectEngineNoLock(index);
+    if (engine != SearchEngine::FLAT || row_filter.sparse){
+        // queries are distributed to the threads
+        topk_pairs.resize(queries.rows());
+        const int n_tasks = std::max(1, std::min(n_threads, (int)queries.rows()));
+        ThreadPool::instance().parallelFor(n_tasks, [&](int t){
+            for (int q = t; q < queries.rows(); q += n_tasks){
+                topk_pairs[q] = searchTopKNoLock(queries.row(q).transpose(), topk, engine, row_filter, 1);
+            }
+        });
+    }
+    else if (topk <= 0){
+        topk_pairs.resize(queries.rows());
+    }
+    else if (useQuantizedNoLock(topk)){
+        topk_pairs = quantized->searchTopKBatch(normsNoLock(), queries, nCandidatesNoLock(topk), n_threads, metric, row_filter.maskData());
+        for (int q = 0; q < queries.rows(); q++){
+            rerankNoLock(queries.row(q).transpose(), topk_pairs[q], topk);
+        }
+    }
+    else{
+        topk_pairs = SearchAlgorithm::dispatchMetric(metric, [&](auto m){
+            return SearchAlgorithm::similarityTopKBatch<decltype(m)::value>(rowsNoLock(), normsNoLock(), queries, topk, n_threads, row_filter.maskData());
+        });
+    }
+
+    std::vector<StringVector> topk_ids = std::vector<StringVector>(queries.rows());
+    std::vector<std::vector<float>> topk_scores = std::vector<std::vector<float>>(queries.rows());
+    for (int q = 0; q < queries.rows(); q++){
+        // the probed lists may have less than topk rows
+        const int n_found = topk_pairs[q].size();
+        topk_ids[q] = StringVector(n_found);
+        topk_scores[q] = std::vector<float>(n_found);
+        for (int i = 0; i < n_found; i++){
+            topk_ids[q][i] = identifiers->at(topk_pairs[q][i].second);
+            topk_scores[q][i] = topk_pairs[q][i].first;
+        }
+    }
+    return std::make_tuple(topk_ids, topk_scores);
+}
+
+template <typename NumT>
+void VectorCollectionImpl<NumT>::setAttributes(const std::string& key, const StringVector& ids, const std::vector<Attribute>& values){
+    if (ids.size() != values.size()){
+        throw std::runtime_error("ids and values size not match");
+    }
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    std::vector<int> rows(ids.size());
+    for (int i = 0; i < ids.size(); i++){
+        auto it = id2idx_.find(ids[i]);
+        if (it == id2idx_.end()){
+            throw std::runtime_error("id not found: " + ids[i]);
+        }
+        rows[i] = it->second;
+    }
+    for (int i = 0; i < ids.size(); i++){
+        attributes->set(key, rows[i], values[i]);
+    }
+}
+
+template <typename NumT>
+std::vector<Attribute> VectorCollectionImpl<NumT>::getAttributes(const std::string& key, const StringVector& ids){
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    std::vector<Attribute> ret;
+    ret.reserve(ids.size());
+    for (const std::string& id : ids){
+        auto it = id2idx_.find(id);
+        if (it == id2idx_.end()){
+            throw std::runtime_error("id not found: " + id);
+        }
+        ret.push_back(attributes->get(key, it->second));
+    }
+    return ret;
+}
+
+template <typename NumT>
+StringVector VectorCollectionImpl<NumT>::attributeKeys(){
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    return attributes->keys();
+}
+
+template <typename NumT>
+typename VectorCollectionImpl<NumT>::SearchEngine VectorCollectionImpl<NumT>::selectEngineNoLock(const std::string& index){
+    if (index == "hnsw"){
+        if (!hnsw_index) throw std::runtime_error("hnsw index is not built");
+        return SearchEngine::HNSW;
+    }
+    if (index == "ivf"){
+        if (!ivf_index->trained()) throw std::runtime_error("ivf index is not trained");
+        return SearchEngine::IVF;
+    }
+    if (index == "pq"){
+        if (!pq_index->trained()) throw std::runtime_error("pq index is not trained");
+        return SearchEngine::PQ;
+    }
+    // the codes are the only rows if the rows are stored as the pq codes, a flat search is the search of the pq index
+    const SearchEngine flat = pqStorageNoLock() ? SearchEngine::PQ : SearchEngine::FLAT;
+    if (index == "flat"){
+        return flat;
+    }
+    if (!index.empty()){
+        throw std::runtime_error("unknown index: " + index);
+    }
+    if (hnsw_index){
+        return SearchEngine::HNSW;
+    }
+    // probing all lists is exhaustive, no need to go through the index
+    if (ivf_index->trained() && nprobe < ivf_index->nLists()){
+        return SearchEngine::IVF;
+    }
+    if (pq_index->trained()){
+        return SearchEngine::PQ;
+    }
+    return flat;
+}
+
+template <typename NumT>
+void VectorCollectionImpl<NumT>::trainIndex(int n_lists, int n_iter){
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    if (keep_rows_){
+        ivf_index->train(rowsNoLock(), n_lists, n_iter, n_threads);
+    }
+    else{
+        // the decoded rows are only held during training
+        ivf_index->train(decodedRowsNoLock(), n_lists, n_iter, n_threads);
+    }
+}
+
+template <typename NumT>
+void VectorCollectionImpl<NumT>::dropIndex(){
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    ivf_index->clear();
+}
+
+template <typename NumT>
+bool VectorCollectionImpl<NumT>::isIndexTrained(){
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    return ivf_index->trained();
+}
+
+template <typename NumT>
+void VectorCollectionImpl<NumT>::setNprobe(int n){
+    if (n < 1){
+        throw std::runtime_error("nprobe should be positive");
+    }
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    nprobe = n;
+}
+
+template <typename NumT>
+int VectorCollectionImpl<NumT>::getNprobe(){
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    return nprobe;
+}
+
+template <typename NumT>
+std::pair<StringVector, std::vector<int>> VectorCollectionImpl<NumT>::existingRowsNoLock(const std::optional<StringVector>& ids){
+    std::pair<StringVector, std::vector<int>> ret;
+    if (!ids){
+        ret.first = *identifiers;
+        ret.second.resize(n_rows);
+        std::iota(ret.second.begin(), ret.second.end(), 0);
+        return ret;
+    }
+    for (const std::string& id : *ids){
+        auto it = id2idx_.find(id);
+        if (it != id2idx_.end()){
+            ret.first.push_back(id);
+            ret.second.push_back(it->second);
+        }
+    }
+    return ret;
+}
+
+template <typename NumT>
+std::tuple<StringVector, py::array_t<NumT>, std::vector<int>> VectorCollectionImpl<NumT>::dumpIndex(const std::optional<StringVector>& ids){
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    const MatrixF& centroids = ivf_index->getCentroids();
+    py::array_t<NumT> centroids_array({(py::ssize_t)centroids.rows(), (py::ssize_t)dim});
+    std::copy(centroids.data(), centroids.data() + centroids.size(), centroids_array.mutable_data());
+    auto [found_ids, rows] = existingRowsNoLock(ids);
+    const std::vector<int>& row_lists = ivf_index->getRowLists();
+    std::vector<int> lists(rows.size());
+    for (size_t i = 0; i < rows.size(); i++){
+        lists[i] = row_lists[rows[i]];
+    }
+    return std::make_tuple(found_ids, centroids_array, lists);
+}
+
+template <typename NumT>
+void VectorCollectionImpl<NumT>::loadIndex(const StringVector& ids, py::buffer centroids, const std::vector<int>& lists){
+    if (ids.size() != lists.size()){
+        throw std::runtime_error("ids and lists size not match");
+    }
+    py::buffer_info info = centroids.request();
+    py::gil_scoped_release release;
+    auto centroid_matrix = bufferAsMatrix<NumT>(info, dim);
+    std::unordered_map<std::string, int> saved_lists;
+    saved_lists.reserve(ids.size());
+    for (int i = 0; i < ids.size(); i++){
+        saved_lists.emplace(ids[i], lists[i]);
+    }
+
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    IVFIndex loaded;
+    loaded.load(centroid_matrix, {});
+    std::vector<int> row_lists(n_rows);
+    for (int i = 0; i < n_rows; i++){
+        auto it = saved_lists.find((*identifiers)[i]);
+        row_lists[i] = it != saved_lists.end() ? it->second : loaded.assign(rowVectorNoLock(i));
+    }
+    ivf_index->load(centroid_matrix, row_lists);
+}
+
+template <typename NumT>
+int VectorCollectionImpl<NumT>::nCandidatesNoLock(int topk){
+    return rerank > 0 ? (int)std::min((long long)topk * rerank, (long long)n_rows) : topk;
+}
+
+template <typename NumT>
+bool VectorCollectionImpl<NumT>::useQuantizedNoLock(int topk){
+    // when most of the rows are candidates anyway, scoring the float32 rows is as cheap and exact
+    return quantized->enabled() && (!keep_rows_ || (long long)nCandidatesNoLock(topk) * 4 < n_rows);
+}
+
+template <typename NumT>
+std::vector<std::pair<float, int>> VectorCollectionImpl<NumT>::hnswSearchNoLock(
+    const Eigen::Vector<NumT, FEAT_DIM>& query, int topk, const RowFilter& filter
+    ){
+    // the beam is widened as the filtered out nodes are still traversed
+    const int ef = (int)std::min((long long)ef_search * n_rows / std::max(filter.n_allowed, 1), (long long)n_rows);
+    if (metric == SearchAlgorithm::Metric::COSINE){
+        // the candidates for the caller to re-rank if the float32 rows are not kept
+        return hnsw_index->search(query, keep_rows_ ? topk : nCandidatesNoLock(topk), ef, hnswSpaceNoLock(), filter.maskData());
+    }
+    // the graph is searched by angle, the candidates are re-scored with the metric
+    std::vector<std::pair<float, int>> candidates = hnsw_index->search(
+        query, nCandidatesNoLock(topk), std::max(ef, nCandidatesNoLock(topk)), hnswSpaceNoLock(), filter.maskData()
+        );
+    rerankNoLock(query, candidates, topk, true);
+    return candidates;
+}
+
+template <typename NumT>
+void VectorCollectionImpl<NumT>::rerankNoLock(
+    const Eigen::Vector<NumT, FEAT_DIM>& query, std::vector<std::pair<float, int>>& candidates, int topk, bool force
+    ){
+    if (rerank <= 0 && !force){
+        return;
+    }
+    const int n_keep = std::min(keep_rows_ ? topk : nCandidatesNoLock(topk), (int)candidates.size());
+    if (!keep_rows_ && !force){
+        // already sorted by the quantized scores
+        candidates.resize(n_keep);
+        return;
+    }
+    const float norm_query = query.norm();
+    auto rows = rowsNoLock();
+    auto norms = normsNoLock();
+    for (auto& c : candidates){
+        const float dot = keep_rows_ ? rows.row(c.second).dot(query.transpose()) : approxDotNoLock(c.second, query.transpose());
+        c.first = SearchAlgorithm::scoreFromDot(metric, dot, norm_query, norms[c.second]);
+    }
+    std::partial_sort(candidates.begin(), candidates.begin() + n_keep, candidates.end(), SearchAlgorithm::largerScore);
+    candidates.resize(n_keep);
+}
+
+template <typename NumT>
+std::vector<std::pair<float, int>> VectorCollectionImpl<NumT>::approxTopKRowsNoLock(
+    const Eigen::Vector<NumT, FEAT_DIM>& query, const std::vector<int>& rows, int k
+    ){
+    const float norm_query = query.norm();
+    auto norms = normsNoLock();
+    std::vector<std::pair<float, int>> heap;
+    heap.reserve(k);
+    for (int row : rows){
+        SearchAlgorithm::pushTopK(heap, k, SearchAlgorithm::scoreFromDot(metric, approxDotNoLock(row, query.transpose()), norm_query, norms[row]), row);
+    }
+    std::sort_heap(heap.begin(), heap.end(), SearchAlgorithm::largerScore);
+    return heap;
+}
+
+template <typename NumT>
+void VectorCollectionImpl<NumT>::trainPQ(int n_sub, int n_iter){
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    if (pqStorageNoLock()){
+        throw std::runtime_error("the rows are stored as the pq codes, cannot train the pq index again");
+    }
+    if (keep_rows_){
+        pq_index->train(rowsNoLock(), n_sub, n_iter, n_threads);
+    }
+    else{
+        pq_index->train(decodedRowsNoLock(), n_sub, n_iter, n_threads);
+    }
+}
+
+template <typename NumT>
+void VectorCollectionImpl<NumT>::dropPQ(){
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    if (pqStorageNoLock()){
+        throw std::runtime_error("the rows are stored as the pq codes, cannot drop the pq index");
+    }
+    pq_index->clear();
+}
+
+template <typename NumT>
+bool VectorCollectionImpl<NumT>::isPQTrained(){
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    return pq_index->trained();
+}
+
+template <typename NumT>
+std::tuple<StringVector, py::array_t<float>, int, py::list> VectorCollectionImpl<NumT>::dumpPQ(const std::optional<StringVector>& ids){
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    if (!pq_index->trained()){
+        throw std::runtime_error("pq index is not trained");
+    }
+    const Eigen::MatrixXf& codebooks = pq_index->getCodebooks();
+    py::array_t<float> codebooks_array({(py::ssize_t)codebooks.rows(), (py::ssize_t)codebooks.cols()});
+    // codebooks are column-major
+    Eigen::Map<Eigen::Matrix<float, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor>>(
+        codebooks_array.mutable_data(), codebooks.rows(), codebooks.cols()
+        ) = codebooks;
+    auto [found_ids, rows] = existingRowsNoLock(ids);
+    py::list saved_rows(rows.size());
+    for (size_t i = 0; i < rows.size(); i++){
+        saved_rows[i] = py::bytes(pq_index->encodeRow(rows[i], normsNoLock()[rows[i]]));
     }
-    return py::make_tuple(topk_ids, topk_scores);
+    return std::make_tuple(found_ids, codebooks_array, pq_index->nSub(), saved_rows);
+}
+
+template <typename NumT>
+void VectorCollectionImpl<NumT>::loadPQ(const StringVector& ids, py::buffer codebooks, int n_sub, const std::vector<std::string>& rows){
+    py::buffer_info info = codebooks.request();
+    if (info.format.back() != py::format_descriptor<float>::c || info.ndim != 2){
+        throw std::runtime_error("codebooks should be a 2-dimensional float32 buffer");
+    }
+    if (n_sub < 1 || rows.size() != ids.size()){
+        throw std::runtime_error("ids and rows size not match");
+    }
+    Eigen::MatrixXf codebooks_matrix = Eigen::Map<const Eigen::Matrix<float, Eigen::Dynamic, Eigen::Dynamic, Eigen::RowMajor>, 0, Eigen::Stride<Eigen::Dynamic, Eigen::Dynamic>>(
+        (const float*)info.ptr, info.shape[0], info.shape[1], 
+        Eigen::Stride<Eigen::Dynamic, Eigen::Dynamic>(info.strides[0] / sizeof(float), info.strides[1] / sizeof(float))
+        );
+    py::gil_scoped_release release;
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    if (pqStorageNoLock()){
+        throw std::runtime_error("the rows are stored as the pq codes, cannot load the pq index again");
+    }
+    pq_index->load(codebooks_matrix, n_sub, PQIndex::Codes::Zero(n_rows, n_sub));
+    std::vector<bool> restored(n_rows, false);
+    for (int i = 0; i < ids.size(); i++){
+        auto it = id2idx_.find(ids[i]);
+        if (it != id2idx_.end()){
+            restored[it->second] = pq_index->loadCodes(it->second, rows[i]);
+        }
+    }
+    for (int row = 0; row < n_rows; row++){
+        if (!restored[row]){
+            pq_index->update(row, rowVectorNoLock(row));
+        }
+    }
+}
+
+template <typename NumT>
+void VectorCollectionImpl<NumT>::setDtype(const std::string& dtype){
+    QuantizedStorage::Type type = QuantizedStorage::parseType(dtype);
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    if (type == quantized->type()){
+        return;
+    }
+    if (!keep_rows_){
+        throw std::runtime_error("the float32 rows are not kept, cannot change the dtype");
+    }
+    quantized->build(rowsNoLock(), type);
+}
+
+template <typename NumT>
+std::string VectorCollectionImpl<NumT>::getDtype(){
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    return QuantizedStorage::typeName(quantized->type());
+}
+
+template <typename NumT>
+void VectorCollectionImpl<NumT>::setMetric(const std::string& name){
+    SearchAlgorithm::Metric m = SearchAlgorithm::parseMetric(name);
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    metric = m;
+}
+
+template <typename NumT>
+std::string VectorCollectionImpl<NumT>::getMetric(){
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    return SearchAlgorithm::metricName(metric);
+}
+
+template <typename NumT>
+void VectorCollectionImpl<NumT>::setRerank(int n){
+    if (n < 0){
+        throw std::runtime_error("rerank should not be negative");
+    }
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    rerank = n;
+}
+
+template <typename NumT>
+int VectorCollectionImpl<NumT>::getRerank(){
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    return rerank;
+}
+
+template <typename NumT>
+size_t VectorCollectionImpl<NumT>::quantizedBytes(){
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    return quantized->nbytes();
+}
+
+template <typename NumT>
+std::tuple<StringVector, py::list> VectorCollectionImpl<NumT>::dumpQuantized(const StringVector& ids){
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    if (!quantized->enabled()){
+        throw std::runtime_error("dtype is not quantized");
+    }
+    auto [found_ids, rows] = existingRowsNoLock(ids);
+    py::list blobs(rows.size());
+    for (size_t i = 0; i < rows.size(); i++){
+        blobs[i] = py::bytes(quantized->encodeRow(rows[i], normsNoLock()[rows[i]]));
+    }
+    return std::make_tuple(found_ids, blobs);
+}
+
+template <typename NumT>
+void VectorCollectionImpl<NumT>::setKeepRows(bool keep){
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    if (keep == keep_rows_){
+        return;
+    }
+    if (keep){
+        if (n_rows != 0){
+            throw std::runtime_error("the float32 rows are not kept, cannot keep them again unless the collection is empty");
+        }
+        vector_chunk->resize(vector_norms->size(), dim);
+        keep_rows_ = true;
+        return;
+    }
+    if (!quantized->enabled() && !pq_index->trained()){
+        throw std::runtime_error("dtype is not quantized and the pq index is not trained, cannot drop the float32 rows");
+    }
+    if (mapped_vectors_){
+        throw std::runtime_error("the rows are mapped, cannot drop the float32 rows");
+    }
+    // the changed vectors are still to be flushed
+    for (const auto& [id, type] : mod_map){
+        if (type != ModificaionType::DELETE){
+            auto row = rowsNoLock().row(id2idx_[id]);
+            pending_[id] = std::vector<NumT>(row.data(), row.data() + dim);
+        }
+    }
+    keep_rows_ = false;
+    vector_chunk->resize(0, dim);
+}
+
+template <typename NumT>
+bool VectorCollectionImpl<NumT>::getKeepRows(){
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    return keep_rows_;
+}
+
+template <typename NumT>
+std::tuple<StringVector, py::array_t<NumT>> VectorCollectionImpl<NumT>::getPending(const StringVector& ids){
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    StringVector found_ids;
+    for (const std::string& id : ids){
+        if (pending_.count(id)){
+            found_ids.push_back(id);
+        }
+    }
+    py::array_t<NumT> vectors({(py::ssize_t)found_ids.size(), (py::ssize_t)dim});
+    for (size_t i = 0; i < found_ids.size(); i++){
+        std::copy_n(pending_.at(found_ids[i]).data(), dim, vectors.mutable_data() + i * dim);
+    }
+    return std::make_tuple(found_ids, vectors);
+}
+
+template <typename NumT>
+HNSWSpace VectorCollectionImpl<NumT>::hnswSpaceNoLock(){
+    if (!keep_rows_){
+        return HNSWSpace{rowsNoLock(), normsNoLock(), [this](int row){ return rowVectorNoLock(row); }};
+    }
+    return HNSWSpace{rowsNoLock(), normsNoLock(), nullptr};
+}
+
+template <typename NumT>
+void VectorCollectionImpl<NumT>::buildHNSW(int M, int ef_construction){
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    rebuildHNSWNoLock(M, ef_construction);
+}
+
+template <typename NumT>
+void VectorCollectionImpl<NumT>::rebuildHNSWNoLock(int M, int ef_construction){
+    HNSWIndex* index = new HNSWIndex(M, ef_construction);
+    HNSWSpace space = hnswSpaceNoLock();
+    for (int i = 0; i < n_rows; i++){
+        index->addRow(i, space);
+    }
+    delete hnsw_index;
+    hnsw_index = index;
+}
+
+template <typename NumT>
+void VectorCollectionImpl<NumT>::dropHNSW(){
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    delete hnsw_index;
+    hnsw_index = nullptr;
+}
+
+template <typename NumT>
+bool VectorCollectionImpl<NumT>::hasHNSW(){
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    return hnsw_index != nullptr;
+}
+
+template <typename NumT>
+void VectorCollectionImpl<NumT>::setEfSearch(int ef){
+    if (ef < 1){
+        throw std::runtime_error("ef should be positive");
+    }
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    ef_search = ef;
+}
+
+template <typename NumT>
+int VectorCollectionImpl<NumT>::getEfSearch(){
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    return ef_search;
+}
+
+template <typename NumT>
+py::dict VectorCollectionImpl<NumT>::hnswInfo(){
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
+    if (!hnsw_index){
+        throw std::runtime_error("hnsw index is not built");
+    }
+    py::dict ret;
+    ret["M"] = hnsw_index->getM();
+    ret["ef_construction"] = hnsw_index->getEfConstruction();
+    ret["entry"] = hnsw_index->getEntry();
+    ret["max_level"] = hnsw_index->getMaxLevel();
+    ret["n_nodes"] = hnsw_index->nNodes();
+    ret["n_deleted"] = hnsw_index->nDeleted();
+    return ret;
+}
+
+template <typename NumT>
+py::list VectorCollectionImpl<NumT>::dumpHNSW(bool all){
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    if (!hnsw_index){
+        throw std::runtime_error("hnsw index is not built");
+    }
+    std::vector<int> nodes;
+    if (all){
+        hnsw_index->takeDirtyNodes();
+        nodes.resize(hnsw_index->nNodes());
+        std::iota(nodes.begin(), nodes.end(), 0);
+    }
+    else{
+        nodes = hnsw_index->takeDirtyNodes();
+        std::sort(nodes.begin(), nodes.end());
+    }
+    py::list ret(nodes.size());
+    for (size_t i = 0; i < nodes.size(); i++){
+        const int node = nodes[i];
+        const int row = hnsw_index->nodeRow(node);
+        std::vector<int> links = hnsw_index->flatLinks(node);
+        ret[i] = py::make_tuple(
+            node, 
+            row >= 0 ? py::object(py::str((*identifiers)[row])) : py::object(py::none()), 
+            hnsw_index->nodeLevel(node), 
+            py::bytes((const char*)links.data(), links.size() * sizeof(int))
+        );
+    }
+    return ret;
+}
+
+template <typename NumT>
+void VectorCollectionImpl<NumT>::loadHNSW(
+    int M, int ef_construction, int entry, int max_level, 
+    const std::vector<std::tuple<int, std::optional<std::string>, int, std::string>>& nodes
+    ){
+    py::gil_scoped_release release;
+    HNSWIndex* index = new HNSWIndex(M, ef_construction);
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    try{
+        for (const auto& [node, id, level, links_bytes] : nodes){
+            std::vector<int> links(links_bytes.size() / sizeof(int));
+            std::memcpy(links.data(), links_bytes.data(), links.size() * sizeof(int));
+            int row = -1;
+            if (id.has_value()){
+                auto it = id2idx_.find(*id);
+                if (it == id2idx_.end()){
+                    throw std::runtime_error("id of hnsw node not found: " + *id);
+                }
+                row = it->second;
+            }
+            index->restoreNode(node, row, level, links);
+        }
+        index->finishRestore(entry, max_level, n_rows);
+    }
+    catch (...){
+        delete index;
+        throw;
+    }
+    delete hnsw_index;
+    hnsw_index = index;
+}
+
+template <typename NumT>
+void VectorCollectionImpl<NumT>::restoreModifications(
+    const StringVector& add_ids, const std::vector<std::string>& add_values, 
+    const StringVector& update_ids, const std::vector<std::string>& update_values, const StringVector& delete_ids
+    ){
+    if (add_ids.size() != add_values.size() || update_ids.size() != update_values.size()){
+        throw std::runtime_error("ids and vectors size not match");
+    }
+    std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+    auto restore = [&](const StringVector& ids, ModificaionType type){
+        for (const std::string& id : ids){
+            auto it = mod_map.find(id);
+            if (it == mod_map.end()){
+                mod_map.emplace(id, type);
+            }
+            else if (type == ModificaionType::ADD && it->second == ModificaionType::DELETE){
+                // added and then deleted, never on disk
+                mod_map.erase(it);
+            }
+            else if (type == ModificaionType::ADD || (type == ModificaionType::DELETE && it->second == ModificaionType::ADD)){
+                // added and then updated is still an ADD, deleted and then added again is an UPDATE
+                it->second = type == ModificaionType::ADD ? ModificaionType::ADD : ModificaionType::UPDATE;
+            }
+            // otherwise the later modification (UPDATE or DELETE) overrides
+        }
+    };
+    restore(add_ids, ModificaionType::ADD);
+    restore(update_ids, ModificaionType::UPDATE);
+    restore(delete_ids, ModificaionType::DELETE);
+    if (keep_rows_){
+        return;
+    }
+    // a vector changed since the flush is already pending
+    auto restorePending = [&](const StringVector& ids, const std::vector<std::string>& values){
+        for (size_t i = 0; i < ids.size(); i++){
+            auto it = mod_map.find(ids[i]);
+            if (it != mod_map.end() && it->second != ModificaionType::DELETE && !pending_.count(ids[i])){
+                std::vector<NumT> vec(dim);
+                VectorBinaryEncode::decodeTo<NumT>(values[i], vec.data(), dim);
+                pending_.emplace(ids[i], std::move(vec));
+            }
+        }
+    };
+    restorePending(add_ids, add_values);
+    restorePending(update_ids, update_values);
 }
 
 template <typename NumT>
@@ -280,48 +1611,62 @@ py::dict VectorCollectionImpl<NumT>::flush(){
     py::dict ret;
 
     StringVector add_ids;
-    // std::vector<std::vector<NumT>> add_values;
-    std::vector<std::string> add_values;    // encode vector to string
+    std::vector<std::string> add_values;    // encode vector to bytes
 
     StringVector update_ids;
-    // std::vector<std::vector<NumT>> update_values;
-    std::vector<std::string> update_values; // encode vector to string
+    std::vector<std::string> update_values; // encode vector to bytes
 
     StringVector delete_ids;
 
-    for (auto it = mod_map.begin(); it != mod_map.end(); it++){
-        if (it->second == ModificaionType::ADD){
-            add_ids.push_back(it->first);
-            std::string encoded = VectorStringEncode::encode(get(it->first));
-            add_values.push_back(encoded);
-        }
-        else if (it->second == ModificaionType::UPDATE){
-            update_ids.push_back(it->first);
-            std::string encoded = VectorStringEncode::encode(get(it->first));
-            update_values.push_back(encoded);
-        }
-        else{
-            delete_ids.push_back(it->first);
+    {
+        // gather and encode without the GIL, the lock must be released before the GIL is re-acquired
+        py::gil_scoped_release release;
+        std::unique_lock<std::shared_mutex> lock(rw_mtx_);
+        for (auto it = mod_map.begin(); it != mod_map.end(); it++){
+            // the exact vectors are pending if the float32 rows are not kept
+            const NumT* data = it->second == ModificaionType::DELETE ? nullptr : 
+                keep_rows_ ? rowsNoLock().row(id2idx_[it->first]).data() : pending_.at(it->first).data();
+            if (it->second == ModificaionType::ADD){
+                add_ids.push_back(it->first);
+                add_values.push_back(VectorBinaryEncode::encode(data, dim));
+            }
+            else if (it->second == ModificaionType::UPDATE){
+                update_ids.push_back(it->first);
+                update_values.push_back(VectorBinaryEncode::encode(data, dim));
+            }
+            else{
+                delete_ids.push_back(it->first);
+            }
         }
+        mod_map.clear();
+        pending_.clear();
     }
     // std::cout << "flush: " << add_ids.size() << " " << update_ids.size() << " " << delete_ids.size() << std::endl;
 
-    ret["ADD"] = py::make_tuple(add_ids, add_values);
-    ret["UPDATE"] = py::make_tuple(update_ids, update_values);
+    // std::string is converted to python str by default, make bytes explicitly
+    auto toBytesList = [](const std::vector<std::string>& values){
+        py::list ret(values.size());
+        for (size_t i = 0; i < values.size(); i++){
+            ret[i] = py::bytes(values[i]);
+        }
+        return ret;
+    };
+    ret["ADD"] = py::make_tuple(add_ids, toBytesList(add_values));
+    ret["UPDATE"] = py::make_tuple(update_ids, toBytesList(update_values));
     ret["DELETE"] = py::make_tuple(delete_ids, py::none());
-    mod_map.clear();
     return ret;
 }
 
 template <typename NumT>
 void VectorCollectionImpl<NumT>::print(){
     // for debug
+    std::shared_lock<std::shared_mutex> lock(rw_mtx_);
     std::cout << "VectorCollectionImpl" << std::endl;
-    std::cout << "- size: " << size() << std::endl;
-    for (int i=0; i<size(); i++){
+    std::cout << "- size: " << n_rows << std::endl;
+    for (int i=0; i<n_rows; i++){
         std::cout << "[" << identifiers->at(i) << "] ";
-        for (int j=0; j<FEAT_DIM; j++){
-            std::cout << (*vector_chunk)(i, j) << " ";
+        for (int j=0; j<dim; j++){
+            std::cout << rowVectorNoLock(i)(j) << " ";
         }
         std::cout << std::endl;
     }
@@ -330,32 +1675,97 @@ void VectorCollectionImpl<NumT>::print(){
 PYBIND11_MODULE(MODULE_NAME, m){
     m.doc() = "pybind11 vecdbImpl plugin";
 
+    // the GIL is released for calls that can take long or wait on the reader/writer lock inside VectorCollectionImpl, 
+    // so that a thread waiting for the lock does not block the other python threads, 
+    // the *Buffer methods release the GIL by themselves after the buffer is acquired
+    using release_gil = py::call_guard<py::gil_scoped_release>;
+    py::class_<SearchFilter>(m, "SearchFilter", py::module_local())
+        .def(py::init<>())
+        .def_readwrite("ids", &SearchFilter::ids)
+        .def_readwrite("prefix", &SearchFilter::prefix)
+        .def_readwrite("where", &SearchFilter::where)
+        .def_readwrite("mask", &SearchFilter::mask);
     py::class_< VectorCollectionImpl<num_t> >(m, "VectorCollectionImpl", py::module_local())
-        .def(py::init<>(
-            // [](){
-            //     std::cout<< "!!! The package is build with FEAT_DIM: " << FEAT_DIM <<std::endl;
-            //     return new VectorCollectionImpl<num_t>();
-            // }
-        ))
-        .def("addBulk", &VectorCollectionImpl<num_t>::addBulk)
-        .def("addRawEncBulk", &VectorCollectionImpl<num_t>::addRawEncBulk)
-        .def("setBulk", &VectorCollectionImpl<num_t>::setBulk)
-        .def("size", &VectorCollectionImpl<num_t>::size)
-        .def("has", &VectorCollectionImpl<num_t>::has)
-        .def("update", &VectorCollectionImpl<num_t>::update)
-        .def("get", &VectorCollectionImpl<num_t>::get)
-        .def("getBulk", &VectorCollectionImpl<num_t>::getBulk)
-        .def("getAllIds", &VectorCollectionImpl<num_t>::getAllIds)
-        .def("deleteBulk", &VectorCollectionImpl<num_t>::deleteBulk)
+        .def(py::init<int>(), py::arg("dim") = FEAT_DIM)
+        .def_readonly("dim", &VectorCollectionImpl<num_t>::dim)
+        .def("addBulk", &VectorCollectionImpl<num_t>::addBulk, release_gil())
+        .def("addBulkBuffer", &VectorCollectionImpl<num_t>::addBulkBuffer)
+        .def("addRawEncBulk", &VectorCollectionImpl<num_t>::addRawEncBulk, release_gil())
+        .def("addRawBinBulk", &VectorCollectionImpl<num_t>::addRawBinBulk, release_gil())
+        .def("addRawQuantizedBulk", &VectorCollectionImpl<num_t>::addRawQuantizedBulk, release_gil())
+        .def("mapBuffer", &VectorCollectionImpl<num_t>::mapBuffer, 
+            py::arg("ids"), py::arg("vectors"), py::arg("norms"), py::arg("quantized") = std::vector<std::string>())
+        .def("isMapped", &VectorCollectionImpl<num_t>::isMapped)
+        .def("setBulk", &VectorCollectionImpl<num_t>::setBulk, release_gil())
+        .def("setBulkBuffer", &VectorCollectionImpl<num_t>::setBulkBuffer)
+        .def("size", &VectorCollectionImpl<num_t>::size, release_gil())
+        .def("capacity", &VectorCollectionImpl<num_t>::capacity, release_gil())
+        .def("memoryBytes", &VectorCollectionImpl<num_t>::memoryBytes, release_gil())
+        .def("reserve", &VectorCollectionImpl<num_t>::reserve, release_gil())
+        .def("has", &VectorCollectionImpl<num_t>::has, release_gil())
+        .def("update", &VectorCollectionImpl<num_t>::update, release_gil())
+        .def("get", &VectorCollectionImpl<num_t>::get, release_gil())
+        .def("getBulk", &VectorCollectionImpl<num_t>::getBulk, release_gil())
+        .def("getBulkArray", &VectorCollectionImpl<num_t>::getBulkArray)
+        .def("getAllIds", &VectorCollectionImpl<num_t>::getAllIds, release_gil())
+        .def("deleteBulk", &VectorCollectionImpl<num_t>::deleteBulk, release_gil())
         .def("print", &VectorCollectionImpl<num_t>::print)
-        .def("search", &VectorCollectionImpl<num_t>::search)
-        .def("score", &VectorCollectionImpl<num_t>::score)
-        .def("flush", &VectorCollectionImpl<num_t>::flush);
+        .def("setNumThreads", &VectorCollectionImpl<num_t>::setNumThreads)
+        .def("getNumThreads", &VectorCollectionImpl<num_t>::getNumThreads)
+        .def("search", &VectorCollectionImpl<num_t>::search, 
+            py::arg("query"), py::arg("topk") = -1, py::arg("index") = "", py::arg("filter") = nullptr, release_gil())
+        .def("searchBuffer", &VectorCollectionImpl<num_t>::searchBuffer, 
+            py::arg("query"), py::arg("topk") = -1, py::arg("index") = "", py::arg("filter") = nullptr)
+        .def("searchBatch", &VectorCollectionImpl<num_t>::searchBatch, 
+            py::arg("queries"), py::arg("topk") = -1, py::arg("index") = "", py::arg("filter") = nullptr, release_gil())
+        .def("searchBatchBuffer", &VectorCollectionImpl<num_t>::searchBatchBuffer, 
+            py::arg("queries"), py::arg("topk") = -1, py::arg("index") = "", py::arg("filter") = nullptr)
+        .def("score", &VectorCollectionImpl<num_t>::score, release_gil())
+        .def("setAttributes", &VectorCollectionImpl<num_t>::setAttributes, release_gil())
+        .def("getAttributes", &VectorCollectionImpl<num_t>::getAttributes, release_gil())
+        .def("attributeKeys", &VectorCollectionImpl<num_t>::attributeKeys)
+        .def("trainIndex", &VectorCollectionImpl<num_t>::trainIndex, py::arg("n_lists"), py::arg("n_iter") = 10, release_gil())
+        .def("dropIndex", &VectorCollectionImpl<num_t>::dropIndex)
+        .def("isIndexTrained", &VectorCollectionImpl<num_t>::isIndexTrained)
+        .def("setNprobe", &VectorCollectionImpl<num_t>::setNprobe)
+        .def("getNprobe", &VectorCollectionImpl<num_t>::getNprobe)
+        .def("dumpIndex", &VectorCollectionImpl<num_t>::dumpIndex, py::arg("ids") = py::none())
+        .def("loadIndex", &VectorCollectionImpl<num_t>::loadIndex)
+        .def("trainPQ", &VectorCollectionImpl<num_t>::trainPQ, py::arg("n_sub"), py::arg("n_iter") = 10, release_gil())
+        .def("dropPQ", &VectorCollectionImpl<num_t>::dropPQ)
+        .def("isPQTrained", &VectorCollectionImpl<num_t>::isPQTrained)
+        .def("dumpPQ", &VectorCollectionImpl<num_t>::dumpPQ, py::arg("ids") = py::none())
+        .def("loadPQ", &VectorCollectionImpl<num_t>::loadPQ)
+        .def("setMetric", &VectorCollectionImpl<num_t>::setMetric)
+        .def("getMetric", &VectorCollectionImpl<num_t>::getMetric)
+        .def("setDtype", &VectorCollectionImpl<num_t>::setDtype, release_gil())
+        .def("getDtype", &VectorCollectionImpl<num_t>::getDtype)
+        .def("setRerank", &VectorCollectionImpl<num_t>::setRerank)
+        .def("getRerank", &VectorCollectionImpl<num_t>::getRerank)
+        .def("quantizedBytes", &VectorCollectionImpl<num_t>::quantizedBytes)
+        .def("dumpQuantized", &VectorCollectionImpl<num_t>::dumpQuantized)
+        .def("setKeepRows", &VectorCollectionImpl<num_t>::setKeepRows, release_gil())
+        .def("getKeepRows", &VectorCollectionImpl<num_t>::getKeepRows)
+        .def("getPending", &VectorCollectionImpl<num_t>::getPending)
+        .def("buildHNSW", &VectorCollectionImpl<num_t>::buildHNSW, py::arg("M") = 16, py::arg("ef_construction") = 200, release_gil())
+        .def("dropHNSW", &VectorCollectionImpl<num_t>::dropHNSW)
+        .def("hasHNSW", &VectorCollectionImpl<num_t>::hasHNSW)
+        .def("setEfSearch", &VectorCollectionImpl<num_t>::setEfSearch)
+        .def("getEfSearch", &VectorCollectionImpl<num_t>::getEfSearch)
+        .def("hnswInfo", &VectorCollectionImpl<num_t>::hnswInfo)
+        .def("dumpHNSW", &VectorCollectionImpl<num_t>::dumpHNSW)
+        .def("loadHNSW", &VectorCollectionImpl<num_t>::loadHNSW)
+        .def("flush", &VectorCollectionImpl<num_t>::flush)
+        .def("restoreModifications", &VectorCollectionImpl<num_t>::restoreModifications, release_gil());
 
-    // for debug.
+    // Eigen::Dynamic (-1) for the runtime-dimension module
     m.attr("FEAT_DIM") = FEAT_DIM;
     
     auto m_enc = m.def_submodule("enc");
     m_enc.def("encode", &VectorStringEncode::encode<num_t>);
     m_enc.def("decode", &VectorStringEncode::decode<num_t>);
+    m_enc.def("encodeQuantized", [](const std::vector<num_t>& vec, const std::string& dtype){
+        return py::bytes(VectorQuantizedEncode::encode<num_t>(vec, dtype));
+    });
+    m_enc.def("decodeQuantized", &VectorQuantizedEncode::decode<num_t>);
 }
\ No newline at end of file
@@ -1,22 +1,117 @@
 
 from __future__ import annotations
 from abc import ABC, abstractmethod
-from typing import Generic, TypeVar, Optional, TYPE_CHECKING, Any, TypedDict
-from .jit import compile
-from .jit_utils import autoCompileConfig
-from .config import BIN_DIR
-import sys
-import importlib
+from typing import Generic, TypeVar, Optional, TYPE_CHECKING, Any, TypedDict, Literal, Union
+from . import jit
+import os, math, json, struct
+import numpy as np
 
 if TYPE_CHECKING:
     from .wrap import VectorDatabase, CompileConfig
 
 
 NumVar = TypeVar('NumVar', int, float)
+def _isList(obj: Any) -> bool:
+    """
+    Python lists are converted element by element, 
+    other objects are passed as buffers (e.g. numpy array, memoryview) to the C++ backend
+    """
+    return isinstance(obj, (list, tuple))
+
+IndexType = Literal["flat", "ivf", "hnsw", "pq"]
+DType = Literal["float32", "float16", "int8", "pq"]
+Metric = Literal["cosine", "ip", "l2"]
+Kernel = Literal["auto", "fixed", "runtime"]
+_IVF_HEADER_FORMAT = "<ii"      # n_lists, dim
+def _packIVF(centroids: np.ndarray) -> bytes:
+    """ Serialize the centroids of an IVF index: header | centroids: float32 (n_lists, dim), the lists of the rows are saved by id """
+    return struct.pack(_IVF_HEADER_FORMAT, *centroids.shape) + np.ascontiguousarray(centroids, dtype="<f4").tobytes()
+def _unpackIVF(data: bytes) -> np.ndarray:
+    n_lists, dim = struct.unpack_from(_IVF_HEADER_FORMAT, data)
+    centroids = np.frombuffer(data, dtype="<f4", count=n_lists * dim, offset=struct.calcsize(_IVF_HEADER_FORMAT))
+    return centroids.reshape(n_lists, dim).astype(np.float32)
+_PQ_HEADER_FORMAT = "<iii"      # n_sub, rows of codebooks, dim of subspace
+def _packPQ(codebooks: np.ndarray, n_sub: int) -> bytes:
+    """ Serialize the codebooks of a PQ index: header | codebooks: float32 (n_sub * n_centroids, dsub), the rows (codes | float32 norm) are saved by id """
+    return struct.pack(_PQ_HEADER_FORMAT, n_sub, *codebooks.shape) + np.ascontiguousarray(codebooks, dtype="<f4").tobytes()
+def _unpackPQ(data: bytes) -> tuple[np.ndarray, int]:
+    n_sub, n_codebook_rows, dsub = struct.unpack_from(_PQ_HEADER_FORMAT, data)
+    codebooks = np.frombuffer(data, dtype="<f4", count=n_codebook_rows * dsub, offset=struct.calcsize(_PQ_HEADER_FORMAT))
+    return codebooks.reshape(n_codebook_rows, dsub).astype(np.float32), n_sub
+
+def _scoreFromDot(metric: Metric, dots: np.ndarray, norm_query: float, norms: np.ndarray) -> np.ndarray:
+    """ Scores of the rows from their dot products with the query, as in the C++ backend """
+    if metric == "cosine":
+        return dots / (norm_query * norms + 1e-8)
+    if metric == "l2":
+        return 2 * dots - norm_query ** 2 - norms ** 2
+    return dots
+
+Attribute = Union[int, str]
+class SearchFilter(TypedDict, total=False):
+    # a search only selects the vectors matching all the given criteria
+    ids: list[str]          # allowed ids
+    prefix: str             # id prefix
+    where: dict[str, Union[Optional[Attribute], list[Optional[Attribute]]]]     # the attribute equals the value, or one of the values
+    mask: Any               # booleans of shape (n, ), in the order of keys()
+
+class _AttributeChanges:
+    """ Attributes set since the last flush, and the ids whose saved attributes are removed """
+    def __init__(self) -> None:
+        self.set: dict[tuple[str, str], Optional[Attribute]] = {}
+        self.deleted: set[str] = set()
+    
+    def onSet(self, key: str, ids: list[str], values: list[Optional[Attribute]]) -> None:
+        for id, value in zip(ids, values):
+            self.set[(id, key)] = value
+    
+    def onDelete(self, ids: list[str]) -> None:
+        ids_set = set(ids)
+        self.set = {k: v for k, v in self.set.items() if k[0] not in ids_set}
+        self.deleted.update(ids_set)
+    
+    def take(self) -> _AttributeChanges:
+        """ Reset the changes and return them, to be saved """
+        taken = _AttributeChanges()
+        taken.set, taken.deleted = self.set, self.deleted
+        self.set = {}
+        self.deleted = set()
+        return taken
+    
+    def save(self, database: Optional[VectorDatabase], name: str) -> None:
+        if database:
+            database.disk_io.deleteAttributes(name, list(self.deleted))
+            database.disk_io.upsertAttributes(name, [(id, key, value) for (id, key), value in self.set.items()])
+    
+    def restore(self, taken: _AttributeChanges) -> None:
+        # the taken changes are older than the current ones
+        restored = {k: v for k, v in taken.set.items() if k[0] not in self.deleted}
+        restored.update(self.set)
+        self.set = restored
+        self.deleted = taken.deleted | self.deleted
+
 class CollectionChanges(TypedDict):
-    ADD: tuple[list[str], list[str]]
-    UPDATE: tuple[list[str], list[str]]
+    # vectors are encoded as raw little-endian float32 bytes, the BLOB format on disk
+    ADD: tuple[list[str], list[bytes]]
+    UPDATE: tuple[list[str], list[bytes]]
     DELETE: tuple[list[str], None]
+def _restoreChanges(log: dict[str, str], changes: CollectionChanges) -> None:
+    """ 
+    Merge the changes of a flush back into a modification log of {id: change type}, if they failed to be written, 
+    the changes are older than the ones logged since the flush
+    """
+    for change_type in ("ADD", "UPDATE", "DELETE"):
+        for id in changes[change_type][0]:
+            current = log.get(id)
+            if current is None:
+                log[id] = change_type
+            elif change_type == "ADD" and current == "DELETE":
+                # added and then deleted, never on disk
+                del log[id]
+            elif change_type == "ADD":
+                log[id] = "ADD"
+            elif change_type == "DELETE" and current == "ADD":
+                log[id] = "UPDATE"
 class _VectorCollectionEncodingAbstract(Generic[NumVar]):
     def encode(self, vectors: list[NumVar]) -> str:...
     def decode(self, enc_vectors: str) -> list[NumVar]:...
@@ -27,7 +122,19 @@ class VectorCollectionAbstract(ABC, Generic[NumVar]):
             name: str, 
             dimension: int, 
             quite_loading = True, 
-            compile_config: Optional[CompileConfig] = None
+            compile_config: Optional[CompileConfig] = None, 
+            num_threads: Optional[int] = None, 
+            index: IndexType = "flat", 
+            n_lists: Optional[int] = None, 
+            nprobe: Optional[int] = None, 
+            M: Optional[int] = None, 
+            ef_construction: Optional[int] = None, 
+            ef_search: Optional[int] = None, 
+            dtype: DType = "float32", 
+            rerank: Optional[int] = None, 
+            n_subspaces: Optional[int] = None, 
+            metric: Metric = "cosine", 
+            kernel: Optional[Kernel] = None
             ):
         ...
     
@@ -49,11 +156,21 @@ class VectorCollectionAbstract(ABC, Generic[NumVar]):
     def has(self, id: str) -> bool:...
     def keys(self) -> list[str]:...
     def get(self, id: str) -> list[NumVar]:...
-    def getBlock(self, ids: list[str]) -> list[list[NumVar]]:...
-    def search(self, query: list[NumVar], k: int = -1) -> tuple[list[str], list[float]]:...
+    def getBlock(self, ids: list[str], as_numpy: bool = False) -> list[list[NumVar]]:...
+    def setAttributes(self, key: str, ids: list[str], values: list[Optional[Attribute]]) -> None:...
+    def getAttributes(self, key: str, ids: list[str]) -> list[Optional[Attribute]]:...
+    def search(
+        self, query: list[NumVar], k: int = -1, index: Optional[IndexType] = None, filter: Optional[SearchFilter] = None
+        ) -> tuple[list[str], list[float]]:...
+    def searchBatch(
+        self, queries: list[list[NumVar]], k: int = -1, index: Optional[IndexType] = None, filter: Optional[SearchFilter] = None
+        ) -> tuple[list[list[str]], list[list[float]]]:...
     def loadFromDisk(self) -> None:...
-    def load(self, ids: list[str], enc_vectors: list[str]) -> None:...
+    def loadFromSegment(self) -> bool:...
+    def load(self, ids: list[str], enc_vectors: list[bytes]) -> None:...
     def flush(self) -> CollectionChanges:...
+    def restore(self, changes: CollectionChanges) -> None:...
+    def memoryBytes(self) -> int:...
     def __len__(self) -> int:...
     def __getitem__(self, id: str) -> Optional[list[NumVar]]:...
 
@@ -68,32 +185,98 @@ class VectorCollection_CXX(VectorCollectionAbstract[NumVar]):
             name: str, 
             dimension: int, 
             quite_loading = True, 
-            compile_config: Optional[CompileConfig] = None
+            compile_config: Optional[CompileConfig] = None, 
+            num_threads: Optional[int] = None, 
+            index: IndexType = "flat", 
+            n_lists: Optional[int] = None, 
+            nprobe: Optional[int] = None, 
+            M: Optional[int] = None, 
+            ef_construction: Optional[int] = None, 
+            ef_search: Optional[int] = None, 
+            dtype: DType = "float32", 
+            rerank: Optional[int] = None, 
+            n_subspaces: Optional[int] = None, 
+            metric: Metric = "cosine", 
+            kernel: Optional[Kernel] = None
             ):
         """
         set parent to None if you don't want to save changes to disk
+        num_threads: number of threads for searching, 
+            default to environment variable TVDB_NUM_THREADS, or 1 if not set
+        index: "flat" for exhaustive search, 
+            "ivf" for approximate search with an inverted-file index, 
+            which is trained when the collection has at least IVF_MIN_ROWS vectors, or by calling trainIndex
+            "hnsw" for approximate search with a HNSW graph index, which is maintained from the start, 
+            "pq" for approximate search with a product quantization index, trained as the ivf index
+        n_lists: number of lists of the ivf index, default to sqrt of the collection size at training
+        nprobe: number of lists to search in the ivf index, the larger the more accurate and slower
+        M, ef_construction: maximum number of links per node and beam size for building the hnsw graph
+        ef_search: beam size for searching the hnsw graph, the larger the more accurate and slower
+        dtype: "float16" or "int8" to keep the vectors scalar quantized in memory, which takes 2 or 4 times less memory, 
+            "pq" to keep only the codes of the pq index (n_subspaces bytes per vector) once it is trained, index is then "pq", 
+            the float32 vectors stay on disk and are read from the database to re-rank, 
+            they are only kept in memory if the collection is not attached, or mapped with "mmap" storage
+        rerank: the top (k * rerank) candidates of the quantized scores are re-scored with the float32 vectors, 
+            default to 4, 0 to return the approximate scores, also used by the pq index
+        n_subspaces: number of subspaces of the pq index, i.e. bytes per vector, should divide the dimension, 
+            default to the largest divisor not greater than dimension / 8
+        metric: similarity of the search scores, the larger the closer, 
+            "cosine" for cosine similarity, "ip" for inner product, "l2" for negative squared euclidean distance, 
+            the hnsw and pq indexes find candidates by angle, so they are only exact for normalized vectors with "ip" or "l2"
+        kernel: "fixed" for the module compiled for this dimension, which is faster for small dimensions, 
+            "runtime" for the single module shared by all dimensions, which is compiled only once (or prebuilt), 
+            "auto" for the fixed module if it is already built, otherwise the runtime module, 
+            default to environment variable TVDB_KERNEL, or "auto" if not set
         """
-        if not sys.path.__contains__(BIN_DIR):
-            if not quite_loading:
-                print("Adding", BIN_DIR, "to sys.path")
-            sys.path.append(BIN_DIR)
-        if compile_config is None:
-            compile_config = autoCompileConfig()
-
         self._dimension = dimension
 
-        _m_name = compile(dimension, quite = quite_loading, **compile_config)
-        self.__clib = importlib.import_module(_m_name)
-        # force reload
-        # importlib.reload(self.__clib)
-        self.__impl = self.__clib.VectorCollectionImpl()
+        if kernel is None:
+            kernel = os.getenv("TVDB_KERNEL", "auto").lower()    # type: ignore
+        if kernel not in ("auto", "fixed", "runtime"):
+            raise ValueError(f"Unknown kernel: {kernel}")
+        if kernel == "auto":
+            kernel = "fixed" if jit.findModule(dimension, compile_config) is not None else "runtime"
+        self.__clib = jit.load(
+            dimension if kernel == "fixed" else jit.RUNTIME_DIM, 
+            quite = quite_loading, compile_config = compile_config
+            )
+        self.__impl = self.__clib.VectorCollectionImpl(dimension)
+        if num_threads is None:
+            num_threads = int(os.getenv("TVDB_NUM_THREADS", 1))
+        self.__impl.setNumThreads(num_threads)
+        if index not in ("flat", "ivf", "hnsw", "pq"):
+            raise ValueError(f"Unknown index type: {index}")
+        # the rows are stored as the codes of the pq index
+        self.__pq_storage = dtype == "pq"
+        if self.__pq_storage and index not in ("flat", "pq"):
+            raise ValueError(f"dtype 'pq' stores the vectors in the pq index, cannot use the {index} index")
+        self._index = "pq" if self.__pq_storage else index
+        self._n_lists = n_lists
+        self._n_subspaces = n_subspaces
+        if nprobe is not None:
+            self.__impl.setNprobe(nprobe)
+        self._M = M or self.HNSW_M
+        self._ef_construction = ef_construction or self.HNSW_EF_CONSTRUCTION
+        if ef_search is not None:
+            self.__impl.setEfSearch(ef_search)
+        self.__impl.setMetric(metric)
+        self.__impl.setDtype("float32" if self.__pq_storage else dtype)
+        if rerank is not None:
+            self.__impl.setRerank(rerank)
+        # whether the index is changed other than by the modification of vectors, e.g. trained
+        self.__index_dirty = False
+        self.__attribute_changes = _AttributeChanges()
+        self.__flushed_attributes = _AttributeChanges()
         if not quite_loading:
             print("\033[1;30m", end="\r")
-            print(f"[[ Loaded {_m_name} from {BIN_DIR} ]]")
+            print(f"[[ Loaded {self.__clib.__name__} from {self.__clib.__file__} ]]")
             print("\033[0m", end="\r")
 
         self.__name = name
         self.__database = parent
+        if index == "hnsw" and parent is None:
+            # attached collections build or restore the graph after loading
+            self.buildHNSW()
     
     @property
     def name(self):
@@ -112,37 +295,75 @@ class VectorCollection_CXX(VectorCollectionAbstract[NumVar]):
         return self.__clib.enc
     @property
     def dim(self) -> int:
-        assert self._dimension == self.clib.FEAT_DIM, "Dimension mismatch"
+        assert self._dimension == self._impl.dim, "Dimension mismatch"
         return self._dimension
+    @property
+    def nprobe(self) -> int:
+        return self._impl.getNprobe()
+    @nprobe.setter
+    def nprobe(self, n: int):
+        self._impl.setNprobe(n)
+    @property
+    def metric(self) -> Metric:
+        return self._impl.getMetric()
+    @metric.setter
+    def metric(self, metric: Metric):
+        self._impl.setMetric(metric)
+    @property
+    def dtype(self) -> DType:
+        return "pq" if self.__pq_storage else self._impl.getDtype()
+    @dtype.setter
+    def dtype(self, dtype: DType):
+        if (dtype == "pq") != self.__pq_storage:
+            raise ValueError("dtype 'pq' can only be set at initialization")
+        if not self.__pq_storage:
+            self._impl.setDtype(dtype)
+    @property
+    def rerank(self) -> int:
+        return self._impl.getRerank()
+    @rerank.setter
+    def rerank(self, n: int):
+        self._impl.setRerank(n)
+    @property
+    def ef_search(self) -> int:
+        return self._impl.getEfSearch()
+    @ef_search.setter
+    def ef_search(self, ef: int):
+        self._impl.setEfSearch(ef)
     
     def addBlock(self, ids: list[str], vectors: list[list[NumVar]]):
         """
         Add a bulk of elements, will raise error if id exists
+        vectors can be a list of lists, or a C-contiguous float32 buffer of shape (n, dim)
         """
-        # debug.
-        for id, vector in zip(ids, vectors):
-            assert len(vector) == self._dimension, f"Vector dimension mismatch, expected {self._dimension}, got {len(vector)}"
-
-        self._impl.addBulk(ids, vectors)
+        if _isList(vectors):
+            self._impl.addBulk(ids, vectors)
+        else:
+            self._impl.addBulkBuffer(ids, vectors)
     
     def deleteBlock(self, ids: list[str]) -> None:
         """
         Delete a bulk of elements, will raise error if id not exists
         """
         self._impl.deleteBulk(ids)
+        self.__attribute_changes.onDelete(ids)
     
     def setBlock(self, ids: list[str], vectors: list[list[NumVar]]) -> None:
         """
         For every element in ids, set the corresponding vector
         Add if not exists, update if exists
+        vectors can be a list of lists, or a C-contiguous float32 buffer of shape (n, dim)
         """
-        self._impl.setBulk(ids, vectors)
+        if _isList(vectors):
+            self._impl.setBulk(ids, vectors)
+        else:
+            self._impl.setBulkBuffer(ids, vectors)
 
     def update(self, id: str, vector: list[NumVar]) -> bool:
         """
         Change a vector, will raise error if id not exists
         """
-        return self._impl.set(id, vector)
+        return self._impl.update(id, vector)
 
     def has(self, id: str) -> bool:
         """
@@ -160,25 +381,131 @@ class VectorCollection_CXX(VectorCollectionAbstract[NumVar]):
         """
         Get a vector by id, return an empty list if not exists
         """
-        return self._impl.get(id)
+        if self._impl.getKeepRows():
+            return self._impl.get(id)
+        return self.__exactVectors([id])[0].tolist() if self._impl.has(id) else []
     
-    def getBlock(self, ids: list[str]) -> list[list[NumVar]]:
+    def getBlock(self, ids: list[str], as_numpy: bool = False) -> list[list[NumVar]]:
         """
         Get a bulk of vectors by ids, return list element can be empty if not exists
+        if as_numpy is True, return a numpy array of shape (n, dim) instead, 
+        and raise error if any id not exists
+        """
+        if self._impl.getKeepRows():
+            if as_numpy:
+                return self._impl.getBulkArray(ids)
+            return self._impl.getBulk(ids)
+        found = [id for id in ids if self._impl.has(id)]
+        if as_numpy:
+            if len(found) != len(ids):
+                raise RuntimeError(f"id not found: {next(id for id in ids if not self._impl.has(id))}")
+            return self.__exactVectors(ids)
+        vectors = dict(zip(found, self.__exactVectors(found).tolist()))
+        return [vectors.get(id, []) for id in ids]
+    
+    def __exactVectors(self, ids: list[str]) -> np.ndarray:
+        """ 
+        The float32 vectors of existing ids when only the quantized rows are kept in memory, 
+        the changed ones are pending in memory until flushed, the others are read from the database
+        """
+        assert self.database is not None
+        ret = np.empty((len(ids), self.dim), dtype=np.float32)
+        pending_ids, pending = self._impl.getPending(ids)
+        pending_rows = {id: i for i, id in enumerate(pending_ids)}
+        saved_ids = [id for id in ids if id not in pending_rows]
+        saved = dict(zip(saved_ids, self.database.disk_io.getVectors(self.name, saved_ids)))
+        for i, id in enumerate(ids):
+            ret[i] = pending[pending_rows[id]] if id in pending_rows else np.frombuffer(saved[id], dtype="<f4")
+        return ret
+    
+    def __rerank(
+        self, queries: np.ndarray, ids: list[list[str]], scores: list[list[float]], k: int
+        ) -> tuple[list[list[str]], list[list[float]]]:
+        """ 
+        Re-score the candidates with the float32 vectors when only the quantized rows are kept in memory, 
+        the C++ backend then returns the top (k * rerank) candidates with the approximate scores
+        """
+        if self._impl.getKeepRows() or self.rerank == 0:
+            return ids, scores
+        candidates = list(dict.fromkeys(id for q_ids in ids for id in q_ids))
+        vectors = self.__exactVectors(candidates)
+        norms = np.linalg.norm(vectors, axis=1)
+        candidate_rows = {id: i for i, id in enumerate(candidates)}
+        ret_ids, ret_scores = [], []
+        for query, q_ids in zip(queries, ids):
+            rows = [candidate_rows[id] for id in q_ids]
+            q_scores = _scoreFromDot(self.metric, vectors[rows] @ query, float(np.linalg.norm(query)), norms[rows])
+            order = np.argsort(-q_scores, kind="stable")[:k if k >= 0 else None]
+            ret_ids.append([q_ids[i] for i in order])
+            ret_scores.append(q_scores[order].tolist())
+        return ret_ids, ret_scores
+    
+    def setAttributes(self, key: str, ids: list[str], values: list[Optional[Attribute]]) -> None:
+        """
+        Set an attribute (an integer or a string) of each id, for search filters, 
+        None removes the attribute, will raise error if id not exists
         """
-        return self._impl.getBulk(ids)
+        self._impl.setAttributes(key, ids, values)
+        self.__attribute_changes.onSet(key, ids, values)
     
-    def search(self, query: list[NumVar], k: int = -1) -> tuple[list[str], list[float]]:
-        """Return a tuple of (ids, scores)"""
-        return self._impl.search(query, k)
+    def getAttributes(self, key: str, ids: list[str]) -> list[Optional[Attribute]]:
+        """ Return the attribute of each id, None if not set """
+        return self._impl.getAttributes(key, ids)
     
-    def load(self, ids: list[str], enc_vectors: list[str]) -> None:
+    def __filter(self, filter: Optional[SearchFilter]) -> Any:
+        if filter is None:
+            return None
+        ret = self.__clib.SearchFilter()
+        if "ids" in filter:
+            ret.ids = list(filter["ids"])
+        if "prefix" in filter:
+            ret.prefix = filter["prefix"]
+        if "where" in filter:
+            ret.where = {key: list(v) if isinstance(v, (list, tuple)) else [v] for key, v in filter["where"].items()}
+        if "mask" in filter:
+            ret.mask = np.asarray(filter["mask"], dtype=bool).tobytes()
+        return ret
+    
+    def search(
+        self, query: list[NumVar], k: int = -1, index: Optional[IndexType] = None, filter: Optional[SearchFilter] = None
+        ) -> tuple[list[str], list[float]]:
+        """
+        Return a tuple of (ids, scores)
+        index: the search engine, "flat", "ivf", "hnsw" or "pq", 
+            default to the hnsw graph if built, then the ivf or pq index if trained, otherwise exhaustive search
+        filter: only select the vectors matching the filter, evaluated in the C++ backend, 
+            if only a few vectors match, they are scored directly instead of searching the index
+        """
+        if _isList(query):
+            ids, scores = self._impl.search(query, k, index or "", self.__filter(filter))
+        else:
+            ids, scores = self._impl.searchBuffer(query, k, index or "", self.__filter(filter))
+        if self._impl.getKeepRows():
+            return ids, scores
+        ids, scores = self.__rerank(np.asarray(query, dtype=np.float32).reshape(1, -1), [ids], [scores], k)
+        return ids[0], scores[0]
+    
+    def searchBatch(
+        self, queries: list[list[NumVar]], k: int = -1, index: Optional[IndexType] = None, filter: Optional[SearchFilter] = None
+        ) -> tuple[list[list[str]], list[list[float]]]:
+        """Return a tuple of (ids, scores), one list of each per query, see search for index and filter"""
+        if _isList(queries):
+            ids, scores = self._impl.searchBatch(queries, k, index or "", self.__filter(filter))
+        else:
+            ids, scores = self._impl.searchBatchBuffer(queries, k, index or "", self.__filter(filter))
+        return self.__rerank(np.asarray(queries, dtype=np.float32).reshape(-1, self.dim), ids, scores, k)
+    
+    def load(self, ids: list[str], enc_vectors: list[bytes]) -> None:
         """
         Load a bulk of elements, should be called when the collection is empty
+        enc_vectors are raw float32 bytes, base64 encoded strings are also accepted
         """
         if len(self) != 0:
             raise RuntimeError("Collection is not empty, cannot load data")
-        self._impl.addRawEncBulk(ids, enc_vectors)
+        if enc_vectors and isinstance(enc_vectors[0], str):
+            self._impl.addRawEncBulk(ids, enc_vectors)
+        else:
+            self._impl.addRawBinBulk(ids, enc_vectors)
     
     def loadFromDisk(self) -> None:
         """
@@ -186,8 +513,269 @@ class VectorCollection_CXX(VectorCollectionAbstract[NumVar]):
         Should be called when the collection is attached to a database and is empty
         """
         if not self.database: return 
-        ids, enc_vectors = self.database.disk_io.getTableData(self.name)
-        self.load(ids, enc_vectors)
+        if len(self) != 0:
+            raise RuntimeError("Collection is not empty, cannot load data")
+        # stream the table by chunks into the pre-allocated collection
+        disk_io = self.database.disk_io
+        self._impl.reserve(disk_io.countTable(self.name))
+        saved_pq = disk_io.getMeta(f"pq.{self.name}") if self.__pq_storage else None
+        if not self.__dropsRows() or (self.__pq_storage and saved_pq is None):
+            for ids, enc_vectors in disk_io.iterTableData(self.name):
+                self._impl.addRawBinBulk(ids, enc_vectors)
+        else:
+            # only the quantized rows are kept in memory, the float32 vectors are read from the database to re-rank
+            if self.__pq_storage:
+                codebooks, n_sub = _unpackPQ(saved_pq)
+                self._impl.loadPQ([], codebooks, n_sub, [])
+                saved = iter([disk_io.getIndexRows(disk_io.PQ_TABLE_PREFIX, self.name)])
+            else:
+                saved = disk_io.iterTableData(self.name, quantized=True)
+            self._impl.setKeepRows(False)
+            missing: list[str] = []
+            for ids, blobs in saved:
+                missing += self._impl.addRawQuantizedBulk(ids, blobs)
+            # not saved yet, or saved with another dtype
+            chunk_size = 65536
+            for i in range(0, len(missing), chunk_size):
+                ids = missing[i: i + chunk_size]
+                self._impl.addRawBinBulk(ids, disk_io.getVectors(self.name, ids))
+            if missing:
+                with disk_io.transaction():
+                    self.__saveQuantized(missing)
+        self.__loadAttributes()
+        self.__loadIndex()
+
+    def loadFromSegment(self) -> bool:
+        """
+        Memory-map the segment file of the collection and search it in place, 
+        the changes logged after the segment is written are applied on top of the mapping, 
+        which is copy-on-write, and is only copied into memory when its spare capacity is exceeded, 
+        return False and load nothing if the changes are not covered by the log, 
+        Should be called when the collection is attached to a database with "mmap" storage and is empty
+        """
+        if not self.database or self.database.segment_io is None: return False
+        if len(self) != 0:
+            raise RuntimeError("Collection is not empty, cannot load data")
+        ids, vectors, norms, generation = self.database.segment_io.read(self.name)
+        changes = self.database.disk_io.getLoggedChanges(self.name, generation)
+        if changes is None:
+            return False
+        requantized: list[str] = []
+        if len(vectors) != 0:
+            blobs: dict[str, bytes] = {}
+            if self._impl.getDtype() != "float32":
+                for chunk_ids, chunk_blobs in self.database.disk_io.iterTableData(self.name, quantized=True):
+                    blobs.update(zip(chunk_ids, chunk_blobs))
+            requantized = self._impl.mapBuffer(ids, vectors, norms, [blobs.get(id, b"") for id in ids] if blobs else [])
+            del blobs
+            # the mapping must outlive its use in the C++ backend
+            self.__mapped = (vectors, norms)
+        set_ids, enc_vectors, delete_ids = changes
+        if set_ids:
+            self._impl.setBulkBuffer(set_ids, np.frombuffer(b"".join(enc_vectors), dtype="<f4").reshape(-1, self.dim))
+        self._impl.deleteBulk([id for id in delete_ids if self._impl.has(id)])
+        # the changes are already in the database
+        self._impl.flush()
+        if requantized:
+            with self.database.disk_io.transaction():
+                self.__saveQuantized(requantized)
+        self.__loadAttributes()
+        self.__loadIndex()
+        return True
+    
+    def __dropsRows(self) -> bool:
+        """ Whether only the quantized rows are kept in memory once loaded (or once the pq index is trained), see dtype """
+        return self.database is not None and self.database.segment_io is None and self.dtype != "float32"
+    
+    def __saveQuantized(self, ids: list[str]):
+        """ 
+        Save the quantized BLOBs of the ids, or their rows of the pq index if the rows are stored as the pq codes, 
+        so that the next load does not quantize their float32 vectors 
+        """
+        if not ids or not self.database:
+            return
+        disk_io = self.database.disk_io
+        if self.__pq_storage and self._impl.isPQTrained():
+            found_ids, _, _, rows = self._impl.dumpPQ(ids)
+            disk_io.touchIndexRowTable(disk_io.PQ_TABLE_PREFIX, self.name)
+            disk_io.upsertIndexRows(disk_io.PQ_TABLE_PREFIX, self.name, found_ids, rows)
+        elif self._impl.getDtype() != "float32":
+            disk_io.setQuantized(self.name, *self._impl.dumpQuantized(ids))
+    
+    def __loadAttributes(self):
+        assert self.database is not None
+        for key, (ids, values) in self.database.disk_io.getAttributes(self.name).items():
+            self._impl.setAttributes(key, ids, values)
+    
+    IVF_MIN_ROWS = 10000
+    def trainIndex(self, n_lists: Optional[int] = None, n_iter: int = 10) -> None:
+        """
+        Train the ivf index on the current vectors, 
+        the index is then maintained on every modification, and saved on commit
+        """
+        if n_lists is None:
+            n_lists = self._n_lists or max(1, int(math.sqrt(len(self))))
+        self._impl.trainIndex(min(n_lists, len(self)), n_iter)
+        self.__index_dirty = True
+    
+    def dropIndex(self) -> None:
+        self._impl.dropIndex()
+        self.__index_dirty = True
+    
+    PQ_MIN_ROWS = 10000
+    def trainPQ(self, n_subspaces: Optional[int] = None, n_iter: int = 10) -> None:
+        """
+        Train the pq index on the current vectors, 
+        the index is then maintained on every modification, and saved on commit
+        """
+        if n_subspaces is None:
+            n_subspaces = self._n_subspaces or max(d for d in range(1, max(1, self.dim // 8) + 1) if self.dim % d == 0)
+        self._impl.trainPQ(n_subspaces, n_iter)
+        self.__index_dirty = True
+        if self.__pq_storage and self.__dropsRows():
+            # the codes store the rows from now on
+            self._impl.setKeepRows(False)
+    
+    def dropPQ(self) -> None:
+        self._impl.dropPQ()
+        self.__index_dirty = True
+    
+    def __autoTrainIndex(self):
+        if self._index == "ivf" and not self._impl.isIndexTrained() and len(self) >= self.IVF_MIN_ROWS:
+            self.trainIndex()
+        if self._index == "pq" and not self._impl.isPQTrained() and len(self) >= self.PQ_MIN_ROWS:
+            self.trainPQ()
+    
+    HNSW_M = 16
+    HNSW_EF_CONSTRUCTION = 200
+    def buildHNSW(self, M: Optional[int] = None, ef_construction: Optional[int] = None) -> None:
+        """
+        Build the hnsw graph from the current vectors, 
+        the graph is then maintained on every modification, and saved on commit
+        """
+        self._M = M or self._M
+        self._ef_construction = ef_construction or self._ef_construction
+        self._impl.buildHNSW(self._M, self._ef_construction)
+        self.__index_dirty = True
+    
+    def dropHNSW(self) -> None:
+        self._impl.dropHNSW()
+        self.__index_dirty = True
+    
+    def __loadHNSW(self):
+        """ Restore the saved graph if it is up to date, or build it """
+        assert self.database is not None
+        disk_io = self.database.disk_io
+        disk_io.touchHNSWTable(self.name)
+        saved = disk_io.getMeta(f"hnsw.{self.name}")
+        if saved is not None:
+            header = json.loads(saved)
+            if header["generation"] == disk_io.getGeneration(self.name):
+                try:
+                    self._impl.loadHNSW(
+                        header["M"], header["ef_construction"], header["entry"], header["max_level"], 
+                        disk_io.getHNSWNodes(self.name)
+                        )
+                    self._M, self._ef_construction = header["M"], header["ef_construction"]
+                    return
+                except RuntimeError:
+                    pass
+        # missing, outdated or corrupted graph
+        self.buildHNSW()
+    
+    def __saveHNSW(self):
+        assert self.database is not None
+        disk_io = self.database.disk_io
+        if not self._impl.hasHNSW():
+            if disk_io.getMeta(f"hnsw.{self.name}") is not None:
+                disk_io.setMeta(f"hnsw.{self.name}", None)
+                disk_io.touchHNSWTable(self.name)
+                disk_io.clearHNSWTable(self.name)
+            return
+        disk_io.touchHNSWTable(self.name)
+        if self.__index_dirty:
+            disk_io.clearHNSWTable(self.name)
+        # only the changed nodes are written, unless the graph is rebuilt, 
+        # which also happens on deletion and may leave fewer nodes
+        disk_io.upsertHNSWNodes(self.name, self._impl.dumpHNSW(self.__index_dirty))
+        info = self._impl.hnswInfo()
+        disk_io.truncateHNSWTable(self.name, info["n_nodes"])
+        disk_io.setMeta(f"hnsw.{self.name}", json.dumps({
+            "M": info["M"], "ef_construction": info["ef_construction"], 
+            "entry": info["entry"], "max_level": info["max_level"], 
+            "generation": disk_io.getGeneration(self.name), 
+        }))
+    
+    def __loadIndex(self):
+        """ Restore the saved index, or train it if there is none """
+        if self._index == "hnsw":
+            self.__loadHNSW()
+            return
+        if self._index not in ("ivf", "pq"):
+            return
+        disk_io = self.database.disk_io if self.database else None
+        saved = disk_io.getMeta(f"{self._index}.{self.name}") if disk_io else None
+        if saved is not None and self._index == "ivf":
+            ids, lists = disk_io.getIndexRows(disk_io.IVF_TABLE_PREFIX, self.name)
+            self._impl.loadIndex(ids, _unpackIVF(saved), lists)
+        elif saved is not None and self._impl.isPQTrained():
+            # restored with the rows stored as the pq codes
+            return
+        elif saved is not None:
+            codebooks, n_sub = _unpackPQ(saved)
+            ids, rows = disk_io.getIndexRows(disk_io.PQ_TABLE_PREFIX, self.name)
+            self._impl.loadPQ(ids, codebooks, n_sub, rows)
+        else:
+            self.__autoTrainIndex()
+    
+    def __saveIVF(self, changes: CollectionChanges):
+        assert self.database is not None
+        disk_io = self.database.disk_io
+        prefix = disk_io.IVF_TABLE_PREFIX
+        if not self._impl.isIndexTrained():
+            if self.__index_dirty:
+                disk_io.setMeta(f"ivf.{self.name}", None)
+                disk_io.clearIndexRows(prefix, self.name)
+            return
+        # the centroids are only written when trained, and the lists of the changed rows otherwise
+        if self.__index_dirty:
+            ids, centroids, lists = self._impl.dumpIndex()
+            disk_io.setMeta(f"ivf.{self.name}", _packIVF(centroids))
+            disk_io.clearIndexRows(prefix, self.name)
+        else:
+            ids, _, lists = self._impl.dumpIndex(changes["ADD"][0] + changes["UPDATE"][0])
+        disk_io.touchIndexRowTable(prefix, self.name)
+        disk_io.deleteIndexRows(prefix, self.name, changes["DELETE"][0])
+        disk_io.upsertIndexRows(prefix, self.name, ids, lists)
+    
+    def __savePQ(self, changes: CollectionChanges):
+        assert self.database is not None
+        disk_io = self.database.disk_io
+        prefix = disk_io.PQ_TABLE_PREFIX
+        if not self._impl.isPQTrained():
+            if self.__index_dirty:
+                disk_io.setMeta(f"pq.{self.name}", None)
+                disk_io.clearIndexRows(prefix, self.name)
+            return
+        # the codebooks are only written when trained, and the codes of the changed rows otherwise
+        if self.__index_dirty:
+            ids, codebooks, n_sub, rows = self._impl.dumpPQ()
+            disk_io.setMeta(f"pq.{self.name}", _packPQ(codebooks, n_sub))
+            disk_io.clearIndexRows(prefix, self.name)
+        else:
+            ids, _, n_sub, rows = self._impl.dumpPQ(changes["ADD"][0] + changes["UPDATE"][0])
+        disk_io.touchIndexRowTable(prefix, self.name)
+        disk_io.deleteIndexRows(prefix, self.name, changes["DELETE"][0])
+        disk_io.upsertIndexRows(prefix, self.name, ids, rows)
+    
+    def __saveIndex(self, changes: CollectionChanges):
+        assert self.database is not None
+        if not (any(len(changes[k][0]) for k in changes) or self.__index_dirty):
+            return
+        self.__saveHNSW()
+        self.__saveIVF(changes)
+        self.__savePQ(changes)
+        self.__index_dirty = False
 
     def flush(self) -> CollectionChanges:
         """
@@ -195,17 +783,38 @@ class VectorCollection_CXX(VectorCollectionAbstract[NumVar]):
         If the collection is not attached to a database, return False
         """
         changes: CollectionChanges = self._impl.flush()
-        if not self.database:
-            return changes
-        ids_add, enc_vectors_add = changes["ADD"]
-        for identifier, enc_vector in zip(ids_add, enc_vectors_add):
-            self.database.disk_io.insetToTable(self.name, identifier, enc_vector)
-        ids_update, enc_vectors_update = changes["UPDATE"]
-        for identifier, enc_vector in zip(ids_update, enc_vectors_update):
-            self.database.disk_io.updateTable(self.name, identifier, enc_vector)
-        for identifier in changes["DELETE"][0]:
-            self.database.disk_io.deleteFromTable(self.name, identifier)
+        self.__autoTrainIndex()
+        self.__flushed_attributes = self.__attribute_changes.take()
+        try:
+            self.__flushed_attributes.save(self.database, self.name)
+            if not self.database:
+                return changes
+            self.database.disk_io.insertBulk(self.name, *changes["ADD"])
+            self.database.disk_io.upsertBulk(self.name, *changes["UPDATE"])
+            self.database.disk_io.deleteBulk(self.name, changes["DELETE"][0])
+            if not self.__pq_storage:
+                # the pq rows are saved with the index
+                self.__saveQuantized(changes["ADD"][0] + changes["UPDATE"][0])
+            self.__saveIndex(changes)
+        except:
+            self.restore(changes)
+            raise
         return changes
+    
+    def restore(self, changes: CollectionChanges) -> None:
+        """
+        Merge the changes returned by the last flush back into the modification log, 
+        should be called if the transaction they are written in is rolled back, so that the next flush writes them again
+        """
+        self._impl.restoreModifications(*changes["ADD"], *changes["UPDATE"], changes["DELETE"][0])
+        self.__attribute_changes.restore(self.__flushed_attributes)
+        self.__flushed_attributes = _AttributeChanges()
+        # the changed nodes of the graph are taken by the flush, save the index as a whole
+        self.__index_dirty = True
+
+    def memoryBytes(self) -> int:
+        """ Approximate bytes held in memory, the float32 rows if kept, the quantized rows and the indexes """
+        return self._impl.memoryBytes()
 
     def __len__(self) -> int:
         return self._impl.size()
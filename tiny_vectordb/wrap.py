@@ -1,53 +1,226 @@
 from __future__ import annotations
 import os
-from typing import Union, TypeVar, Optional, TypedDict, Optional
-from .jit import ensureEigen
-from .vector_collection import VectorCollection_CXX, VectorCollectionAbstract
+from typing import Union, TypeVar, Optional, TypedDict, Optional, Literal, Iterator, KeysView
+from .vector_collection import VectorCollection_CXX, VectorCollectionAbstract, CollectionChanges, IndexType, DType, Metric, Kernel
 from .numpy_impl import VectorCollection_Numpy
 from .diskio import SqliteIO
+from .segment import SegmentIO
 
 Number = Union[int, float]
 NumVar = TypeVar('NumVar', int, float)
 
 
-class CollectionConfig(TypedDict):
+class _CollectionConfigRequired(TypedDict):
     name: str
     dimension: int
 
+class CollectionConfig(_CollectionConfigRequired, total=False):
+    num_threads: int        # number of threads for searching, used by cxx backend
+    index: IndexType        # "flat", "ivf", "hnsw" or "pq", used by cxx backend
+    n_lists: int            # number of lists of the ivf index
+    nprobe: int             # number of lists to search in the ivf index
+    M: int                  # maximum number of links per node of the hnsw graph
+    ef_construction: int    # beam size for building the hnsw graph
+    ef_search: int          # beam size for searching the hnsw graph
+    dtype: DType            # "float32", "float16", "int8" or "pq", dtype of the vectors kept in memory, used by cxx backend
+    rerank: int             # number of candidates per result re-scored with float32 vectors, if dtype is quantized or with pq
+    n_subspaces: int        # number of subspaces of the pq index, i.e. bytes per vector
+    metric: Metric          # "cosine", "ip" or "l2", similarity of the search scores
+    kernel: Kernel          # "auto", "fixed" or "runtime", module of the dimension or shared by all, used by cxx backend
+
 class CompileConfig(TypedDict):
     cxx: str
     additional_compile_flags: list[str]
     additional_link_flags: list[str]
 
+StorageEngine = Literal["sqlite", "mmap"]
+
 class VectorDatabase(dict[str, "VectorCollectionAbstract[float]"]):
     VERBOSE: bool = False
-    def __init__(self, path: str, collection_configs: list[CollectionConfig], compile_config: Optional[CompileConfig] = None):
+    SEGMENT_CHUNK_ROWS: int = 65536
+    # spare rows of a segment file for the added vectors, relative to the number of vectors
+    SEGMENT_SPARE_RATIO: float = 0.5
+    # the segment file is rewritten when the logged ids exceed this ratio of the vectors
+    SEGMENT_COMPACT_RATIO: float = 0.25
+    def __init__(
+            self, path: str, 
+            collection_configs: list[CollectionConfig], 
+            compile_config: Optional[CompileConfig] = None, 
+            storage: StorageEngine = "sqlite", 
+            lazy: bool = False, 
+            memory_budget: Optional[int] = None
+            ):
+        """
+        storage: 
+            "sqlite" - load all vectors from the sqlite database into memory
+            "mmap" - additionally keep a segment file of each collection next to the database, 
+                which is memory-mapped at startup and searched in place, 
+                the sqlite database still records all changes, and logs the changed ids, which are applied on top of the segment when loaded, 
+                a segment file is only rewritten on commit when the log or the added vectors outgrow it (see SEGMENT_COMPACT_RATIO)
+        lazy: 
+            if True, a collection is compiled and loaded on its first access (by `self[name]` or `getCollection`), 
+            instead of all collections at initialization, 
+            the names in the database are still all configured collections, use `isLoaded` to check if one is loaded
+        memory_budget: 
+            the approximate size in bytes of the loaded collections (see `memoryBytes` of a collection), only used in lazy mode, 
+            when exceeded after loading or creating a collection, the least recently accessed collections are unloaded
+        """
         super().__init__()
+        if storage not in ("sqlite", "mmap"):
+            raise ValueError(f"Unknown storage engine: {storage}")
         self.__database_path = path
-        self.__disk_io = SqliteIO(path)
-        for config in collection_configs:
-            self[config['name']] = getVectorCollectionBackend()(
-                self, 
-                quite_loading=not self.VERBOSE, 
-                compile_config=compile_config, 
-                **config
-                )
+        self.__disk_io = SqliteIO(path, log_changes = storage == "mmap")
+        self.__segment_io = SegmentIO(path) if storage == "mmap" else None
+        self.__compile_config = compile_config
+        self.__configs: dict[str, CollectionConfig] = {config['name']: config for config in collection_configs}
+        self.__lazy = lazy
+        self.__memory_budget = memory_budget
+        self.__last_access: dict[str, int] = {}
+        self.__access_count = 0
         self.__initCollections()
     
     def __initCollections(self):
         """Load collection from disk if exists"""
         table_names = self.disk_io.getTableNames()
-        assert set(table_names).issubset(set(self.keys())), \
-        f"Database corrupted, existing tables: {table_names}, but only specified collections of: {self.keys()}"
-        for name in self.keys():
-            if table_names.__contains__(name):
-                self.getCollection(name).loadFromDisk()
+        assert set(table_names).issubset(set(self.__configs.keys())), \
+        f"Database corrupted, existing tables: {table_names}, but only specified collections of: {self.__configs.keys()}"
+        for name in self.__configs.keys():
             self.disk_io.touchTable(name)
+            if not self.__lazy:
+                self.__loadCollection(name)
+    
+    def __getitem__(self, name: str) -> VectorCollectionAbstract[float]:
+        collection = super().__getitem__(name)
+        if self.__lazy:
+            self.__access_count += 1
+            self.__last_access[name] = self.__access_count
+        return collection
+    
+    def __contains__(self, name: object) -> bool:
+        return name in self.__configs
+    
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.__configs)
+    
+    def __len__(self) -> int:
+        return len(self.__configs)
+    
+    def keys(self) -> KeysView[str]:
+        return self.__configs.keys()
+    
+    def get(self, name: str, default: Optional[VectorCollectionAbstract[float]] = None) -> Optional[VectorCollectionAbstract[float]]:
+        return self[name] if name in self.__configs else default
+    
+    def values(self) -> list[VectorCollectionAbstract[float]]:
+        """ All collections, the ones not loaded are loaded in lazy mode """
+        return [self[name] for name in self.__configs]
+    
+    def items(self) -> list[tuple[str, VectorCollectionAbstract[float]]]:
+        """ All (name, collection) pairs, the collections not loaded are loaded in lazy mode """
+        return [(name, self[name]) for name in self.__configs]
+    
+    def __missing__(self, name: str) -> VectorCollectionAbstract[float]:
+        # called by dict.__getitem__, load configured collections on demand
+        if name not in self.__configs:
+            raise KeyError(name)
+        collection = self.__loadCollection(name)
+        self.__evict(keep = name)
+        return collection
+    
+    def __loadCollection(self, name: str) -> VectorCollectionAbstract[float]:
+        collection = getVectorCollectionBackend()(
+            self, 
+            quite_loading=not self.VERBOSE, 
+            compile_config=self.__compile_config, 
+            **self.__configs[name]
+            )
+        super().__setitem__(name, collection)
+        if self.segment_io is None:
+            collection.loadFromDisk()
+            return collection
+        header = self.segment_io.readHeader(name)
+        if header is None or header[0] != collection.dim or not collection.loadFromSegment():
+            # missing segment, or changes not in the log
+            collection.loadFromDisk()
+            self.__writeSegment(collection)
+        return collection
+    
+    def __evict(self, keep: str):
+        """ Unload the least recently accessed collections until the memory budget is met """
+        if self.__memory_budget is None:
+            return
+        loaded = dict(dict.items(self))
+        total = sum(c.memoryBytes() for c in loaded.values())
+        for name in sorted(loaded, key = lambda n: self.__last_access.get(n, 0)):
+            if total <= self.__memory_budget:
+                break
+            if name == keep:
+                continue
+            total -= loaded[name].memoryBytes()
+            self.unloadCollection(name)
+    
+    def unloadCollection(self, name: str):
+        """
+        Save the changes of a loaded collection and release it from memory, 
+        it can be loaded again by accessing it in lazy mode
+        """
+        collection = super().__getitem__(name)
+        self.__flush([collection])
+        self.__compactSegment(collection)
+        del self[name]
+        self.__last_access.pop(name, None)
+    
+    def isLoaded(self, name: str) -> bool:
+        return super().__contains__(name)
+    
+    def __flush(self, collections: list[VectorCollectionAbstract]):
+        """ 
+        Write the changes of the collections in one transaction, 
+        if it fails, the changes are kept in the collections for the next commit 
+        """
+        flushed: list[tuple[VectorCollectionAbstract, CollectionChanges]] = []
+        try:
+            with self.disk_io.transaction():
+                for collection in collections:
+                    flushed.append((collection, collection.flush()))
+        except:
+            # a collection that failed to flush has restored its own changes
+            for collection, changes in flushed:
+                collection.restore(changes)
+            raise
+    
+    def __writeSegment(self, collection: VectorCollectionAbstract):
+        """ Write the segment file of the collection, and start the log of the changes after it """
+        assert self.segment_io is not None
+        ids = collection.keys()
+        chunk_size = self.SEGMENT_CHUNK_ROWS
+        generation = self.disk_io.getGeneration(collection.name)
+        self.segment_io.write(
+            collection.name, collection.dim, generation, ids, 
+            (collection.getBlock(ids[i: i + chunk_size], as_numpy=True) for i in range(0, len(ids), chunk_size)), 
+            capacity = int(len(ids) * (1 + self.SEGMENT_SPARE_RATIO)) + 1
+        )
+        with self.disk_io.transaction():
+            self.disk_io.resetLog(collection.name, generation)
+    
+    def __compactSegment(self, collection: VectorCollectionAbstract):
+        """ Rewrite the segment file of the collection if the log or the added vectors outgrow it """
+        if self.segment_io is None:
+            return
+        header = self.segment_io.readHeader(collection.name)
+        if header is None or len(collection) > header[2] \
+            or self.disk_io.countLog(collection.name) > self.SEGMENT_COMPACT_RATIO * len(collection) \
+            or not self.disk_io.isLogged(collection.name, header[3]):
+            self.__writeSegment(collection)
 
     @property
     def disk_io(self):
         return self.__disk_io
     
+    @property
+    def segment_io(self) -> Optional[SegmentIO]:
+        return self.__segment_io
+    
     @property
     def database_path(self):
         return self.__database_path
@@ -56,28 +229,41 @@ class VectorDatabase(dict[str, "VectorCollectionAbstract[float]"]):
         return self[name]
     
     def getCollectionNames(self) -> list[str]:
-        return list(self.keys())
+        """ Names of all collections, including the ones not loaded in lazy mode """
+        return list(self.__configs.keys())
     
     def createCollection(self, collection_config: CollectionConfig) -> VectorCollectionAbstract:
         """ Insert a new collection to database and create a new table in sqlite database """
         _name = collection_config["name"]
-        assert not self.keys().__contains__(_name), f"Collection '{_name}' already exists"
-        self[_name] = getVectorCollectionBackend()(self, quite_loading=not self.VERBOSE, **collection_config)
+        assert not self.__configs.__contains__(_name), f"Collection '{_name}' already exists"
+        self.__configs[_name] = collection_config
         self.disk_io.touchTable(_name)
-        return self[_name]
+        collection = self.__loadCollection(_name)
+        self.__evict(keep = _name)
+        return collection
     
     def deleteCollection(self, name: str):
-        assert self.keys().__contains__(name), f"Collection '{name}' not exists"
-        del self[name]
+        assert self.__configs.__contains__(name), f"Collection '{name}' not exists"
+        del self.__configs[name]
+        if self.isLoaded(name):
+            del self[name]
+        self.__last_access.pop(name, None)
         self.disk_io.deleteTable(name)
+        if self.segment_io is not None:
+            self.segment_io.remove(name)
 
     def commit(self):
         """
-        Commit all changes to sqlite database and commit
+        Commit all changes to sqlite database and commit, 
+        changes of all collections are written in one transaction, 
+        then the segment files that are outgrown by the changes are rewritten if "mmap" storage is used
         """
-        for collection in self.values():
-            collection.flush()
-        self.disk_io.commit()
+        loaded = dict(dict.items(self))
+        generations = {name: self.disk_io.getGeneration(name) for name in loaded}
+        self.__flush(list(loaded.values()))
+        for name, collection in loaded.items():
+            if self.disk_io.getGeneration(name) != generations[name]:
+                self.__compactSegment(collection)
 
 
 def getVectorCollectionBackend(backend: str = "") -> type[VectorCollectionAbstract[NumVar]]:
@@ -87,7 +273,6 @@ def getVectorCollectionBackend(backend: str = "") -> type[VectorCollectionAbstra
         __backend = backend.lower()
     
     if __backend == "cxx" or __backend=="jit":
-        ensureEigen()
         return VectorCollection_CXX[NumVar]
 
     elif __backend == "numpy" or __backend == "np":